@@ -0,0 +1,454 @@
+#!/usr/bin/env python3
+"""
+Times the core endpoints (POST /post, /raw, /<id>, /diff, /recent and the
+pygments stylesheet) across paste sizes and lexers, calling the WSGI
+application in-process and over a local socket, and reports throughput,
+p50/p99 latency and the peak memory allocated by one request. Results can
+be saved as a JSON baseline and later runs compared against it, failing
+when any case got slower by more than the given threshold. Run from the top
+of the source tree:
+
+    PYTHONPATH=src python benchmarks/endpoints.py --save baseline.json
+    PYTHONPATH=src python benchmarks/endpoints.py --compare baseline.json
+
+Highlighting is timed cold (the render cache is turned off) and in-process
+without any time limit (so big pastes are never shown plain instead), so
+the full range of sizes (--sizes 100,10k,1m,50m) takes a while
+"""
+
+import argparse
+import http.client
+import io
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import wsgiref.simple_server as simple_server
+import wsgiref.util
+
+# Keep pasttle from opening the database of a local pasttle.ini on import
+os.environ['PASTTLECONF'] = '{0}:benchmark'.format(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pasttle.ini'),
+)
+
+import pasttle.util as util  # noqa: E402
+
+
+# Samples repeated up to each paste size, by the filename given to pasttle
+SAMPLES = {
+    'python': ('bench.py', (
+        'def fib(n):\n'
+        '    """Returns the n-th Fibonacci number"""\n'
+        '    a, b = 0, 1\n'
+        '    for _ in range(n):\n'
+        '        a, b = b, a + b  # {0}\n'
+        '    return a\n\n'
+    )),
+    'c': ('bench.c', (
+        '/* {0} */\n'
+        'static int fib(int n) {{\n'
+        '    int a = 0, b = 1, t;\n'
+        '    while (n-- > 0) {{ t = a + b; a = b; b = t; }}\n'
+        '    return a;\n'
+        '}}\n\n'
+    )),
+    'json': ('bench.json', (
+        '{{"id": {0}, "name": "fib", "values": [0, 1, 1, 2, 3, 5, 8],\n'
+        ' "nested": {{"ok": true, "ratio": 1.618, "note": null}}}}\n'
+    )),
+    'text': ('bench.txt', (
+        'Line {0} of a plain text paste, nothing to highlight in here.\n'
+    )),
+}
+
+UNITS = {'': 1, 'k': 1024, 'm': 1024 ** 2}
+
+
+def _size(text):
+    text = text.strip().lower()
+    if text[-1:] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(text)
+
+
+def _label(size):
+    for unit in ('m', 'k'):
+        if size >= UNITS[unit] and not size % UNITS[unit]:
+            return '{0}{1}'.format(size // UNITS[unit], unit)
+    return str(size)
+
+
+def _content(lexer, size, seed):
+    """
+    Deterministic content of about the given size, different for every seed
+    so new pastes don't share their stored blob
+    """
+
+    sample = SAMPLES[lexer][1]
+    lines, total, n = ['# {0}\n'.format(seed)], 0, 0
+    while total < size:
+        lines.append(sample.format(n))
+        total += len(lines[-1])
+        n += 1
+    return ''.join(lines)[:max(size, 1)]
+
+
+def _changed(content, seed):
+    """
+    A copy of the given content with about one line in fifty changed
+    """
+
+    rand = random.Random(seed)
+    lines = content.splitlines(True)
+    for _ in range(max(len(lines) // 50, 1)):
+        i = rand.randrange(len(lines))
+        lines[i] = 'changed {0}\n'.format(rand.random())
+    return ''.join(lines)
+
+
+def _multipart(content, filename):
+    boundary = 'pasttlebenchmark{0}'.format(random.getrandbits(64))
+    head = (
+        '--{0}\r\nContent-Disposition: form-data; name="filename"\r\n\r\n'
+        '{1}\r\n--{0}\r\nContent-Disposition: form-data; name="upload"; '
+        'filename="{1}"\r\nContent-Type: application/octet-stream\r\n\r\n'
+    ).format(boundary, filename).encode()
+    tail = '\r\n--{0}--\r\n'.format(boundary).encode()
+    return (
+        'multipart/form-data; boundary={0}'.format(boundary),
+        head + content.encode() + tail,
+    )
+
+
+class InProcess(object):
+    """
+    Calls the WSGI application directly
+    """
+
+    name = 'inproc'
+
+    def __init__(self, app):
+        self.app = app
+
+    def request(self, method, path, body=b'', content_type=None):
+        environ = {
+            'REQUEST_METHOD': method, 'PATH_INFO': path.split('?')[0],
+            'QUERY_STRING': path.partition('?')[2],
+            'CONTENT_LENGTH': str(len(body)), 'wsgi.input': io.BytesIO(body),
+        }
+        if content_type:
+            environ['CONTENT_TYPE'] = content_type
+        wsgiref.util.setup_testing_defaults(environ)
+        status = []
+        chunks = self.app(
+            environ, lambda code, headers, exc_info=None: status.append(code)
+        )
+        try:
+            size = sum(len(_) for _ in chunks)
+        finally:
+            getattr(chunks, 'close', lambda: None)()
+        return int(status[0].split()[0]), size
+
+    def close(self):
+        pass
+
+
+class Socket(object):
+    """
+    Sends requests over a local socket to a wsgiref server running the
+    application in a thread
+    """
+
+    name = 'socket'
+
+    def __init__(self, app):
+        import pasttle.prefork as prefork
+        self.server = simple_server.make_server(
+            '127.0.0.1', 0, app, handler_class=prefork.QuietHandler
+        )
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, daemon=True
+        )
+        self.thread.start()
+
+    def request(self, method, path, body=b'', content_type=None):
+        conn = http.client.HTTPConnection(*self.server.server_address)
+        headers = {'Content-Type': content_type} if content_type else {}
+        try:
+            conn.request(method, path, body or None, headers)
+            rsp = conn.getresponse()
+            size = 0
+            while True:
+                chunk = rsp.read(65536)
+                if not chunk:
+                    break
+                size += len(chunk)
+            return rsp.status, size
+        finally:
+            conn.close()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def _peak_kb(func):
+    """
+    Peak memory allocated (by Python, in any thread) while calling func
+    once, in KiB. Traced apart from the timed calls, tracing slows them down
+    """
+
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1] // 1024
+    finally:
+        tracemalloc.stop()
+
+
+def _time(func, iterations, seconds):
+    """
+    Calls func (returning the bytes it moved) up to iterations times or
+    until seconds are up, at least once, after an untimed warm-up call, and
+    once more to measure its memory. Returns the case's results
+    """
+
+    func()
+    latencies, moved = [], 0
+    deadline = time.monotonic() + seconds
+    while len(latencies) < iterations and (
+        not latencies or time.monotonic() < deadline
+    ):
+        started = time.perf_counter()
+        moved += func()
+        latencies.append(time.perf_counter() - started)
+    spent = sum(latencies)
+    latencies.sort()
+    return dict(
+        iterations=len(latencies),
+        ops=len(latencies) / spent,
+        mb_s=moved / spent / UNITS['m'],
+        p50_ms=latencies[len(latencies) // 2] * 1000,
+        p99_ms=latencies[int(len(latencies) * 0.99)] * 1000,
+        peak_kb=_peak_kb(func),
+    )
+
+
+def _expect(status, size, expected=200):
+    if status != expected:
+        raise RuntimeError('Got a {0} instead of a {1}'.format(
+            status, expected,
+        ))
+    return size
+
+
+def _post(client, content, filename):
+    content_type, body = _multipart(content, filename)
+    status, size = client.request('POST', '/post', body, content_type)
+    _expect(status, size)
+    return body
+
+
+def cases(client, sizes, lexers, iterations, seconds):
+    """
+    Yields the (name, results) of every case against the given client
+    """
+
+    import pasttle.model as model
+
+    def newest():
+        with model.engine.connect() as conn:
+            return conn.execute(
+                model.Paste.__table__.select().with_only_columns(
+                    [model.Paste.id]
+                ).order_by(model.Paste.id.desc()).limit(1)
+            ).scalar()
+
+    seeds = iter(range(sys.maxsize))
+    for size in sizes:
+        for lexer in lexers:
+            name = '{0}/{{0}}/{1}/{2}'.format(client.name, lexer, _label(size))
+            filename = SAMPLES[lexer][0]
+            content = _content(lexer, size, 0)
+            yield name.format('post'), _time(
+                lambda: len(_post(
+                    client, _content(lexer, size, next(seeds)), filename,
+                )), iterations, seconds,
+            )
+            _post(client, content, filename)
+            parent = newest()
+            _post(client, _changed(content, 0), filename)
+            child = newest()
+            for endpoint, path in (
+                ('raw', '/raw/{0}'.format(parent)),
+                ('highlight', '/{0}'.format(parent)),
+                ('diff', '/diff/{0}..{1}'.format(parent, child)),
+            ):
+                yield name.format(endpoint), _time(
+                    lambda: _expect(*client.request('GET', path)),
+                    iterations, seconds,
+                )
+    style = util.conf.get(util.cfg_section, 'pygments_style')
+    for endpoint, path in (
+        ('recent', '/recent'),
+        ('css', '/pygments/{0}.css'.format(style)),
+    ):
+        yield '{0}/{1}'.format(client.name, endpoint), _time(
+            lambda: _expect(*client.request('GET', path)),
+            iterations, seconds,
+        )
+
+
+def run(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        # A database file shared by the server thread, and highlighting
+        # timed cold, in this process (so its memory is measured) and never
+        # given up on
+        util.conf.set(util.cfg_section, 'dsn', 'sqlite:///{0}'.format(
+            os.path.join(tmp, 'pasttle.db'),
+        ))
+        util.conf.set(util.cfg_section, 'render_cache_bytes', '0')
+        util.conf.set(util.cfg_section, 'highlight_workers', '0')
+        util.conf.set(util.cfg_section, 'diff_highlight_ms', '0')
+        import pasttle.model as model
+        import pasttle.server as server
+        # Only in-memory databases get their tables on import
+        model.create_schema()
+        server.stylesheets.load()
+        results = {}
+        for transport in args.transports:
+            client = TRANSPORTS[transport](server.application)
+            try:
+                for name, result in cases(
+                    client, args.sizes, args.lexers, args.iterations,
+                    args.seconds,
+                ):
+                    results[name] = result
+                    _print(name, result)
+            finally:
+                client.close()
+    return results
+
+
+def _versions():
+    import bottle
+    import pygments
+    import sqlalchemy
+    import pasttle
+    return dict(
+        python=platform.python_version(), platform=platform.platform(),
+        pasttle=pasttle.__version__, bottle=bottle.__version__,
+        pygments=pygments.__version__, sqlalchemy=sqlalchemy.__version__,
+    )
+
+
+def _print(name, result):
+    print('{0:<32} {1:>9.1f} {2:>9.2f} {3:>10.2f} {4:>10.2f} {5:>10}'.format(
+        name, result['ops'], result['mb_s'], result['p50_ms'],
+        result['p99_ms'], result['peak_kb'],
+    ))
+
+
+def compare(baseline, results, threshold):
+    """
+    Returns the cases whose p50 latency grew, or whose throughput dropped,
+    by more than the threshold (a fraction) compared to the baseline
+    """
+
+    regressions = []
+    for name, result in sorted(results.items()):
+        before = baseline.get(name)
+        if before is None:
+            continue
+        slower = result['p50_ms'] / before['p50_ms'] - 1
+        fewer = 1 - result['ops'] / before['ops']
+        worst = max(slower, fewer)
+        print('{0:<32} {1:>+9.1%}{2}'.format(
+            name, worst, '  REGRESSION' if worst > threshold else '',
+        ))
+        if worst > threshold:
+            regressions.append(name)
+    return regressions
+
+
+TRANSPORTS = {
+    'inproc': InProcess,
+    'socket': Socket,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip(),
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument(
+        '--sizes', default='100,10k,1m',
+        type=lambda _: [_size(s) for s in _.split(',')],
+        help='Paste sizes, in bytes with an optional k or m suffix',
+    )
+    parser.add_argument(
+        '--lexers', default=','.join(SAMPLES),
+        type=lambda _: _.split(','),
+        help='Kinds of content, out of {0}'.format(', '.join(SAMPLES)),
+    )
+    parser.add_argument(
+        '--transports', default=','.join(TRANSPORTS),
+        type=lambda _: _.split(','),
+    )
+    parser.add_argument(
+        '--iterations', type=int, default=50,
+        help='Most requests per case',
+    )
+    parser.add_argument(
+        '--seconds', type=float, default=2,
+        help='Most time per case (at least one request is always made)',
+    )
+    parser.add_argument('--save', help='Write the results to this file')
+    parser.add_argument(
+        '--compare', help='Compare the results to this saved baseline',
+    )
+    parser.add_argument(
+        '--threshold', type=float, default=0.2,
+        help='Biggest slowdown (as a fraction) allowed by --compare',
+    )
+    args = parser.parse_args()
+    for lexer in args.lexers:
+        if lexer not in SAMPLES:
+            parser.error('Unknown lexer {0}'.format(lexer,))
+    for transport in args.transports:
+        if transport not in TRANSPORTS:
+            parser.error('Unknown transport {0}'.format(transport,))
+
+    print('{0:<32} {1:>9} {2:>9} {3:>10} {4:>10} {5:>10}'.format(
+        'case', 'ops/s', 'MB/s', 'p50 ms', 'p99 ms', 'peak KiB',
+    ))
+    results = run(args)
+    if args.save:
+        with open(args.save, 'w') as out:
+            json.dump(
+                dict(versions=_versions(), results=results), out, indent=2,
+                sort_keys=True,
+            )
+    if args.compare:
+        with open(args.compare) as saved:
+            baseline = json.load(saved)
+        print()
+        regressions = compare(
+            baseline['results'], results, args.threshold,
+        )
+        if regressions:
+            print('{0} cases regressed by more than {1:.0%}'.format(
+                len(regressions), args.threshold,
+            ))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
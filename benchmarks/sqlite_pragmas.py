@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Concurrent reads and writes against an SQLite database with and without the
+pragmas from pasttle.ini, each reader and writer in a process of its own
+(like prefork workers). Run from the top of the source tree:
+
+    PYTHONPATH=src python benchmarks/sqlite_pragmas.py --seconds 10
+"""
+
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+# Keep pasttle from opening the database of a local pasttle.ini on import
+os.environ['PASTTLECONF'] = '{0}:benchmark'.format(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pasttle.ini'),
+)
+
+import sqlalchemy  # noqa: E402
+import sqlalchemy.exc  # noqa: E402
+import sqlalchemy.orm as orm  # noqa: E402
+
+import pasttle.model as model  # noqa: E402
+
+
+def _engine(path, pragmas):
+    engine = sqlalchemy.create_engine('sqlite:///{0}'.format(path))
+    model.use_pragmas(engine, pragmas)
+    return engine
+
+
+def _work(path, pragmas, role, seconds, results):
+    engine = _engine(path, pragmas)
+    session = orm.sessionmaker(bind=engine)()
+    done = errors = 0
+    latencies = []
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        started = time.perf_counter()
+        try:
+            if role == 'writer':
+                session.add(model.Paste(
+                    content=u'{0} {1}\n'.format(os.getpid(), done) * 50,
+                    mimetype='text/plain',
+                ))
+                session.commit()
+            else:
+                session.query(model.Paste).filter_by(
+                    id=random.randint(1, 1000)
+                ).first()
+                session.rollback()
+            done += 1
+            latencies.append(time.perf_counter() - started)
+        except sqlalchemy.exc.OperationalError:
+            # "database is locked"
+            session.rollback()
+            errors += 1
+    session.close()
+    results.put((role, done, errors, latencies))
+
+
+def run(pragmas, writers, readers, seconds):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'pasttle.db')
+        engine = _engine(path, pragmas)
+        model.Base.metadata.create_all(engine)
+        session = orm.sessionmaker(bind=engine)()
+        session.add_all([
+            model.Paste(content=u'seed {0}'.format(_), mimetype='text/plain')
+            for _ in range(1000)
+        ])
+        session.commit()
+        session.close()
+        engine.dispose()
+        results = multiprocessing.Queue()
+        procs = [
+            multiprocessing.Process(
+                target=_work, args=(path, pragmas, role, seconds, results)
+            ) for role in ['writer'] * writers + ['reader'] * readers
+        ]
+        for proc in procs:
+            proc.start()
+        totals = {}
+        for proc in procs:
+            role, done, errors, latencies = results.get()
+            total = totals.setdefault(role, [0, 0, []])
+            total[0] += done
+            total[1] += errors
+            total[2].extend(latencies)
+        for proc in procs:
+            proc.join()
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=5)
+    args = parser.parse_args()
+
+    print('{0:<10} {1:<7} {2:>10} {3:>8} {4:>10}'.format(
+        'pragmas', 'role', 'ops/s', 'errors', 'p99 ms',
+    ))
+    for label, pragmas in (
+        ('defaults', {}), ('pasttle', model.sqlite_pragmas()),
+    ):
+        totals = run(pragmas, args.writers, args.readers, args.seconds)
+        for role in ('writer', 'reader'):
+            done, errors, latencies = totals.get(role, (0, 0, []))
+            latencies.sort()
+            p99 = latencies[int(len(latencies) * 0.99)] if latencies else 0
+            print('{0:<10} {1:<7} {2:>10.0f} {3:>8} {4:>10.2f}'.format(
+                label, role, done / args.seconds, errors, p99 * 1000,
+            ))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
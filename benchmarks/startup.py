@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Cold start time of pasttle: how long a fresh interpreter takes to import
+pasttle.server, and then to answer its first paste page, each run in a
+process of its own. Run from the top of the source tree:
+
+    PYTHONPATH=src python benchmarks/startup.py --runs 20
+
+With --modules, the slowest modules imported (by python -X importtime) are
+listed too
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+
+# Keep pasttle from opening the database of a local pasttle.ini on import
+CONF = '{0}:benchmark'.format(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pasttle.ini'),
+)
+
+# Run in every child process, prints its timings as JSON
+CHILD = '''
+import io, json, time, wsgiref.util
+started = time.perf_counter()
+import pasttle.server as server
+imported = time.perf_counter()
+
+def call(method, path, body=b'', content_type=''):
+    environ = {
+        'REQUEST_METHOD': method, 'PATH_INFO': path,
+        'CONTENT_TYPE': content_type, 'CONTENT_LENGTH': str(len(body)),
+        'wsgi.input': io.BytesIO(body),
+    }
+    wsgiref.util.setup_testing_defaults(environ)
+    return b''.join(server.application(environ, lambda *args: None))
+
+url = call(
+    'POST', '/post', b'filename=startup.py&upload=def+startup%28%29%3A+pass',
+    'application/x-www-form-urlencoded',
+)
+posted = time.perf_counter()
+call('GET', '/' + url.decode().rsplit('/', 1)[1])
+shown = time.perf_counter()
+print(json.dumps(dict(
+    imported=imported - started, posted=posted - imported,
+    shown=shown - posted, total=shown - started,
+)))
+'''
+
+
+def _env():
+    env = dict(os.environ, PASTTLECONF=CONF)
+    return env
+
+
+def run(runs):
+    timings = []
+    for _ in range(runs):
+        out = subprocess.run(
+            [sys.executable, '-c', CHILD], env=_env(), check=True,
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+        ).stdout
+        timings.append(json.loads(out))
+    return timings
+
+
+def slowest_modules(count):
+    """
+    Returns the (cumulative microseconds, module) of the slowest top level
+    imports of pasttle.server
+    """
+
+    err = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import pasttle.server'],
+        env=_env(), check=True, stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE, universal_newlines=True,
+    ).stderr
+    modules = []
+    for line in err.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # Only the modules imported by pasttle itself
+        if name.startswith('   ') and not name.startswith('    '):
+            modules.append((int(cumulative), name.strip()))
+    return sorted(modules, reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip(),
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument(
+        '--modules', type=int, default=0,
+        help='List this many of the slowest modules imported',
+    )
+    args = parser.parse_args()
+
+    timings = run(args.runs)
+    print('{0:<10} {1:>10} {2:>10} {3:>10}'.format(
+        'step', 'min ms', 'median ms', 'max ms',
+    ))
+    for step in ('imported', 'posted', 'shown', 'total'):
+        values = [_[step] * 1000 for _ in timings]
+        print('{0:<10} {1:>10.1f} {2:>10.1f} {3:>10.1f}'.format(
+            step, min(values), statistics.median(values), max(values),
+        ))
+    if args.modules:
+        print()
+        for cumulative, name in slowest_modules(args.modules):
+            print('{0:<40} {1:>10.1f} ms'.format(name, cumulative / 1000))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
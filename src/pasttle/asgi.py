@@ -0,0 +1,264 @@
+import asyncio
+import concurrent.futures as futures
+import sys
+import tempfile
+
+import pasttle.server as server
+import pasttle.util as util
+import pasttle.model as model
+
+
+class Disconnected(Exception):
+    pass
+
+
+class ASGIApplication(object):
+    """
+    Serves a WSGI application over ASGI. The request body is received
+    asynchronously (spooled to disk past ``spool_bytes``, and refused past
+    ``max_bytes`` or the limit ``path_max_bytes`` sets for its path) before
+    the WSGI application is called on the first free worker thread.
+    Response bodies are read ahead up to ``read_ahead_bytes`` at a time on
+    any free worker thread, which is given back before they are sent from
+    the event loop, so slow clients don't hold on to one
+    """
+
+    def __init__(
+        self, wsgi_app, threads, spool_bytes=1048576, max_bytes=0,
+        admission=None, path_max_bytes=None, read_ahead_bytes=262144,
+    ):
+        self.wsgi_app = wsgi_app
+        self.spool_bytes = spool_bytes
+        self.read_ahead_bytes = read_ahead_bytes
+        self.max_bytes = max_bytes
+        self.path_max_bytes = path_max_bytes or {}
+        self.admission = admission
+        self.workers = [
+            futures.ThreadPoolExecutor(1, thread_name_prefix='pasttle-asgi')
+            for _ in range(threads)
+        ]
+        # Created on first use, so it belongs to the loop of the server
+        self._idle = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+        else:
+            raise ValueError('Unsupported scope {0}'.format(scope['type']))
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                model.create_schema()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _read_body(self, receive, max_bytes):
+        """
+        Returns the request body spooled into a file, or None if it is
+        bigger than max_bytes. Raises Disconnected if the client went away
+        """
+
+        body = tempfile.SpooledTemporaryFile(max_size=self.spool_bytes)
+        more = True
+        while more:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                body.close()
+                raise Disconnected()
+            body.write(message.get('body', b''))
+            more = message.get('more_body', False)
+            if max_bytes and body.tell() > max_bytes:
+                body.close()
+                return None
+        return body
+
+    def _environ(self, scope, body):
+        server_name, server_port = scope.get('server') or ('localhost', 80)
+        size = body.tell()
+        body.seek(0)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode().decode(
+                'latin-1'
+            ),
+            'PATH_INFO': scope['path'].encode().decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': server_name,
+            'SERVER_PORT': str(server_port),
+            'SERVER_PROTOCOL': 'HTTP/{0}'.format(
+                scope.get('http_version', '1.1'),
+            ),
+            'CONTENT_LENGTH': str(size),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': body,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        if scope.get('client'):
+            environ['REMOTE_ADDR'] = scope['client'][0]
+        for name, value in scope.get('headers', []):
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if name == 'CONTENT_TYPE':
+                environ[name] = value
+            elif name != 'CONTENT_LENGTH':
+                key = 'HTTP_{0}'.format(name)
+                if key in environ:
+                    value = '{0},{1}'.format(environ[key], value)
+                environ[key] = value
+        return environ
+
+    def _start(self, environ):
+        """
+        Calls the WSGI application and reads ahead the first chunks of the
+        response, by then its status and headers have been set. Bodies
+        built up front are read whole
+        """
+
+        started = []
+
+        def start_response(status, headers, exc_info=None):
+            started[:] = [status, headers]
+
+        result = self.wsgi_app(environ, start_response)
+        chunks = iter(result)
+        eager = isinstance(result, (list, tuple))
+        batch, more = self._read_ahead(chunks, 0 if eager else None)
+        return started, result, chunks, batch, more
+
+    def _read_ahead(self, chunks, limit=None):
+        """
+        Returns the next chunks of a response body, at least ``limit`` bytes
+        of them (``read_ahead_bytes`` by default, 0 for all of them) unless
+        it ends first, and whether there are more
+        """
+
+        if limit is None:
+            limit = self.read_ahead_bytes
+        batch = []
+        size = 0
+        for chunk in chunks:
+            batch.append(chunk)
+            size += len(chunk)
+            if limit and size >= limit:
+                return batch, True
+        return batch, False
+
+    async def _error(self, send, status, message, headers=()):
+        await send({
+            'type': 'http.response.start', 'status': status,
+            'headers': [(b'content-type', b'text/plain')] + list(headers),
+        })
+        await send({'type': 'http.response.body', 'body': message})
+
+    async def _http(self, scope, receive, send):
+        # Requests past the admission limit are turned away before reading
+        # their body, instead of queueing up for the worker threads
+        if self.admission is not None and not self.admission.enter():
+            await self._error(
+                send, 503, b'Too busy, try again later',
+                [(b'retry-after', b'1')],
+            )
+            return
+        try:
+            await self._respond(scope, receive, send)
+        finally:
+            if self.admission is not None:
+                self.admission.leave()
+
+    async def _worker(self):
+        """
+        Waits for a free worker thread and takes it
+        """
+
+        if self._idle is None:
+            self._idle = asyncio.LifoQueue()
+            for worker in self.workers:
+                self._idle.put_nowait(worker)
+        return await self._idle.get()
+
+    async def _respond(self, scope, receive, send):
+        loop = asyncio.get_event_loop()
+        try:
+            body = await self._read_body(receive, self.path_max_bytes.get(
+                scope['path'], self.max_bytes
+            ))
+        except Disconnected:
+            return
+        if body is None:
+            await self._error(send, 413, b'Paste is too big')
+            return
+        environ = self._environ(scope, body)
+        environ['pasttle.admitted'] = self.admission is not None
+        worker = await self._worker()
+        try:
+            started, result, chunks, batch, more = await loop.run_in_executor(
+                worker, self._start, environ
+            )
+            # The worker thread is free for other requests while the chunks
+            # read so far are sent, the next ones are read on any free one
+            self._idle.put_nowait(worker)
+            worker = None
+            try:
+                status, headers = started
+                await send({
+                    'type': 'http.response.start',
+                    'status': int(status.split(' ', 1)[0]),
+                    'headers': [
+                        (k.lower().encode('latin-1'), v.encode('latin-1'))
+                        for k, v in headers
+                    ],
+                })
+                while True:
+                    for chunk in batch:
+                        if chunk:
+                            await send({
+                                'type': 'http.response.body', 'body': chunk,
+                                'more_body': True,
+                            })
+                    if not more:
+                        break
+                    worker = await self._worker()
+                    batch, more = await loop.run_in_executor(
+                        worker, self._read_ahead, chunks
+                    )
+                    self._idle.put_nowait(worker)
+                    worker = None
+                await send({'type': 'http.response.body', 'body': b''})
+            finally:
+                if hasattr(result, 'close'):
+                    if worker is None:
+                        worker = await self._worker()
+                    await loop.run_in_executor(worker, result.close)
+        finally:
+            if worker is not None:
+                self._idle.put_nowait(worker)
+            body.close()
+
+    def shutdown(self):
+        for worker in self.workers:
+            worker.shutdown(wait=False)
+
+
+def _max_body_bytes(pastes=1):
+    max_bytes = util.conf.getint(util.cfg_section, 'max_paste_bytes')
+    return (max_bytes + server.FORM_BYTES) * pastes if max_bytes else 0
+
+
+application = ASGIApplication(
+    server.application, util.conf.getint(util.cfg_section, 'asgi_threads'),
+    max_bytes=_max_body_bytes(), admission=server.admission,
+    path_max_bytes={'/bulk': _max_body_bytes(
+        util.conf.getint(util.cfg_section, 'bulk_max_pastes')
+    )},
+)
@@ -0,0 +1,122 @@
+import collections
+import threading
+import time
+
+
+class LRUCache(object):
+    """
+    Thread-safe, least-recently-used cache bounded by the total size (in
+    bytes) of the values it holds rather than by the number of entries
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        """
+        Returns the cached value for the given key (marking it as the most
+        recently used) or the default if it is not cached
+        """
+
+        with self._lock:
+            try:
+                value = self._items[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """
+        Caches the given value, evicting the least recently used entries
+        until it fits the byte budget. Values bigger than the whole budget
+        are not cached at all
+        """
+
+        size = len(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._items:
+                self.size -= len(self._items.pop(key))
+            self._items[key] = value
+            self.size += size
+            while self.size > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.size = 0
+
+    def stats(self):
+        return dict(
+            entries=len(self._items), bytes=self.size,
+            max_bytes=self.max_bytes, hits=self.hits,
+            misses=self.misses, evictions=self.evictions,
+        )
+
+    def __repr__(self):
+        return u'<LRUCache {0}/{1} bytes, {2} entries>'.format(
+            self.size, self.max_bytes, len(self._items))
+
+
+class Snapshot(object):
+    """
+    Holds a single value computed from data that only changes at known
+    points, until it is explicitly invalidated or, if given a ``ttl``, for
+    up to that many seconds (for changes made by other processes). A value
+    that was being computed while the data changed is handed out but not
+    kept
+    """
+
+    def __init__(self, ttl=None):
+        self.value = None
+        self.generation = 0
+        self.ttl = ttl
+        self._computed = None
+        self._lock = threading.Lock()
+
+    def get(self, compute):
+        """
+        Returns the held value, computing it with the given callable if
+        there is none
+        """
+
+        with self._lock:
+            value, generation = self.value, self.generation
+            if self.ttl is not None and value is not None and \
+                    time.monotonic() - self._computed >= self.ttl:
+                value = None
+        if value is None:
+            started = time.monotonic()
+            value = compute()
+            with self._lock:
+                if generation == self.generation:
+                    self.value, self._computed = value, started
+        return value
+
+    def invalidate(self):
+        with self._lock:
+            self.value = None
+            self.generation += 1
+
+    def __repr__(self):
+        return u'<Snapshot generation {0}, {1}>'.format(
+            self.generation, 'empty' if self.value is None else 'held')
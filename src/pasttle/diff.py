@@ -0,0 +1,199 @@
+import html
+import time
+
+import pasttle.lexing as lexing
+import pasttle.metrics as metrics
+import pasttle.render as render
+import pasttle.sandbox as sandbox
+import pasttle.util as util
+
+
+def _common_ends(a, b):
+    """
+    Returns how many lines the two lists have in common at their start and,
+    after those, at their end
+    """
+
+    limit = min(len(a), len(b))
+    prefix = 0
+    while prefix < limit and a[prefix] == b[prefix]:
+        prefix += 1
+    limit -= prefix
+    suffix = 0
+    while suffix < limit and a[-1 - suffix] == b[-1 - suffix]:
+        suffix += 1
+    return prefix, suffix
+
+
+def _intern(a, b):
+    """
+    Maps every distinct line to a small integer, so the matcher hashes and
+    compares ints instead of (possibly long) strings
+    """
+
+    ids = {}
+    return (
+        [ids.setdefault(_, len(ids)) for _ in a],
+        [ids.setdefault(_, len(ids)) for _ in b],
+    )
+
+
+def opcodes(a, b, max_lines=0):
+    """
+    Returns the difflib opcodes turning the list of lines a into b. The
+    lines both have in common at the start and end are skipped before
+    matching, and if what remains of either side is longer than max_lines
+    (0 means no limit) it is not matched at all but replaced as a whole,
+    which keeps the cost linear on big inputs
+    """
+
+    prefix, suffix = _common_ends(a, b)
+    a_end, b_end = len(a) - suffix, len(b) - suffix
+    ops = []
+    if prefix:
+        ops.append(('equal', 0, prefix, 0, prefix))
+    middle_a, middle_b = a[prefix:a_end], b[prefix:b_end]
+    if max_lines and max(len(middle_a), len(middle_b)) > max_lines:
+        util.log.debug('Not matching {0}/{1} lines'.format(
+            len(middle_a), len(middle_b),
+        ))
+        tag = 'replace' if middle_a and middle_b else \
+            'delete' if middle_a else 'insert'
+        ops.append((tag, prefix, a_end, prefix, b_end))
+    elif middle_a or middle_b:
+        import difflib
+
+        with metrics.stage('diff'):
+            matcher = difflib.SequenceMatcher(
+                None, *_intern(middle_a, middle_b)
+            )
+            for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+                ops.append(
+                    (tag, i1 + prefix, i2 + prefix, j1 + prefix, j2 + prefix)
+                )
+    if suffix:
+        ops.append(('equal', a_end, len(a), b_end, len(b)))
+    return ops
+
+
+def _grouped(ops, context):
+    """
+    Groups the opcodes into hunks with up to the given number of lines of
+    context, the same way difflib.SequenceMatcher.get_grouped_opcodes does
+    """
+
+    if not ops:
+        ops = [('equal', 0, 1, 0, 1)]
+    if ops[0][0] == 'equal':
+        tag, i1, i2, j1, j2 = ops[0]
+        ops[0] = tag, max(i1, i2 - context), i2, max(j1, j2 - context), j2
+    if ops[-1][0] == 'equal':
+        tag, i1, i2, j1, j2 = ops[-1]
+        ops[-1] = tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context)
+    group = []
+    for tag, i1, i2, j1, j2 in ops:
+        if tag == 'equal' and i2 - i1 > context * 2:
+            group.append((tag, i1, min(i2, i1 + context), j1,
+                          min(j2, j1 + context)))
+            yield group
+            group = []
+            i1, j1 = max(i1, i2 - context), max(j1, j2 - context)
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == 'equal'):
+        yield group
+
+
+def _range(start, stop):
+    """
+    Formats a hunk line range the way unified diffs do
+    """
+
+    length = stop - start
+    if length == 1:
+        return u'{0}'.format(start + 1)
+    return u'{0},{1}'.format(start + 1 if length else start, length)
+
+
+def hunks(a, b, fromfile, tofile, context=3, max_lines=0):
+    """
+    Yields the unified diff between the two lists of lines one hunk (as a
+    list of lines, without line endings) at a time, the file headers go with
+    the first one. See opcodes() for max_lines
+    """
+
+    header = [u'--- {0}'.format(fromfile), u'+++ {0}'.format(tofile)]
+    for group in _grouped(opcodes(a, b, max_lines), context):
+        first, last = group[0], group[-1]
+        hunk, header = header, []
+        hunk.append(u'@@ -{0} +{1} @@'.format(
+            _range(first[1], last[2]), _range(first[3], last[4]),
+        ))
+        for tag, i1, i2, j1, j2 in group:
+            if tag == 'equal':
+                hunk.extend([u' ' + _ for _ in a[i1:i2]])
+                continue
+            if tag in ('replace', 'delete'):
+                hunk.extend([u'-' + _ for _ in a[i1:i2]])
+            if tag in ('replace', 'insert'):
+                hunk.extend([u'+' + _ for _ in b[j1:j2]])
+        yield hunk
+
+
+def _plain(hunk):
+    return u'<div class="highlight"><pre>{0}\n</pre></div>'.format(
+        html.escape(u'\n'.join(hunk))
+    ).encode()
+
+
+def highlight(hunks, budget=0, pool=None, busy=None):
+    """
+    Highlights diff hunks one at a time, numbering the lines as if they
+    were highlighted all together. Once budget seconds (0 means no limit)
+    have been spent highlighting, the remaining hunks are sent as plain text.
+    With a pool (see pasttle.sandbox) every hunk is highlighted in a worker
+    process, one that takes too long is sent as plain text along with the
+    rest. So is any hunk no worker was free for, or whose worker failed
+    otherwise (e.g. did not start), but only for now: its first line number
+    is then appended to the ``busy`` list, if given
+    """
+
+    hunks = iter(hunks)
+    lexer = lexing.by_name('diff')
+    deadline = time.perf_counter() + budget if budget else None
+    lineno = 1
+    for hunk in hunks:
+        left = deadline - time.perf_counter() if deadline else None
+        if left is not None and left <= 0:
+            util.log.debug(
+                'Out of time, plain diff from line {0}'.format(lineno,)
+            )
+            yield _plain(hunk)
+            for hunk in hunks:
+                yield _plain(hunk)
+            return
+        text = u'\n'.join(hunk)
+        if pool is None:
+            yield render.highlight(text, lexer, linenostart=lineno)
+        else:
+            timeout = min(pool.timeout, left) if left else pool.timeout
+            try:
+                yield render.run_in(
+                    pool, render.highlight, text, lexer, lineno,
+                    timeout=timeout,
+                )
+            except sandbox.Busy:
+                if busy is not None:
+                    busy.append(lineno)
+                yield _plain(hunk)
+            except sandbox.Failed as ex:
+                util.log.warn('Plain diff from line {0}: {1}'.format(
+                    lineno, ex,
+                ))
+                if busy is not None and \
+                        not isinstance(ex, sandbox.TimedOut):
+                    busy.append(lineno)
+                yield _plain(hunk)
+                for hunk in hunks:
+                    yield _plain(hunk)
+                return
+        lineno += len(hunk)
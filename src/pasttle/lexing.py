@@ -0,0 +1,236 @@
+import fnmatch
+import functools
+import os
+import threading
+import time
+
+import pygments.util
+
+import pasttle.util as util
+
+
+# pygments.lexers and its mapping of every lexer take a while to load, they
+# are only imported once a lexer is needed
+
+ClassNotFound = pygments.util.ClassNotFound
+
+
+class Registry(object):
+    """
+    Memoized lexer lookups. The name, alias and mime type tables are built
+    once from the pygments lexer mapping (which does not import any lexer
+    module), lexer classes are only loaded and instantiated the first time
+    they are needed and then re-used for every request
+    """
+
+    def __init__(self):
+        import pygments.lexers as lexers
+
+        # lexer name -> (aliases, filename patterns, mime types)
+        self.names = {}
+        self.by_alias = {}
+        self.by_mimetype = {}
+        for name, aliases, filenames, mimetypes in lexers.get_all_lexers():
+            self.names.setdefault(name, (aliases, filenames, mimetypes))
+            self.by_alias.setdefault(name.lower(), name)
+            for alias in aliases:
+                self.by_alias.setdefault(alias.lower(), name)
+            for mimetype in mimetypes:
+                self.by_mimetype.setdefault(mimetype, name)
+        self._classes = None
+        self._instances = {}
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        """
+        Returns the (shared) lexer instance for the given lexer name
+        """
+
+        lexer = self._instances.get(name)
+        if lexer is None:
+            import pygments.lexers as lexers
+            lexer = self._instances[name] = lexers.find_lexer_class(name)()
+        return lexer
+
+    def classes(self):
+        """
+        Returns every lexer class, loading them all the first time it is
+        called
+        """
+
+        with self._lock:
+            if self._classes is None:
+                import pygments.lexers as lexers
+                self._classes = [
+                    lexers.find_lexer_class(_) for _ in self.names
+                ]
+        return self._classes
+
+    @functools.lru_cache(maxsize=1024)
+    def for_filename(self, filename):
+        """
+        Returns the (lexer class, is primary pattern) pairs for the lexers
+        whose filename patterns match the given base file name
+        """
+
+        candidates = []
+        for cls in self.classes():
+            if [_ for _ in cls.filenames if fnmatch.fnmatchcase(filename, _)]:
+                candidates.append((cls, True))
+            elif [
+                _ for _ in cls.alias_filenames
+                if fnmatch.fnmatchcase(filename, _)
+            ]:
+                candidates.append((cls, False))
+        return tuple(candidates)
+
+    def __repr__(self):
+        return u'<Registry {0} lexers, {1} loaded>'.format(
+            len(self.names), len(self._instances))
+
+
+_registry = None
+
+
+def registry():
+    """
+    Returns the lexer registry, building it on first use
+    """
+
+    global _registry
+    if _registry is None:
+        _registry = Registry()
+    return _registry
+
+
+def by_name(name):
+    """
+    Returns the lexer for the given alias (or full lexer name), raises
+    ClassNotFound if there isn't one
+    """
+
+    reg = registry()
+    try:
+        return reg.get(reg.by_alias[(name or '').lower()])
+    except KeyError:
+        raise ClassNotFound('no lexer for alias {0!r} found'.format(name))
+
+
+def by_mimetype(mimetype):
+    """
+    Returns the lexer for the given mime type, raises ClassNotFound if there
+    isn't one
+    """
+
+    reg = registry()
+    try:
+        return reg.get(reg.by_mimetype[mimetype])
+    except KeyError:
+        raise ClassNotFound(
+            'no lexer for mimetype {0!r} found'.format(mimetype)
+        )
+
+
+def alias_for_mimetype(mimetype):
+    """
+    Returns the main alias of the lexer for the given mime type, without
+    loading the lexer itself
+    """
+
+    reg = registry()
+    try:
+        return reg.names[reg.by_mimetype[mimetype]][0][0]
+    except (KeyError, IndexError):
+        raise ClassNotFound(
+            'no lexer for mimetype {0!r} found'.format(mimetype)
+        )
+
+
+def for_paste(name, mimetype):
+    """
+    Returns the lexer a stored paste is highlighted with: the one it was
+    stored with if it can be found, or the one matching its mime type
+    """
+
+    try:
+        return by_name(name)
+    except ClassNotFound:
+        return by_mimetype(mimetype)
+
+
+class GuessTimeout(Exception):
+    pass
+
+
+def _scores(classes, text, deadline):
+    """
+    Yields how well each of the given lexer classes thinks it can handle the
+    text, raises GuessTimeout once the deadline is reached
+    """
+
+    for cls in classes:
+        if time.perf_counter() > deadline:
+            raise GuessTimeout()
+        yield cls.analyse_text(text)
+
+
+def _guess_for_filename(reg, filename, sample, deadline):
+    candidates = reg.for_filename(os.path.basename(filename))
+    if len(candidates) < 2:
+        return candidates[0][0] if candidates else None
+    best, best_key = None, None
+    classes = [_[0] for _ in candidates]
+    for (cls, primary), score in zip(
+        candidates, _scores(classes, sample, deadline)
+    ):
+        if score == 1.0:
+            return cls
+        key = (score, primary, cls.priority, cls.__name__)
+        if best_key is None or key > best_key:
+            best, best_key = cls, key
+    return best
+
+
+def _guess_for_content(reg, sample, deadline):
+    import pygments.modeline as modeline
+
+    filetype = modeline.get_filetype_from_buffer(sample)
+    if filetype:
+        try:
+            return by_name(filetype).__class__
+        except ClassNotFound:
+            pass
+    best, best_score = None, 0.0
+    classes = reg.classes()
+    for cls, score in zip(classes, _scores(classes, sample, deadline)):
+        if score == 1.0:
+            return cls
+        if score > best_score:
+            best, best_score = cls, score
+    return best
+
+
+def guess(sample, filename=None):
+    """
+    Guesses the lexer for a paste from a sample of its content (and its
+    filename, if any) the same way pygments does, but giving up after
+    ``lexer_guess_ms`` milliseconds. Falls back to plain text if nothing
+    matched or time ran out. Returns the lexer and the seconds it took
+    """
+
+    started = time.perf_counter()
+    deadline = started + \
+        util.conf.getint(util.cfg_section, 'lexer_guess_ms') / 1000.0
+    reg = registry()
+    cls = None
+    try:
+        if filename:
+            cls = _guess_for_filename(reg, filename, sample, deadline)
+        if cls is None:
+            cls = _guess_for_content(reg, sample, deadline)
+    except GuessTimeout:
+        util.log.warn('Gave up guessing the lexer for {0}'.format(filename,))
+    elapsed = time.perf_counter() - started
+    if cls is None:
+        return by_mimetype('text/plain'), elapsed
+    return reg.get(cls.name), elapsed
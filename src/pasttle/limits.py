@@ -0,0 +1,202 @@
+import math
+import threading
+import time
+import types
+
+import bottle
+
+
+class _Shard(object):
+
+    __slots__ = ('buckets', 'lock', 'swept', 'limited')
+
+    def __init__(self, now):
+        # key -> (tokens left, when they were counted)
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.swept = now
+        self.limited = 0
+
+
+class TokenBuckets(object):
+    """
+    Per-client token buckets, refilled at ``rate`` tokens per second up to
+    ``burst``. The table is split in shards with a lock each, so concurrent
+    requests rarely wait on each other, and the buckets left idle long
+    enough to be full again are dropped (which is the same as keeping them)
+    """
+
+    def __init__(self, rate, burst=0, shards=16, clock=time.monotonic):
+        self.rate = float(rate)
+        self.burst = float(max(burst, 1))
+        # Time an empty bucket takes to fill up again
+        self.idle = self.burst / self.rate
+        self._clock = clock
+        self._shards = [_Shard(clock()) for _ in range(shards)]
+
+    def take(self, key, cost=1.0):
+        """
+        Takes cost tokens from the bucket of the given key. Returns 0 if it
+        had enough of them, or how many seconds until it will
+        """
+
+        shard = self._shards[hash(key) % len(self._shards)]
+        now = self._clock()
+        with shard.lock:
+            bucket = shard.buckets.get(key)
+            if bucket is None:
+                tokens = self.burst
+            else:
+                tokens = min(
+                    self.burst, bucket[0] + (now - bucket[1]) * self.rate
+                )
+            if tokens >= cost:
+                shard.buckets[key] = (tokens - cost, now)
+                wait = 0.0
+            else:
+                shard.buckets[key] = (tokens, now)
+                wait = (cost - tokens) / self.rate
+                shard.limited += 1
+            if now - shard.swept >= self.idle:
+                self._sweep(shard, now)
+        return wait
+
+    def _sweep(self, shard, now):
+        shard.buckets = {
+            key: bucket for key, bucket in shard.buckets.items()
+            if now - bucket[1] < self.idle
+        }
+        shard.swept = now
+
+    @property
+    def limited(self):
+        """
+        How many times a bucket did not have enough tokens
+        """
+
+        return sum(_.limited for _ in self._shards)
+
+    def __len__(self):
+        return sum(len(_.buckets) for _ in self._shards)
+
+    def __repr__(self):
+        return u'<TokenBuckets {0}/s burst {1}, {2} clients>'.format(
+            self.rate, self.burst, len(self))
+
+
+class Admission(object):
+    """
+    Counts the requests in flight, turning new ones away past the limit
+    instead of letting them wait for a thread
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.inflight = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def enter(self):
+        """
+        Admits a new request, returns False if there are too many in flight
+        """
+
+        with self._lock:
+            if self.inflight >= self.limit:
+                self.rejected += 1
+                return False
+            self.inflight += 1
+            return True
+
+    def leave(self):
+        with self._lock:
+            self.inflight -= 1
+
+    def __repr__(self):
+        return u'<Admission {0}/{1} in flight>'.format(
+            self.inflight, self.limit)
+
+
+def _error(status, message, retry_after):
+    return bottle.HTTPError(status, message, headers={
+        'Retry-After': str(max(int(math.ceil(retry_after)), 1)),
+    })
+
+
+def client_addr(environ, proxies=0):
+    """
+    Returns the address of the client: the peer address of the request or,
+    behind the given number of trusted proxies, the one the outermost of
+    them added to ``X-Forwarded-For`` (anything before it can be forged)
+    """
+
+    addr = environ.get('REMOTE_ADDR')
+    if proxies:
+        forwarded = [
+            _.strip() for _ in environ.get('HTTP_X_FORWARDED_FOR', '').split(
+                ','
+            ) if _.strip()
+        ]
+        if forwarded:
+            addr = forwarded[-min(proxies, len(forwarded))]
+    return addr
+
+
+class LimitPlugin(object):
+    """
+    Bottle plugin applying the token buckets of each kind of route (its
+    ``limit`` config: ``read`` by default, ``write`` or ``None`` for no
+    limits at all) to the client address (see client_addr()), answering
+    with a 429 when empty, and the admission control, answering with a 503
+    when there are too many requests in flight. Streamed responses are in
+    flight until their last chunk is sent
+    """
+
+    name = 'limits'
+    api = 2
+
+    def __init__(self, buckets, admission=None, proxies=0):
+        self.buckets = buckets
+        self.admission = admission
+        self.proxies = proxies
+
+    def apply(self, callback, route):
+        kind = route.config.get('limit', 'read')
+        if kind is None:
+            return callback
+        buckets = self.buckets.get(kind)
+        admission = self.admission
+        if buckets is None and admission is None:
+            return callback
+
+        def wrapper(*args, **kwargs):
+            environ = bottle.request.environ
+            if buckets is not None:
+                wait = buckets.take(client_addr(environ, self.proxies))
+                if wait:
+                    return _error(429, 'Too many requests', wait)
+            # The ASGI application does its own admission control
+            if admission is None or environ.get('pasttle.admitted'):
+                return callback(*args, **kwargs)
+            if not admission.enter():
+                return _error(503, 'Too busy, try again later', 1)
+            try:
+                rv = callback(*args, **kwargs)
+            except BaseException:
+                admission.leave()
+                raise
+            if isinstance(rv, types.GeneratorType):
+                return _leaving(admission, rv)
+            admission.leave()
+            return rv
+
+        return wrapper
+
+
+def _leaving(admission, chunks):
+    try:
+        for chunk in chunks:
+            yield chunk
+    finally:
+        chunks.close()
+        admission.leave()
@@ -0,0 +1,242 @@
+import bisect
+import threading
+import time
+
+import bottle
+import sqlalchemy.event
+
+
+# Default latency buckets, in seconds
+SECONDS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+    10.0,
+)
+
+# Response size buckets, in bytes
+BYTES = tuple(256 * 4 ** _ for _ in range(9))
+
+
+class Histogram(object):
+    """
+    Counts observed values in fixed buckets (each one counts the values up
+    to its bound, not cumulative until exported)
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name, labels):
+        """
+        Yields the (name, labels, value) samples of the histogram
+        """
+
+        total = 0
+        bounds = ['{0:g}'.format(_) for _ in self.buckets] + ['+Inf']
+        for bound, count in zip(bounds, self.counts):
+            total += count
+            yield name + '_bucket', labels + (('le', bound),), total
+        yield name + '_sum', labels, self.sum
+        yield name + '_count', labels, self.count
+
+
+class Registry(object):
+    """
+    In-process metrics exported in the Prometheus text format. Histograms
+    are observed as requests go, collectors are called at export time to
+    report other components' counters
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._families = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def histogram(self, name, help, labels=(), buckets=SECONDS):
+        """
+        Declares a histogram with the given label names, values are then
+        observed with observe() along with the value of each label
+        """
+
+        self._families[name] = (help, labels, buckets, {})
+
+    def observe(self, name, value, *labels):
+        help, names, buckets, metrics = self._families[name]
+        with self._lock:
+            metric = metrics.get(labels)
+            if metric is None:
+                metric = metrics[labels] = Histogram(buckets)
+            metric.observe(value)
+
+    def collector(self, func):
+        """
+        Registers a callable returning (name, type, help, [(labels, value)])
+        tuples, called on every export
+        """
+
+        self._collectors.append(func)
+        return func
+
+    def export(self):
+        """
+        Returns all the metrics in the Prometheus text exposition format
+        """
+
+        lines = []
+        with self._lock:
+            for name, (help, names, buckets, metrics) in sorted(
+                self._families.items()
+            ):
+                lines.append('# HELP {0} {1}'.format(name, help))
+                lines.append('# TYPE {0} histogram'.format(name))
+                for values, metric in sorted(metrics.items()):
+                    labels = tuple(zip(names, values))
+                    for sample in metric.samples(name, labels):
+                        lines.append(_sample(*sample))
+        for func in self._collectors:
+            for name, kind, help, values in func():
+                lines.append('# HELP {0} {1}'.format(name, help))
+                lines.append('# TYPE {0} {1}'.format(name, kind))
+                for labels, value in values:
+                    lines.append(
+                        _sample(name, tuple(sorted(labels.items())), value)
+                    )
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace(
+        '"', '\\"'
+    )
+
+
+def _sample(name, labels, value):
+    if labels:
+        name = '{0}{{{1}}}'.format(name, ','.join(
+            '{0}="{1}"'.format(k, _escape(v)) for k, v in labels
+        ))
+    return '{0} {1}'.format(name, repr(float(value)))
+
+
+ROUTE_LABELS = ('route', 'method', 'status')
+
+registry = Registry()
+registry.histogram(
+    'pasttle_request_seconds', 'Time spent handling requests, by route',
+    ROUTE_LABELS,
+)
+registry.histogram(
+    'pasttle_response_bytes', 'Size of the response bodies, by route',
+    ROUTE_LABELS, BYTES,
+)
+registry.histogram(
+    'pasttle_stage_seconds',
+    'Time spent in each stage of a request (db, lexer_guess, highlight, '
+    'diff, template)', ('stage',),
+)
+
+
+class Stage(object):
+    """
+    Times the enclosed block into the given stage, if metrics are enabled
+    """
+
+    __slots__ = ('name', 'started')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if registry.enabled:
+            registry.observe(
+                'pasttle_stage_seconds', time.perf_counter() - self.started,
+                self.name,
+            )
+
+
+def stage(name):
+    return Stage(name)
+
+
+def _body_size(body):
+    if isinstance(body, (bytes, str)):
+        return len(body)
+    length = bottle.response.content_length
+    return length if length >= 0 else None
+
+
+class MetricsPlugin(object):
+    """
+    Bottle plugin recording the latency and response size of every request
+    by route, method and status code, and the lexer guessing time of new
+    pastes. Streamed responses are timed until the handler returns
+    """
+
+    name = 'metrics'
+    api = 2
+
+    def apply(self, callback, route):
+        rule = route.rule
+
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            status = 500
+            body = None
+            try:
+                rv = callback(*args, **kwargs)
+                if isinstance(rv, bottle.HTTPResponse):
+                    status, body = rv.status_code, rv.body
+                else:
+                    status, body = bottle.response.status_code, rv
+                return rv
+            except bottle.HTTPResponse as ex:
+                status, body = ex.status_code, ex.body
+                raise
+            finally:
+                environ = bottle.request.environ
+                labels = (rule, environ['REQUEST_METHOD'], status)
+                registry.observe(
+                    'pasttle_request_seconds',
+                    time.perf_counter() - started, *labels
+                )
+                size = _body_size(body)
+                if size is not None:
+                    registry.observe('pasttle_response_bytes', size, *labels)
+                guess = environ.get('pasttle.guess_time')
+                if guess is not None:
+                    registry.observe(
+                        'pasttle_stage_seconds', guess, 'lexer_guess'
+                    )
+
+        return wrapper
+
+
+def time_queries(engine):
+    """
+    Times every statement run on the given engine into the db stage
+    """
+
+    @sqlalchemy.event.listens_for(engine, 'before_cursor_execute')
+    def _started(conn, cursor, statement, parameters, context, many):
+        conn.info.setdefault('pasttle.query_started', []).append(
+            time.perf_counter()
+        )
+
+    @sqlalchemy.event.listens_for(engine, 'after_cursor_execute')
+    def _finished(conn, cursor, statement, parameters, context, many):
+        started = conn.info['pasttle.query_started'].pop()
+        registry.observe(
+            'pasttle_stage_seconds', time.perf_counter() - started, 'db'
+        )
@@ -1,8 +1,17 @@
+import codecs
+import collections
+import datetime
 import hashlib
+import io
+import ipaddress
 import os
+import re
+import zlib
 
 import sqlalchemy
+import sqlalchemy.event
 import sqlalchemy.ext.declarative as declarative
+import sqlalchemy.orm as orm
 
 import pasttle.util as util
 
@@ -11,15 +20,337 @@ import pasttle.util as util
 Base = declarative.declarative_base()
 
 
+def digest(content):
+    """
+    Returns the hex SHA-256 of the given content, used to validate cached
+    copies of a paste
+    """
+
+    if not isinstance(content, bytes):
+        content = content.encode()
+    return hashlib.sha256(content).hexdigest()
+
+
+# Compression codecs for stored content, mapped to the zlib window bits that
+# produce (and read) their framing: gzip framing can be passed through as-is
+# to clients that accept a gzip content-coding, plain zlib as deflate
+CODECS = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'zlib': zlib.MAX_WBITS,
+}
+
+
+# Stored content is read, hashed and compressed this many bytes at a time
+CHUNK_SIZE = 65536
+
+# Blobs are streamed out of the database this many bytes per connection
+READ_BATCH_SIZE = 16 * CHUNK_SIZE
+
+# Content ready to be stored: its digest, the codec it ended up compressed
+# with (if any), the stored bytes, the size of the uncompressed text and how
+# many lines it has
+Encoded = collections.namedtuple(
+    'Encoded', ['digest', 'codec', 'data', 'size', 'lines']
+)
+
+
+def pack_ip(address):
+    """
+    Returns the given IP address (text) packed into 4 or 16 bytes, the way
+    it is stored. IPv4 addresses mapped into IPv6 are stored as IPv4. Raises
+    ValueError if it is not a valid address
+    """
+
+    ip = ipaddress.ip_address(address)
+    mapped = getattr(ip, 'ipv4_mapped', None)
+    return (mapped or ip).packed
+
+
+def _is_legacy_ip(value):
+    # Previous versions stored the address as its ASCII binary digits
+    # (b'0b1111111000...'), which is never 4 or 16 bytes long for a
+    # non-trivial address
+    return value[:2] == b'0b' and len(value) not in (4, 16) and \
+        not value[2:].strip(b'01')
+
+
+def unpack_ip(value):
+    """
+    Returns the stored IP address as an ipaddress object, or None
+    """
+
+    if not value:
+        return None
+    if _is_legacy_ip(value):
+        return ipaddress.ip_address(int(value, 2))
+    return ipaddress.ip_address(bytes(value))
+
+
+def storage_codec():
+    """
+    Returns the codec new content gets compressed with, per pasttle.ini
+    """
+
+    codec = util.conf.get(util.cfg_section, 'compression')
+    return codec if codec in CODECS else None
+
+
+def encode_stream(stream, codec=None):
+    """
+    Encodes the UTF-8 text read from the given (seekable) binary file object
+    for storage, hashing and compressing it a chunk at a time so it never
+    needs to be fully decoded in memory. Content that does not get smaller
+    when compressed is stored uncompressed. Raises UnicodeDecodeError if the
+    content is not UTF-8 text
+    """
+
+    start = stream.tell()
+    hasher = hashlib.sha256()
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    compressor = None
+    if codec:
+        compressor = zlib.compressobj(
+            zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, CODECS[codec]
+        )
+    chunks = []
+    size = 0
+    lines = 0
+    last = b'\n'
+    chunk = stream.read(CHUNK_SIZE)
+    while chunk:
+        decoder.decode(chunk)
+        hasher.update(chunk)
+        size += len(chunk)
+        lines += chunk.count(b'\n')
+        last = chunk[-1:]
+        chunks.append(compressor.compress(chunk) if compressor else chunk)
+        chunk = stream.read(CHUNK_SIZE)
+    decoder.decode(b'', True)
+    # The last line may not end with a newline
+    if last != b'\n':
+        lines += 1
+    if compressor:
+        chunks.append(compressor.flush())
+        data = b''.join(chunks)
+        if len(data) < size:
+            return Encoded(hasher.hexdigest(), codec, data, size, lines)
+        stream.seek(start)
+        return Encoded(
+            hasher.hexdigest(), None, stream.read(), size, lines
+        )
+    return Encoded(hasher.hexdigest(), None, b''.join(chunks), size, lines)
+
+
+def encode(content, codec=None):
+    """
+    Encodes the given text for storage, see encode_stream()
+    """
+
+    return encode_stream(io.BytesIO(content.encode()), codec)
+
+
+def decode(data, codec=None):
+    """
+    Decodes stored data back into text
+    """
+
+    if codec:
+        data = zlib.decompress(data, CODECS[codec])
+    return data.decode()
+
+
+def read_blob(digest, chunk_size=CHUNK_SIZE, codec=None):
+    """
+    Yields the stored bytes of the given blob a chunk at a time (decompressed
+    with the given codec, if any) straight from the database. At most
+    READ_BATCH_SIZE bytes are read per connection, which is given back before
+    they are yielded, so a slow download holds neither a connection nor a
+    read transaction (that would keep WAL checkpoints from completing)
+    """
+
+    decompressor = zlib.decompressobj(CODECS[codec]) if codec else None
+    offset = 0
+    while True:
+        batch = _read_batch(digest, offset, chunk_size)
+        for chunk in batch:
+            offset += len(chunk)
+            if decompressor:
+                chunk = decompressor.decompress(chunk)
+            if chunk:
+                yield chunk
+        if sum(len(_) for _ in batch) < READ_BATCH_SIZE:
+            break
+    if decompressor:
+        chunk = decompressor.flush()
+        if chunk:
+            yield chunk
+
+
+def _read_batch(digest, offset, chunk_size):
+    """
+    Reads up to READ_BATCH_SIZE bytes of the given blob from the given
+    offset, in chunks. SQLite's incremental blob I/O is used when the driver
+    supports it, other backends are read in substr() slices
+    """
+
+    with engine.connect() as conn:
+        dbapi = conn.connection.dbapi_connection
+        if not hasattr(dbapi, 'blobopen'):
+            return list(_read_slices(conn, digest, offset, chunk_size))
+        rowid = conn.execute(
+            sqlalchemy.select(sqlalchemy.literal_column('rowid'))
+            .select_from(Blob).where(Blob.digest == digest)
+        ).scalar()
+        if rowid is None:
+            return []
+        chunks = []
+        left = READ_BATCH_SIZE
+        handle = dbapi.blobopen('blob', 'data', rowid, readonly=True)
+        try:
+            handle.seek(offset)
+            while left > 0:
+                chunk = handle.read(min(chunk_size, left))
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                left -= len(chunk)
+        finally:
+            handle.close()
+        return chunks
+
+
+def _read_slices(conn, digest, offset, chunk_size):
+    end = offset + READ_BATCH_SIZE
+    while offset < end:
+        chunk = conn.execute(
+            sqlalchemy.select(
+                sqlalchemy.func.substr(
+                    Blob.data, offset + 1, min(chunk_size, end - offset)
+                )
+            ).where(Blob.digest == digest)
+        ).scalar()
+        if not chunk:
+            return
+        yield chunk
+        offset += len(chunk)
+
+
+class Blob(Base):
+    """
+    Paste content, stored once per distinct body and shared (by SHA-256
+    digest) between all the pastes with the same content
+    """
+
+    __tablename__ = 'blob'
+
+    digest = sqlalchemy.Column(sqlalchemy.String(64), primary_key=True)
+    # Encoded content, the codec it is compressed with (if any) is recorded
+    # for every row so the compression setting can change at any time
+    data = orm.deferred(
+        sqlalchemy.Column(sqlalchemy.LargeBinary, nullable=False)
+    )
+    codec = sqlalchemy.Column(sqlalchemy.String(16))
+    size = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+    # Unknown for blobs stored by previous versions until they are counted
+    lines = sqlalchemy.Column(sqlalchemy.Integer)
+    refcount = sqlalchemy.Column(sqlalchemy.Integer, nullable=False)
+    # Lexer that took too long to highlight this content, it is shown as
+    # plain text instead of being highlighted with it again
+    slow_lexer = sqlalchemy.Column(sqlalchemy.String(64))
+
+    def __init__(self, encoded, refcount=1):
+        self.digest = encoded.digest
+        self.codec = encoded.codec
+        self.data = encoded.data
+        self.size = encoded.size
+        self.lines = encoded.lines
+        self.refcount = refcount
+
+    @property
+    def content(self):
+        return decode(self.data, self.codec)
+
+    def iter_data(self, chunk_size=CHUNK_SIZE):
+        """
+        Returns an iterator over the stored (possibly compressed) bytes,
+        see read_blob()
+        """
+
+        return read_blob(self.digest, chunk_size)
+
+    def iter_content(self, chunk_size=CHUNK_SIZE):
+        """
+        Returns an iterator over the UTF-8 bytes of the content, decompressed
+        on the fly, see read_blob()
+        """
+
+        return read_blob(self.digest, chunk_size, self.codec)
+
+    @classmethod
+    def intern(cls, session, contents):
+        """
+        Takes a list of encoded contents and returns a {digest: blob} map,
+        re-using (and adding a reference to) the blobs already stored and
+        creating the missing ones
+        """
+
+        refs = {}
+        for encoded in contents:
+            refs.setdefault(encoded.digest, [encoded, 0])[1] += 1
+        blobs = {}
+        with session.no_autoflush:
+            for blob in session.query(cls).filter(cls.digest.in_(refs)):
+                # Increment in SQL so concurrent writers don't lose counts
+                blob.refcount = cls.refcount + refs[blob.digest][1]
+                blobs[blob.digest] = blob
+        for key, (encoded, count) in refs.items():
+            if key not in blobs:
+                blobs[key] = cls(encoded, count)
+                session.add(blobs[key])
+        return blobs
+
+    @classmethod
+    def release(cls, session, keys):
+        """
+        Drops a reference to each of the given blobs, deleting the ones no
+        paste refers to anymore
+        """
+
+        for key in keys:
+            session.execute(
+                sqlalchemy.update(cls).where(cls.digest == key).values(
+                    refcount=cls.refcount - 1
+                )
+            )
+        session.execute(
+            sqlalchemy.delete(cls).where(
+                cls.digest.in_(keys), cls.refcount <= 0
+            )
+        )
+
+    def __repr__(self):
+        return u'<Blob {0} ({1} bytes, {2} refs)>'.format(
+            self.digest, self.size, self.refcount)
+
+
 class Paste(Base):
     """
     Main paste sqlalchemy construct for database storage
     """
 
     __tablename__ = 'paste'
+    # Ids of deleted (e.g. expired) pastes are never handed out again, links
+    # to them and anything cached by id must not show a different paste
+    __table_args__ = dict(sqlite_autoincrement=True)
 
     id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
-    content = sqlalchemy.Column(sqlalchemy.Text, nullable=False)
+    # Only pastes stored before the blob table existed have their content
+    # inline, it is empty for the rest. Deferred so metadata-only requests
+    # (e.g. a 304) never load the body
+    inline_content = orm.deferred(
+        sqlalchemy.Column('content', sqlalchemy.Text, nullable=False)
+    )
+    digest = sqlalchemy.Column(sqlalchemy.String(64), index=True)
     filename = sqlalchemy.Column(sqlalchemy.String(128))
     password = sqlalchemy.Column(sqlalchemy.String(40))
     mimetype = sqlalchemy.Column(sqlalchemy.String(64), nullable=False)
@@ -27,16 +358,31 @@ class Paste(Base):
     created = sqlalchemy.Column(
         sqlalchemy.DateTime, default=sqlalchemy.func.now(), nullable=False
     )
-    ip = sqlalchemy.Column(sqlalchemy.LargeBinary(16))
+    # Packed 4 (IPv4) or 16 (IPv6) bytes, see pack_ip()
+    ip = sqlalchemy.Column(sqlalchemy.LargeBinary(16), index=True)
     parent = sqlalchemy.Column(sqlalchemy.Integer)
+    # When the paste expires (UTC), never if empty
+    expires = sqlalchemy.Column(sqlalchemy.DateTime, index=True)
+    # Blobs are explicitly added by Blob.intern() when flushing, so a retried
+    # insert never re-adds a blob that lost an insert race
+    blob = orm.relationship(
+        Blob, primaryjoin='foreign(Paste.digest) == Blob.digest', cascade=''
+    )
+    rendered = orm.relationship(
+        'Rendered', uselist=False, cascade='all, delete-orphan'
+    )
 
     def __init__(
         self, content, mimetype, filename=None,
         password=None, is_encrypted=True, ip=None,
-        lexer=None, parent=None
+        lexer=None, parent=None, expires=None
     ):
 
-        self.content = content
+        # The blob holding the content is looked up (or created) on flush
+        if not isinstance(content, Encoded):
+            content = encode(content, storage_codec())
+        self.new_content = content
+        self.inline_content = u''
         self.mimetype = mimetype
         if filename and filename.strip():
             self.filename = os.path.basename(filename).strip()[:128]
@@ -45,19 +391,308 @@ class Paste(Base):
                 self.password = password[:40]
             else:
                 self.password = hashlib.sha1(password.encode()).hexdigest()
-        self.ip = ip.encode() if ip else None
+        self.ip = ip or None
         self.lexer = lexer
         self.parent = parent
+        self.expires = expires
+
+    def is_expired(self, now=None):
+        return self.expires is not None and \
+            self.expires <= (now or datetime.datetime.utcnow())
+
+    @property
+    def source_ip(self):
+        """
+        The address this paste was sent from, if known
+        """
+
+        return unpack_ip(self.ip)
+
+    @property
+    def content(self):
+        new_content = getattr(self, 'new_content', None)
+        if new_content is not None:
+            return decode(new_content.data, new_content.codec)
+        if self.digest and self.blob is not None:
+            return self.blob.content
+        return self.inline_content
+
+    def get_digest(self):
+        """
+        Returns the content digest, rows created before the blob table
+        existed get it computed from their inline content until they are
+        moved into blobs by migrate_contents()
+        """
+
+        if not self.digest:
+            if getattr(self, 'inline_digest', None) is None:
+                self.inline_digest = digest(self.inline_content)
+            return self.inline_digest
+        return self.digest
 
     def __repr__(self):
         return u'<Paste {0} ({1}), protected={2}>'.format(
             self.filename, self.lexer or self.mimetype, bool(self.password))
 
 
+@sqlalchemy.event.listens_for(orm.Session, 'before_flush')
+def _reference_blobs(session, context, instances):
+    """
+    Points new pastes to the blob holding their content and drops the blob
+    references of deleted ones
+    """
+
+    new = [
+        _ for _ in session.new
+        if isinstance(_, Paste) and getattr(_, 'new_content', None)
+    ]
+    if new:
+        blobs = Blob.intern(session, [_.new_content for _ in new])
+        for paste in new:
+            paste.blob = blobs[paste.new_content.digest]
+    released = [
+        _.digest for _ in session.deleted
+        if isinstance(_, Paste) and _.digest
+    ]
+    if released:
+        Blob.release(session, released)
+
+
+class Rendered(Base):
+    """
+    Highlighted HTML for a paste, rendered in the background right after
+    it was inserted
+    """
+
+    __tablename__ = 'rendered'
+
+    paste_id = sqlalchemy.Column(
+        sqlalchemy.Integer, sqlalchemy.ForeignKey('paste.id'),
+        primary_key=True
+    )
+    lexer = sqlalchemy.Column(sqlalchemy.String(64), nullable=False)
+    html = orm.deferred(
+        sqlalchemy.Column(sqlalchemy.LargeBinary, nullable=False)
+    )
+
+    def __repr__(self):
+        return u'<Rendered #{0} ({1})>'.format(self.paste_id, self.lexer)
+
+
+# Pragmas applied to every new SQLite connection, see pasttle.ini
+SQLITE_PRAGMAS = (
+    'journal_mode', 'synchronous', 'mmap_size', 'cache_size', 'busy_timeout',
+)
+
+
+def sqlite_pragmas():
+    """
+    Returns the {pragma: value} map configured in pasttle.ini, pragmas left
+    empty keep the SQLite defaults
+    """
+
+    pragmas = {}
+    for name in SQLITE_PRAGMAS:
+        value = util.conf.get(util.cfg_section, 'sqlite_{0}'.format(name))
+        if value.strip():
+            pragmas[name] = value.strip()
+    return pragmas
+
+
+def use_pragmas(engine, pragmas):
+    """
+    Sets the given pragmas on every new connection of the given engine, if
+    it is an SQLite one
+    """
+
+    if engine.url.get_backend_name() != 'sqlite' or not pragmas:
+        return
+    for name, value in pragmas.items():
+        if not re.match(r'^-?\w+$', value):
+            raise ValueError(
+                'Invalid value for pragma {0}: {1!r}'.format(name, value)
+            )
+
+    @sqlalchemy.event.listens_for(engine, 'connect')
+    def _set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in pragmas.items():
+                cursor.execute('PRAGMA {0} = {1}'.format(name, value))
+        finally:
+            cursor.close()
+
+
 engine = sqlalchemy.create_engine(
     util.conf.get(util.cfg_section, 'dsn'), echo=util.is_debug,
     convert_unicode=True, logging_name='pasttle.db', echo_pool=util.is_debug,
     pool_recycle=util.pool_recycle
 )
-# Create all metadata on loading, if something blows we need to know asap
-Base.metadata.create_all(engine)
+use_pragmas(engine, sqlite_pragmas())
+
+
+def is_memory_db():
+    """
+    Tells whether the engine points to an in-memory SQLite database, which
+    is private to each thread and can't be used by background workers
+    """
+
+    return engine.url.get_backend_name() == 'sqlite' and \
+        engine.url.database in (None, '', ':memory:')
+
+
+def create_schema(bind=None):
+    """
+    Creates the tables missing from the database, and the (nullable)
+    columns and indexes added to existing tables by newer versions. SQLite
+    tables created without the AUTOINCREMENT ids they now have are rebuilt
+    with them. This is done once when the server starts, or with ``python
+    -m pasttle.model`` (which also migrates the rows stored by previous
+    versions) when served by a separate WSGI server
+    """
+
+    engine = bind or globals()['engine']
+    Base.metadata.create_all(engine)
+    inspector = sqlalchemy.inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing = set(_['name'] for _ in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name in existing or not column.nullable:
+                continue
+            util.log.info('Adding {0}.{1}'.format(table.name, column.name,))
+            with engine.begin() as conn:
+                conn.execute(sqlalchemy.text(
+                    'ALTER TABLE {0} ADD COLUMN {1} {2}'.format(
+                        table.name, column.name,
+                        column.type.compile(dialect=engine.dialect),
+                    )
+                ))
+        # Indexes added by newer versions, on new columns or not
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+    if engine.url.get_backend_name() == 'sqlite':
+        for table in Base.metadata.sorted_tables:
+            if table.dialect_options['sqlite']['autoincrement']:
+                _autoincrement(engine, table)
+
+
+def _autoincrement(engine, table):
+    """
+    Rebuilds the given SQLite table with AUTOINCREMENT ids, unless it has
+    them already. Without them, the highest id is handed out again once its
+    row is deleted
+    """
+
+    with engine.begin() as conn:
+        sql = conn.execute(sqlalchemy.text(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND "
+            "name = :name"
+        ), dict(name=table.name)).scalar()
+        if not sql or 'AUTOINCREMENT' in sql.upper():
+            return
+        util.log.info('Rebuilding {0} with AUTOINCREMENT ids'.format(
+            table.name,
+        ))
+        rebuilt = table.to_metadata(
+            sqlalchemy.MetaData(), name='{0}_rebuilt'.format(table.name),
+        )
+        conn.execute(sqlalchemy.schema.CreateTable(rebuilt))
+        columns = ', '.join([_.name for _ in table.columns])
+        conn.execute(sqlalchemy.text(
+            'INSERT INTO {0} ({1}) SELECT {1} FROM {2}'.format(
+                rebuilt.name, columns, table.name,
+            )
+        ))
+        conn.execute(sqlalchemy.text('DROP TABLE {0}'.format(table.name)))
+        conn.execute(sqlalchemy.text('ALTER TABLE {0} RENAME TO {1}'.format(
+            rebuilt.name, table.name,
+        )))
+        for index in table.indexes:
+            index.create(conn)
+
+
+def migrate_ips(batch=1000):
+    """
+    Packs the source addresses stored by previous versions and indexes
+    them, a batch of rows per transaction so the table is never locked for
+    long. Returns how many rows were rewritten
+    """
+
+    table = Paste.__table__
+    for index in table.indexes:
+        index.create(engine, checkfirst=True)
+    update = table.update().where(
+        table.c.id == sqlalchemy.bindparam('row_id')
+    ).values(ip=sqlalchemy.bindparam('packed'))
+    done, last = 0, 0
+    while True:
+        with engine.begin() as conn:
+            # Read as-is, older versions may have stored text
+            rows = conn.execute(
+                sqlalchemy.select([
+                    table.c.id,
+                    sqlalchemy.type_coerce(table.c.ip, sqlalchemy.String),
+                ]).where(
+                    table.c.id > last
+                ).where(table.c.ip.isnot(None)).order_by(
+                    table.c.id
+                ).limit(batch)
+            ).fetchall()
+            if not rows:
+                return done
+            last = rows[-1][0]
+            legacy = []
+            for id, ip in rows:
+                ip = ip.encode() if isinstance(ip, str) else bytes(ip)
+                if _is_legacy_ip(ip):
+                    legacy.append(dict(row_id=id, packed=unpack_ip(ip).packed))
+            if legacy:
+                conn.execute(update, legacy)
+                done += len(legacy)
+        util.log.debug('Packed {0} addresses up to paste #{1}'.format(
+            done, last,
+        ))
+
+
+def migrate_contents(batch=100):
+    """
+    Moves the content stored inline by versions before the blob table into
+    (shared) blobs, a batch of pastes per transaction, so their digest is
+    known without loading and hashing their content. Returns how many
+    pastes were moved
+    """
+
+    session = orm.Session(bind=engine)
+    done, last = 0, 0
+    try:
+        while True:
+            pastes = session.query(Paste).filter(
+                Paste.id > last,
+                sqlalchemy.or_(Paste.digest.is_(None), Paste.digest == ''),
+            ).order_by(Paste.id).limit(batch).all()
+            if not pastes:
+                return done
+            last = pastes[-1].id
+            encoded = [
+                encode(_.inline_content, storage_codec()) for _ in pastes
+            ]
+            blobs = Blob.intern(session, encoded)
+            for paste, content in zip(pastes, encoded):
+                paste.blob = blobs[content.digest]
+                paste.inline_content = u''
+            session.commit()
+            done += len(pastes)
+            util.log.debug('Moved the content of {0} pastes up to #{1}'.format(
+                done, last,
+            ))
+    finally:
+        session.close()
+
+
+if __name__ == '__main__':
+    create_schema()
+    util.log.info('Created the schema on {0!r}'.format(engine.url,))
+    util.log.info('Packed {0} source addresses'.format(migrate_ips(),))
+    util.log.info('Moved the content of {0} pastes into blobs'.format(
+        migrate_contents(),
+    ))
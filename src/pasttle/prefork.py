@@ -0,0 +1,173 @@
+import errno
+import os
+import signal
+import socket
+import time
+import wsgiref.simple_server as simple_server
+
+import pasttle.lexing as lexing
+import pasttle.util as util
+import pasttle.model as model
+
+
+class ReusePortServer(simple_server.WSGIServer):
+    """
+    WSGI server whose listening socket can be bound by several processes at
+    once, the kernel then spreads the incoming connections between them
+    """
+
+    allow_reuse_address = True
+
+    def server_bind(self):
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        simple_server.WSGIServer.server_bind(self)
+
+
+class QuietHandler(simple_server.WSGIRequestHandler):
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class Prefork(object):
+    """
+    Serves the given WSGI application from a number of forked worker
+    processes, each accepting connections on its own SO_REUSEPORT socket
+    bound to the same address (or on a socket inherited from the parent
+    where SO_REUSEPORT is not available). Workers that die are replaced
+    """
+
+    # Workers dying sooner than this after being started are replaced with
+    # a delay, so a broken setup doesn't turn into a fork loop
+    MIN_UPTIME = 1.0
+
+    def __init__(self, app, host, port, workers, quiet=False):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.handler = QuietHandler if quiet else \
+            simple_server.WSGIRequestHandler
+        self.children = {}
+        self.listener = None
+        self.stopping = False
+
+    def warm_up(self):
+        """
+        Loads everything the workers are going to need before forking, so
+        they share it copy-on-write instead of each loading its own copy
+        """
+
+        lexing.registry().classes()
+        # Don't hand any open database connection down to the workers
+        model.engine.dispose()
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            util.log.warn('No SO_REUSEPORT, workers share a single socket')
+            self.listener = self._make_server(simple_server.WSGIServer)
+
+    def _make_server(self, server_class):
+        return simple_server.make_server(
+            self.host, self.port, self.app, server_class=server_class,
+            handler_class=self.handler,
+        )
+
+    def _serve(self):
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        # Replace the pool inherited from the parent without touching its
+        # connections, each worker opens its own
+        model.engine.dispose(close=False)
+        httpd = self.listener or self._make_server(ReusePortServer)
+        httpd.serve_forever()
+
+    def spawn(self):
+        """
+        Forks a new worker
+        """
+
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                self._serve()
+            except BaseException as ex:
+                util.log.error('Worker {0} failed: {1}'.format(
+                    os.getpid(), ex,
+                ))
+                status = 1
+            finally:
+                os._exit(status)
+        self.children[pid] = time.monotonic()
+        util.log.info('Started worker {0}'.format(pid,))
+        return pid
+
+    def reap(self):
+        """
+        Waits for a worker to exit and replaces it unless stopping. Returns
+        the pid of the worker that exited
+        """
+
+        try:
+            pid, status = os.wait()
+        except OSError as ex:
+            if ex.errno == errno.ECHILD:
+                self.children.clear()
+                return None
+            raise
+        started = self.children.pop(pid, None)
+        if started is None or self.stopping:
+            return pid
+        util.log.warn('Worker {0} exited with status {1}, restarting'.format(
+            pid, status,
+        ))
+        if time.monotonic() - started < self.MIN_UPTIME:
+            time.sleep(self.MIN_UPTIME)
+        self.spawn()
+        return pid
+
+    def stop(self):
+        """
+        Terminates all the workers and waits for them
+        """
+
+        self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                self.children.pop(pid, None)
+        while self.children:
+            self.reap()
+
+    def run(self):
+        """
+        Starts the workers and keeps them running until SIGTERM or SIGINT
+        """
+
+        self.warm_up()
+        for _ in range(self.workers):
+            self.spawn()
+        util.log.info('Serving on http://{0}:{1}/ with {2} workers'.format(
+            self.host, self.port, self.workers,
+        ))
+        signal.signal(signal.SIGTERM, self._interrupt)
+        signal.signal(signal.SIGINT, self._interrupt)
+        try:
+            while self.children and not self.stopping:
+                self.reap()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def _interrupt(self, signum, frame):
+        raise KeyboardInterrupt()
+
+
+def worker_count():
+    """
+    Returns the number of workers from pasttle.ini, 0 means one per CPU
+    """
+
+    workers = util.conf.getint(util.cfg_section, 'workers')
+    return workers if workers > 0 else (os.cpu_count() or 1)
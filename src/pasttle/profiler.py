@@ -0,0 +1,252 @@
+import cProfile
+import collections
+import datetime
+import hmac
+import itertools
+import json
+import os
+import random
+import sys
+import threading
+import time
+import types
+
+import bottle
+
+import pasttle.util as util
+
+
+# WSGI name of the header asking for a request to be profiled
+HEADER = 'HTTP_X_PASTTLE_PROFILE'
+
+
+class Capture(object):
+    """
+    Profiling state of a single request: its cProfile profile (when it was
+    picked beforehand) and the stacks sampled while it was running
+    """
+
+    __slots__ = ('reason', 'profile', 'stacks', 'started', 'size', 'status')
+
+    def __init__(self, reason, profile):
+        self.reason = reason
+        self.profile = profile
+        self.stacks = collections.Counter()
+        self.started = time.perf_counter()
+        self.size = 0
+        self.status = 500
+
+
+class ProfilerPlugin(object):
+    """
+    Bottle plugin profiling requests into a spool directory. A ``rate``
+    fraction of the requests, and the ones sending the ``token`` in the
+    ``X-Pasttle-Profile`` header, are profiled with cProfile (one at a time
+    per process). When ``slow`` is set every request has its stacks sampled
+    every ``interval`` seconds, and those taking longer than ``slow`` seconds
+    are written out as folded stacks. Only the newest ``keep`` profiles are
+    kept. Streamed responses are profiled until their last chunk is sent
+    """
+
+    name = 'profiler'
+    api = 2
+
+    def __init__(
+        self, spool, rate=0.0, slow=0.0, token='', keep=100, interval=0.01,
+    ):
+        self.spool = spool
+        self.rate = rate
+        self.slow = slow
+        self.token = token
+        self.keep = keep
+        self.interval = interval
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._profiling = threading.Lock()
+        self._active = {}
+        self._busy = threading.Event()
+        self._thread = None
+        self._pid = None
+        os.makedirs(spool, exist_ok=True)
+
+    def apply(self, callback, route):
+        rule = route.rule
+
+        def wrapper(*args, **kwargs):
+            environ = bottle.request.environ
+            reason = self._wanted(environ)
+            if reason is None and not self.slow:
+                return callback(*args, **kwargs)
+            capture = self._begin(reason)
+            about = (environ, rule, kwargs)
+            try:
+                rv = self._run(capture, callback, *args, **kwargs)
+            except bottle.HTTPResponse as ex:
+                capture.status = ex.status_code
+                self._finish(capture, ex.body, *about)
+                raise
+            except Exception:
+                self._finish(capture, None, *about)
+                raise
+            if isinstance(rv, bottle.HTTPResponse):
+                capture.status = rv.status_code
+                self._finish(capture, rv.body, *about)
+                return rv
+            capture.status = bottle.response.status_code
+            if isinstance(rv, types.GeneratorType):
+                return self._iterate(capture, rv, *about)
+            self._finish(capture, rv, *about)
+            return rv
+
+        return wrapper
+
+    def _wanted(self, environ):
+        given = environ.get(HEADER)
+        if self.token and given and hmac.compare_digest(
+            given.encode(), self.token.encode()
+        ):
+            return 'header'
+        if self.rate and random.random() < self.rate:
+            return 'sampled'
+        return None
+
+    def _begin(self, reason):
+        profile = None
+        if reason is not None and self._profiling.acquire(blocking=False):
+            profile = cProfile.Profile()
+        if self.slow:
+            self._start()
+        return Capture(reason, profile)
+
+    def _start(self):
+        # The sampler thread is started on first use, so a forked worker
+        # gets its own
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(
+                    target=self._sample, name='pasttle-profiler', daemon=True
+                )
+                self._thread.start()
+
+    def _run(self, capture, func, *args, **kwargs):
+        # Requests are only accounted for while running in their thread,
+        # streamed ones may share it with others in between chunks
+        ident = threading.get_ident()
+        if self.slow:
+            with self._lock:
+                self._active[ident] = capture
+                self._busy.set()
+        if capture.profile is not None:
+            capture.profile.enable()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            if capture.profile is not None:
+                capture.profile.disable()
+            if self.slow:
+                with self._lock:
+                    self._active.pop(ident, None)
+
+    def _iterate(self, capture, chunks, *about):
+        try:
+            while True:
+                try:
+                    chunk = self._run(capture, next, chunks)
+                except StopIteration:
+                    break
+                capture.size += len(chunk)
+                yield chunk
+        finally:
+            chunks.close()
+            self._finish(capture, None, *about)
+
+    def _sample(self):
+        while True:
+            with self._lock:
+                if not self._active:
+                    self._busy.clear()
+            self._busy.wait()
+            time.sleep(self.interval)
+            with self._lock:
+                active = list(self._active.items())
+            frames = sys._current_frames()
+            stacks = []
+            for ident, capture in active:
+                frame, stack = frames.get(ident), []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(
+                        '{0}:{1}'.format(code.co_filename, code.co_name)
+                    )
+                    frame = frame.f_back
+                stacks.append((ident, capture, ';'.join(reversed(stack))))
+            del frames
+            with self._lock:
+                for ident, capture, stack in stacks:
+                    if stack and self._active.get(ident) is capture:
+                        capture.stacks[stack] += 1
+
+    def _finish(self, capture, body, environ, rule, url_args):
+        elapsed = time.perf_counter() - capture.started
+        if capture.profile is not None:
+            self._profiling.release()
+        if isinstance(body, (bytes, str)):
+            capture.size = len(body)
+        reasons = [capture.reason] if capture.reason else []
+        if self.slow and elapsed >= self.slow:
+            reasons.append('slow')
+        if not reasons:
+            return
+        about = dict(
+            reasons=reasons,
+            route=rule,
+            method=environ.get('REQUEST_METHOD'),
+            path=environ.get('PATH_INFO'),
+            paste=url_args.get('id'),
+            lexer=environ.get('pasttle.lexer'),
+            request_bytes=int(environ.get('CONTENT_LENGTH') or 0),
+            response_bytes=capture.size,
+            status=capture.status,
+            seconds=elapsed,
+            pid=os.getpid(),
+        )
+        try:
+            self._write(capture, about)
+        except OSError as ex:
+            util.log.warn('Could not write profile: {0}'.format(ex,))
+
+    def _write(self, capture, about):
+        stem = os.path.join(self.spool, '{0:%Y%m%dT%H%M%S.%f}-{1}-{2}'.format(
+            datetime.datetime.utcnow(), os.getpid(), next(self._seq),
+        ))
+        if capture.profile is not None:
+            capture.profile.dump_stats(stem + '.prof')
+        if capture.stacks:
+            with open(stem + '.folded', 'w') as folded:
+                for stack, count in sorted(capture.stacks.items()):
+                    folded.write('{0} {1}\n'.format(stack, count))
+        # The metadata goes last, profiles are rotated by it
+        with open(stem + '.json', 'w') as meta:
+            json.dump(about, meta, indent=2)
+        util.log.info('Profiled {0} {1} in {2:.3f}s ({3}) to {4}'.format(
+            about['method'], about['path'], about['seconds'],
+            ', '.join(about['reasons']), stem,
+        ))
+        self._rotate()
+
+    def _rotate(self):
+        stems = sorted(
+            _[:-len('.json')] for _ in os.listdir(self.spool)
+            if _.endswith('.json')
+        )
+        for stem in stems[:max(len(stems) - self.keep, 0)]:
+            for ext in ('.json', '.prof', '.folded'):
+                try:
+                    os.remove(os.path.join(self.spool, stem + ext))
+                except FileNotFoundError:
+                    pass
+
+    def __repr__(self):
+        return u'<ProfilerPlugin {0} rate={1} slow={2}>'.format(
+            self.spool, self.rate, self.slow)
@@ -0,0 +1,126 @@
+import datetime
+import os
+import threading
+
+import sqlalchemy
+import sqlalchemy.orm as orm
+
+import pasttle.util as util
+import pasttle.model as model
+
+
+class Reaper(object):
+    """
+    Deletes expired pastes (and drops their references to the blobs holding
+    their content) from a background thread, every ``interval`` seconds.
+    They are deleted ``batch`` at a time, each batch in a short transaction
+    of its own and with a ``pause`` between them, so other writers never
+    wait long for the database. Several processes can reap the same
+    database at the same time
+    """
+
+    def __init__(self, engine, batch=100, pause=0.2, interval=60.0,
+                 on_reap=None):
+        self.engine = engine
+        self.batch = batch
+        self.pause = pause
+        self.interval = interval
+        self.on_reap = on_reap
+        self.session = orm.sessionmaker(bind=engine)
+        self.reaped = 0
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def start(self):
+        """
+        Starts the reaper thread, unless it is already running in this
+        process (a forked worker starts its own)
+        """
+
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._stop.clear()
+                self._thread = threading.Thread(
+                    target=self._run, name='pasttle-reaper', daemon=True
+                )
+                self._thread.start()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.reap()
+            except Exception as ex:
+                util.log.warn('Could not reap expired pastes: {0}'.format(ex,))
+            self._stop.wait(self.interval)
+
+    def reap(self, now=None):
+        """
+        Deletes all the pastes expired by now, returns how many
+        """
+
+        now = now or datetime.datetime.utcnow()
+        total = 0
+        while not self._stop.is_set():
+            deleted = self._reap_batch(now)
+            total += deleted
+            if deleted < self.batch:
+                break
+            self._stop.wait(self.pause)
+        if total:
+            with self._lock:
+                self.reaped += total
+            util.log.info('Reaped {0} expired pastes'.format(total,))
+            if self.on_reap:
+                self.on_reap()
+        return total
+
+    def _reap_batch(self, now):
+        paste = model.Paste.__table__
+        rendered = model.Rendered.__table__
+        session = self.session()
+        try:
+            rows = session.execute(
+                sqlalchemy.select([paste.c.id, paste.c.digest]).where(
+                    paste.c.expires <= now
+                ).order_by(paste.c.expires).limit(self.batch)
+            ).fetchall()
+            released = []
+            for id, digest in rows:
+                session.execute(
+                    rendered.delete().where(rendered.c.paste_id == id)
+                )
+                # Another reaper may have deleted it in the meantime, only
+                # the one that did drops its blob reference
+                deleted = session.execute(
+                    paste.delete().where(paste.c.id == id)
+                ).rowcount
+                if deleted and digest:
+                    released.append(digest)
+            if released:
+                model.Blob.release(session, released)
+            session.commit()
+            return len(rows)
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def close(self):
+        """
+        Stops the reaper thread, after the batch it may be deleting
+        """
+
+        self._stop.set()
+        with self._lock:
+            thread = self._thread
+        if thread is not None and thread.is_alive():
+            thread.join()
+
+    def __repr__(self):
+        return u'<Reaper {0} pastes reaped>'.format(self.reaped)
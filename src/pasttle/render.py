@@ -0,0 +1,332 @@
+import collections
+import concurrent.futures as futures
+import gzip
+import io
+import threading
+
+import sqlalchemy.orm as orm
+
+import pasttle.lexing as lexing
+import pasttle.metrics as metrics
+import pasttle.sandbox as sandbox
+import pasttle.util as util
+import pasttle.model as model
+
+
+def highlight(content, lexer, linenostart=1):
+    """
+    Highlights the given content into the HTML table shown on paste pages
+    """
+
+    # Imported on first use, like the lexers, to keep startup fast
+    import pygments
+    import pygments.formatters as formatters
+
+    with metrics.stage('highlight'):
+        return pygments.highlight(
+            content, lexer, formatters.HtmlFormatter(
+                linenos='table',
+                linenostart=linenostart,
+                encoding='utf-8',
+                lineanchors='ln',
+                anchorlinenos=True,
+            )
+        )
+
+
+def read_window(chunks, first, last, lead=0, count=True):
+    """
+    Reads lines ``first`` to ``last`` (counted from 1, both included) out of
+    the given chunks of UTF-8 bytes, along with up to ``lead`` lines right
+    before them. Returns the lead-in text, the text of the window and how
+    many lines the whole content has, or None if ``count`` is not set, in
+    which case the chunks are only read up to the end of the window
+    """
+
+    start = max(first - lead, 1)
+    # Line the current position of the current chunk is on
+    line = 1
+    parts = []
+    last_byte = b''
+    for chunk in chunks:
+        pos = 0
+        if line < start:
+            newlines = chunk.count(b'\n')
+            if line + newlines < start:
+                line += newlines
+                last_byte = chunk[-1:]
+                continue
+            while line < start:
+                pos = chunk.index(b'\n', pos) + 1
+                line += 1
+        if line <= last:
+            end = pos
+            while line <= last:
+                end = chunk.find(b'\n', end) + 1
+                if not end:
+                    end = len(chunk)
+                    break
+                line += 1
+            parts.append(chunk[pos:end])
+            pos = end
+        if not count and line > last:
+            break
+        line += chunk.count(b'\n', pos)
+        last_byte = chunk[-1:] or last_byte
+    text = b''.join(parts).decode()
+    split = 0
+    for _ in range(first - start):
+        split = text.find('\n', split) + 1
+        if not split:
+            split = len(text)
+            break
+    total = None
+    if count:
+        # The last line may not end with a newline
+        total = line - 1 if last_byte in (b'', b'\n') else line
+    return text[:split], text[split:], total
+
+
+def highlight_window(text, lexer, first, lead=''):
+    """
+    Highlights a window of lines starting at line ``first`` of a paste like
+    highlight(). Pygments lexers can't start from a saved state, so the
+    window is lexed along with the ``lead`` lines before it, to get into the
+    right state for most constructs spanning lines (e.g. comments), and only
+    the tokens of the window are rendered
+    """
+
+    import pygments
+    import pygments.formatters as formatters
+
+    # Leading newlines are never stripped, they are lines of the window
+    lexer = type(lexer)(**dict(lexer.options, stripnl=False, stripall=False))
+    skip = lead.count('\n')
+    with metrics.stage('highlight'):
+        tokens = _after_lines(lexer.get_tokens(lead + text), skip)
+        return pygments.format(tokens, formatters.HtmlFormatter(
+            linenos='table',
+            linenostart=first,
+            encoding='utf-8',
+            lineanchors='ln',
+            anchorlinenos=True,
+        ))
+
+
+def _after_lines(tokens, lines):
+    """
+    Drops the tokens of the given number of first lines
+    """
+
+    for ttype, value in tokens:
+        if lines:
+            newlines = value.count('\n')
+            if newlines < lines:
+                lines -= newlines
+                continue
+            # The rest of this token is on the first line to keep
+            for _ in range(lines):
+                value = value[value.index('\n') + 1:]
+            lines = 0
+            if not value:
+                continue
+        yield ttype, value
+
+
+def run_in(pool, func, text, lexer, *args, **kwargs):
+    """
+    Runs ``func(text, lexer, *args)`` (e.g. highlight()) in one of the
+    worker processes of the given pool, see pasttle.sandbox.ProcessPool.run
+    """
+
+    # Timed here, the metrics of the worker processes are never exported
+    with metrics.stage('highlight'):
+        return pool.run(
+            _rebuilt, func, text, type(lexer), lexer.options, *args,
+            **kwargs
+        )
+
+
+def _rebuilt(func, text, lexer_class, options, *args):
+    # Unpickled lexers miss the token tables their metaclass only builds
+    # when they are instantiated, so they are sent as class and options
+    return func(text, lexer_class(**options), *args)
+
+
+# A pygments style rendered to CSS: the stylesheet, its gzip-compressed copy
+# and a digest of its content to validate cached copies with
+Stylesheet = collections.namedtuple(
+    'Stylesheet', ['css', 'gzipped', 'digest']
+)
+
+
+class Stylesheets(object):
+    """
+    The CSS of every installed pygments style, rendered (and compressed)
+    once the first time any of them is needed and kept in memory, so
+    serving one is a dictionary lookup
+    """
+
+    def __init__(self, selector='.pygmentized', fallback='default'):
+        self.selector = selector
+        self.fallback = fallback
+        self._sheets = None
+        self._lock = threading.Lock()
+
+    def _render(self, style):
+        import pygments.formatters as formatters
+
+        css = formatters.HtmlFormatter(style=style).get_style_defs(
+            [self.selector]
+        ).encode()
+        gzipped = io.BytesIO()
+        # No timestamp, so every process compresses to the same bytes
+        with gzip.GzipFile(fileobj=gzipped, mode='wb', mtime=0) as out:
+            out.write(css)
+        return Stylesheet(css, gzipped.getvalue(), model.digest(css)[:16])
+
+    def load(self):
+        """
+        Renders every installed style, unless it was done already
+        """
+
+        import pygments.styles as styles
+
+        with self._lock:
+            if self._sheets is None:
+                sheets = {}
+                for style in styles.get_all_styles():
+                    try:
+                        sheets[style] = self._render(style)
+                    except Exception as ex:
+                        util.log.warn(
+                            'Style "{0}" cannot be loaded: {1}'.format(
+                                style, ex,
+                            )
+                        )
+                self._sheets = sheets
+        return self._sheets
+
+    def get(self, style):
+        """
+        Returns the stylesheet for the given style, or the fallback one if
+        there is no such style
+        """
+
+        sheets = self.load()
+        try:
+            return sheets[style]
+        except KeyError:
+            return sheets[self.fallback]
+
+    def __contains__(self, style):
+        return style in self.load()
+
+    def __repr__(self):
+        return u'<Stylesheets {0}>'.format(
+            'not loaded' if self._sheets is None else
+            '{0} styles'.format(len(self._sheets))
+        )
+
+
+def _prerender(encoded, lexer, mimetype):
+    # Module-level so it can be pickled over to a worker process, which gets
+    # the (smaller) stored bytes and decompresses them itself
+    lexer = lexing.for_paste(lexer, mimetype)
+    content = model.decode(encoded.data, encoded.codec)
+    return lexer.name, highlight(content, lexer)
+
+
+class PreRenderer(object):
+    """
+    Renders freshly inserted pastes in a pool of worker threads (or
+    processes) and stores the result in the ``rendered`` table, so the
+    first readers of a new link do not all highlight it at the same time.
+    Given a ``timeout``, pastes are rendered in pasttle.sandbox processes
+    instead, and the ones taking longer are marked to be shown plain (the
+    ones whose process failed otherwise are just left to their viewers)
+    """
+
+    def __init__(self, engine, workers, processes=False, timeout=None):
+        self.engine = engine
+        self.session = orm.sessionmaker(bind=engine)
+        self.pool = None
+        if timeout:
+            self.pool = sandbox.ProcessPool(
+                workers, timeout, preload=['pasttle.render'],
+            )
+        if processes and self.pool is None:
+            self.executor = futures.ProcessPoolExecutor(workers)
+        else:
+            self.executor = futures.ThreadPoolExecutor(
+                workers, thread_name_prefix='pasttle-prerender'
+            )
+        self._pending = 0
+        self._idle = threading.Condition()
+
+    def submit(self, id, encoded, lexer, mimetype):
+        """
+        Queues the given paste (and its encoded content) for rendering
+        """
+
+        with self._idle:
+            self._pending += 1
+        if self.pool is None:
+            future = self.executor.submit(
+                _prerender, encoded, lexer, mimetype
+            )
+        else:
+            future = self.executor.submit(
+                self.pool.run, _prerender, encoded, lexer, mimetype
+            )
+        future.add_done_callback(
+            lambda f: self._store(id, encoded, lexer, mimetype, f)
+        )
+        return future
+
+    def _store(self, id, encoded, lexer, mimetype, future):
+        try:
+            if future.cancelled():
+                return
+            session = self.session()
+            try:
+                try:
+                    name, html = future.result()
+                except sandbox.TimedOut:
+                    # Views show it plain from now on, like when they time
+                    # out highlighting it themselves
+                    session.query(model.Blob).filter_by(
+                        digest=encoded.digest,
+                    ).update(dict(
+                        slow_lexer=lexing.for_paste(lexer, mimetype).name,
+                    ))
+                    session.commit()
+                    raise
+                session.merge(
+                    model.Rendered(paste_id=id, lexer=name, html=html)
+                )
+                session.commit()
+            finally:
+                session.close()
+            util.log.debug('Pre-rendered paste #{0}'.format(id,))
+        except Exception as ex:
+            util.log.warn(
+                'Could not pre-render paste #{0}: {1}'.format(id, ex,)
+            )
+        finally:
+            with self._idle:
+                self._pending -= 1
+                self._idle.notify_all()
+
+    def join(self, timeout=None):
+        """
+        Waits until everything queued so far has been stored
+        """
+
+        with self._idle:
+            return self._idle.wait_for(lambda: not self._pending, timeout)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+        if self.pool is not None:
+            self.pool.close()
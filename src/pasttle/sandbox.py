@@ -0,0 +1,180 @@
+import importlib
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+
+
+class Failed(Exception):
+    """
+    The worker process died (or was killed) before finishing the job
+    """
+
+
+class TimedOut(Failed):
+    """
+    The job took longer than allowed, its worker process was killed
+    """
+
+
+class Busy(Exception):
+    """
+    No worker process was free in time to take the job
+    """
+
+
+def _serve(conn, preload):
+    # Interrupting the server (e.g. Ctrl-C in a terminal) is left to the
+    # parent process, which kills its workers on the way out
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for name in preload:
+        importlib.import_module(name)
+    conn.send(None)
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            return
+        func, args = job
+        try:
+            result = (True, func(*args))
+        except Exception as ex:
+            result = (False, ex)
+        try:
+            conn.send(result)
+        except Exception as ex:
+            # Exceptions that can't be pickled are sent as their message
+            conn.send((False, RuntimeError(repr(ex))))
+
+
+class _Worker(object):
+
+    def __init__(self, context, preload, ready_timeout):
+        self.conn, child = context.Pipe()
+        self.process = context.Process(
+            target=_serve, args=(child, preload),
+            name='pasttle-sandbox', daemon=True,
+        )
+        self.process.start()
+        child.close()
+        # Imports are done before taking any job, so they never count
+        # against the time it is given
+        try:
+            if self.conn.poll(ready_timeout):
+                self.conn.recv()
+                return
+        except (EOFError, OSError):
+            pass
+        self.kill()
+        raise Failed('Worker did not start')
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class ProcessPool(object):
+    """
+    Runs jobs (module-level functions and picklable arguments) in up to
+    ``workers`` processes, one job at a time each, so jobs that loop or
+    backtrack for too long can be stopped: a worker that does not finish
+    its job within ``timeout`` seconds is killed and replaced. Jobs wait up
+    to ``wait`` seconds (``timeout`` by default) for a free worker. Workers
+    are started on demand with ``spawn``, forking a threaded server is not
+    safe, and ``preload`` modules are imported by each before its first job
+    """
+
+    def __init__(self, workers, timeout, wait=None, preload=(),
+                 ready_timeout=60.0):
+        self.workers = workers
+        self.timeout = timeout
+        self.wait = timeout if wait is None else wait
+        self.preload = tuple(preload)
+        self.ready_timeout = ready_timeout
+        self.results = dict(ok=0, error=0, timeout=0, crashed=0, busy=0)
+        self._context = multiprocessing.get_context('spawn')
+        self._lock = threading.Lock()
+        self._pid = None
+        self._idle = None
+
+    def _reset(self):
+        # Workers started by the parent of a forked process are not ours
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._idle = queue.LifoQueue()
+                for _ in range(self.workers):
+                    self._idle.put(None)
+
+    def _count(self, result):
+        with self._lock:
+            self.results[result] += 1
+
+    def run(self, func, *args, **kwargs):
+        """
+        Returns what func(*args) returns once run in a worker process, or
+        raises what it raises. Raises Busy if no worker was free in time,
+        TimedOut if the job took longer than ``timeout`` seconds (or the
+        given one) and Failed if its worker died
+        """
+
+        timeout = kwargs.get('timeout', self.timeout)
+        if self._pid != os.getpid():
+            self._reset()
+        idle = self._idle
+        try:
+            worker = idle.get(timeout=self.wait)
+        except queue.Empty:
+            self._count('busy')
+            raise Busy('No worker free after {0}s'.format(self.wait,))
+        try:
+            if worker is None:
+                try:
+                    worker = _Worker(
+                        self._context, self.preload, self.ready_timeout
+                    )
+                except Failed:
+                    self._count('crashed')
+                    raise
+            try:
+                worker.conn.send((func, args))
+                done = worker.conn.poll(timeout)
+                if done:
+                    ok, result = worker.conn.recv()
+            except (EOFError, OSError) as ex:
+                worker.kill()
+                worker = None
+                self._count('crashed')
+                raise Failed('Worker died: {0}'.format(ex,))
+            if not done:
+                worker.kill()
+                worker = None
+                self._count('timeout')
+                raise TimedOut('Job took longer than {0}s'.format(timeout,))
+        finally:
+            idle.put(worker)
+        self._count('ok' if ok else 'error')
+        if not ok:
+            raise result
+        return result
+
+    def close(self):
+        """
+        Kills the idle workers of this process
+        """
+
+        if self._pid != os.getpid():
+            return
+        while True:
+            try:
+                worker = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            if worker is not None:
+                worker.kill()
+
+    def __repr__(self):
+        return u'<ProcessPool {0} workers, {1}s per job>'.format(
+            self.workers, self.timeout)
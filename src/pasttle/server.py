@@ -1,26 +1,48 @@
 #!/usr/bin/env python3
 
+import calendar
+import concurrent.futures as futures
 import datetime
-import difflib
 import hashlib
+import importlib.resources
+import io
+import json
 import os
-import pkg_resources
 import sys
+import urllib.parse
 
 import bottle
 import bottle.ext.sqlalchemy as sqlaplugin
-import IPy
-import pygments
-import pygments.formatters as formatters
-import pygments.lexers as lexers
+import sqlalchemy.exc
 
 import pasttle
+import pasttle.cache as cache
+import pasttle.diff as diff
+import pasttle.lexing as lexing
+import pasttle.limits as limits
+import pasttle.metrics as metrics
+import pasttle.prefork as prefork
+import pasttle.profiler as profiler
+import pasttle.reaper as reaper_mod
+import pasttle.render as render
+import pasttle.sandbox as sandbox
 import pasttle.util as util
 import pasttle.model as model
+import pasttle.writer as writer
 
 
 CURRENT_YEAR = datetime.date.today().year
 
+# Room for the multipart boundaries and the other /post fields when checking
+# the size of a request body against max_paste_bytes
+FORM_BYTES = 65536
+
+# HTTP content-codings matching the compression codecs of stored content
+CONTENT_CODINGS = {
+    'gzip': 'gzip',
+    'zlib': 'deflate',
+}
+
 application = bottle.app()
 
 # Load an alternate template directory if specified in pasttle.ini
@@ -31,18 +53,152 @@ if util.conf.has_option(util.cfg_section, 'templates'):
     bottle.TEMPLATE_PATH.append(os.path.realpath(tpl_path))
     STATIC_CONTENT = tpl_path
 
+
+def _package_path(name):
+    """
+    Returns the path of the given directory shipped with the package
+    """
+
+    try:
+        files = importlib.resources.files
+    except AttributeError:
+        # Python < 3.9, the package is always installed unzipped
+        return os.path.join(os.path.dirname(pasttle.__file__), name)
+    return str(files('pasttle') / name)
+
+
 # Load the templates shipped with the package
-tpl_path = pkg_resources.resource_filename('pasttle', 'views')
+tpl_path = _package_path('views')
 STATIC_CONTENT = STATIC_CONTENT or tpl_path
 bottle.TEMPLATE_PATH.append(tpl_path)
 
+# Optionally profile requests into a spool directory, installed first so it
+# covers the other plugins too
+profile_dir = util.conf.get(util.cfg_section, 'profile_dir')
+if profile_dir:
+    application.install(profiler.ProfilerPlugin(
+        os.path.expanduser(profile_dir),
+        rate=util.conf.getfloat(util.cfg_section, 'profile_rate'),
+        slow=util.conf.getint(util.cfg_section, 'profile_slow_ms') / 1000.0,
+        token=util.conf.get(util.cfg_section, 'profile_token'),
+        keep=util.conf.getint(util.cfg_section, 'profile_keep'),
+    ))
+
+# Optionally record request metrics, exported on /metrics
+if util.conf.getboolean(util.cfg_section, 'metrics'):
+    metrics.registry.enabled = True
+    application.install(metrics.MetricsPlugin())
+    metrics.time_queries(model.engine)
+
+
+def _token_buckets(kind):
+    rate = util.conf.getfloat(util.cfg_section, 'rate_limit_{0}'.format(kind))
+    if rate <= 0:
+        return None
+    return limits.TokenBuckets(rate, util.conf.getint(
+        util.cfg_section, 'rate_limit_{0}_burst'.format(kind),
+    ))
+
+
+# Optionally limit the requests of each client (separately for the routes
+# storing pastes) and the requests in flight in this process
+rate_limits = dict(read=_token_buckets('read'), write=_token_buckets('write'))
+admission = None
+max_inflight = util.conf.getint(util.cfg_section, 'max_inflight')
+if max_inflight > 0:
+    admission = limits.Admission(max_inflight)
+if admission or any(rate_limits.values()):
+    application.install(limits.LimitPlugin(
+        rate_limits, admission,
+        util.conf.getint(util.cfg_section, 'trusted_proxies'),
+    ))
+
 # Install sqlalchemy plugin
 db_plugin = sqlaplugin.SQLAlchemyPlugin(
-    model.engine, model.Base.metadata, create=True
+    model.engine, model.Base.metadata, create=False
 )
 
+# The schema is created once on startup (see main), but there is nothing to
+# set up beforehand for in-memory databases
+if model.is_memory_db():
+    model.create_schema()
+
 application.install(db_plugin)
 
+# Highlighted HTML is cached in-process, pastes never change after insert
+render_cache = cache.LRUCache(
+    util.conf.getint(util.cfg_section, 'render_cache_bytes')
+)
+
+# Pastes and diffs are highlighted in a few worker processes, so a lexer
+# stuck on some input (e.g. backtracking regular expressions) is killed
+# after highlight_timeout_ms instead of tying up a request thread
+highlighter = None
+highlight_workers = util.conf.getint(util.cfg_section, 'highlight_workers')
+highlight_timeout = None
+if highlight_workers > 0:
+    highlight_timeout = util.conf.getint(
+        util.cfg_section, 'highlight_timeout_ms'
+    ) / 1000.0
+    highlighter = sandbox.ProcessPool(
+        highlight_workers, highlight_timeout, preload=['pasttle.render'],
+    )
+
+# Optionally highlight new pastes in the background right after insert
+prerenderer = None
+prerender_workers = util.conf.getint(util.cfg_section, 'prerender_workers')
+if prerender_workers > 0:
+    if model.is_memory_db():
+        util.log.warn('Pre-rendering needs a database shared across threads')
+    else:
+        prerenderer = render.PreRenderer(
+            model.engine, prerender_workers,
+            util.conf.getboolean(util.cfg_section, 'prerender_processes'),
+            # In processes of its own, killed just as slow
+            highlight_timeout,
+        )
+
+# Optionally store new pastes in batches from a single writer thread
+committer = None
+if util.conf.getboolean(util.cfg_section, 'group_commit'):
+    if model.is_memory_db():
+        util.log.warn('Group commit needs a database shared across threads')
+    else:
+        committer = writer.GroupCommitter(
+            model.engine,
+            util.conf.getint(util.cfg_section, 'group_commit_size'),
+            util.conf.getint(
+                util.cfg_section, 'group_commit_wait_ms'
+            ) / 1000.0,
+        )
+# How long a request waits for its paste to be committed before giving up
+commit_timeout = util.conf.getint(
+    util.cfg_section, 'group_commit_timeout_ms'
+) / 1000.0
+
+# The first page of /recent only changes when a paste is stored or reaped,
+# which other processes do too, or when one of its pastes expires
+recent_page = cache.Snapshot(
+    util.conf.getfloat(util.cfg_section, 'recent_cache_seconds') or None
+)
+
+# Expired pastes are deleted in the background, by every process serving
+# requests (each starts its own reaper on the first one). They are never
+# served anyway, in-memory databases only lose them on exit
+reaper = None
+reaper_interval = util.conf.getfloat(util.cfg_section, 'reaper_interval')
+if reaper_interval > 0 and not model.is_memory_db():
+    reaper = reaper_mod.Reaper(
+        model.engine,
+        util.conf.getint(util.cfg_section, 'reaper_batch'),
+        util.conf.getint(util.cfg_section, 'reaper_pause_ms') / 1000.0,
+        reaper_interval, on_reap=recent_page.invalidate,
+    )
+    application.add_hook('before_request', reaper.start)
+
+# Stylesheets of all the pygments styles, rendered once
+stylesheets = render.Stylesheets()
+
 
 def get_url(path=False):
     (scheme, host, q_path, qs, fragment) = bottle.request.urlparts
@@ -52,6 +208,73 @@ def get_url(path=False):
         return '{0}://{1}'.format(scheme, host)
 
 
+def _uncacheable():
+    """
+    Drops the validators and caching headers set by _is_fresh(), for
+    responses that are not what the same request gets next time (e.g.
+    shown plain because every highlighter process was busy)
+    """
+
+    for name in ('ETag', 'Last-Modified'):
+        if name in bottle.response:
+            del bottle.response[name]
+    bottle.response.set_header('Cache-Control', 'no-store')
+
+
+def _variant(*parts):
+    """
+    Short digest of the request details a rendered representation depends on
+    """
+
+    return hashlib.sha1(
+        u'|'.join([str(_ or '') for _ in parts]).encode()
+    ).hexdigest()[:12]
+
+
+def _is_fresh(etag_parts, last_modified=None, expires=None):
+    """
+    Sets the validators (strong ETag, Last-Modified) and far-future caching
+    headers for an immutable representation (only cached until then if it
+    expires), then checks the conditional request headers. Returns True if
+    the client copy is still fresh, in which case the response status is set
+    to 304 and the caller should return an empty body
+    """
+
+    etag = u'"{0}"'.format(u'-'.join([str(_) for _ in etag_parts]))
+    bottle.response.set_header('ETag', etag)
+    if expires:
+        left = (expires - datetime.datetime.utcnow()).total_seconds()
+        bottle.response.set_header(
+            'Cache-Control', 'public, max-age={0}'.format(max(int(left), 0))
+        )
+    else:
+        bottle.response.set_header(
+            'Cache-Control', 'public, max-age=31536000, immutable'
+        )
+    if last_modified:
+        bottle.response.set_header(
+            'Last-Modified', bottle.http_date(last_modified)
+        )
+    if bottle.request.method not in ('GET', 'HEAD'):
+        return False
+
+    fresh = False
+    if_none_match = bottle.request.get_header('If-None-Match')
+    if_modified_since = bottle.request.get_header('If-Modified-Since')
+    if if_none_match:
+        # If-None-Match takes precedence over If-Modified-Since
+        tags = [_.strip() for _ in if_none_match.split(',')]
+        fresh = '*' in tags or etag in tags or u'W/' + etag in tags
+    elif if_modified_since and last_modified:
+        since = bottle.parse_date(if_modified_since.split(';')[0].strip())
+        modified = calendar.timegm(last_modified.utctimetuple())
+        fresh = since is not None and modified <= since
+    if fresh:
+        util.log.debug('Client copy of {0} is fresh'.format(etag,))
+        bottle.response.status = 304
+    return fresh
+
+
 @bottle.get('/')
 @bottle.view('index')
 def index():
@@ -67,48 +290,182 @@ def index():
     )
 
 
-@bottle.get('/pygments/<style>.css')
+@bottle.get('/pygments/<style>.css', limit=None)
 def serve_language_css(style):
-    try:
-        fmt = formatters.get_formatter_by_name('html', style=style)
-    except Exception:
-        util.log.warn(
+    if style not in stylesheets:
+        util.log.debug(
             'Style "{0}" cannot be found, falling back to default'.format(
                 style,
             )
         )
-        fmt = formatters.get_formatter_by_name('html')
+    sheet = stylesheets.get(style)
+    coding = 'gzip' if _accepts('gzip') else None
+    bottle.response.set_header('Vary', 'Accept-Encoding')
+    if _is_fresh(['css', sheet.digest] + ([coding] if coding else [])):
+        return ''
     bottle.response.content_type = 'text/css'
-    return fmt.get_style_defs(['.pygmentized'])
+    if coding:
+        bottle.response.set_header('Content-Encoding', coding)
+        return sheet.gzipped
+    return sheet.css
+
+
+@bottle.get('/metrics', limit=None)
+def serve_metrics():
+    """
+    Exports the request metrics of this process in the Prometheus text
+    format, if enabled
+    """
+
+    if not metrics.registry.enabled:
+        return bottle.HTTPError(404, 'Metrics are not enabled')
+    bottle.response.content_type = 'text/plain; version=0.0.4; charset=utf-8'
+    return metrics.registry.export()
+
+
+@metrics.registry.collector
+def _component_metrics():
+    """
+    Reports the counters kept by the render cache, the rate limits, the
+    highlighter processes and the group committer
+    """
 
+    stats = render_cache.stats()
+    yield (
+        'pasttle_render_cache_requests_total', 'counter',
+        'Render cache lookups, by result', [
+            (dict(result='hit'), stats['hits']),
+            (dict(result='miss'), stats['misses']),
+        ],
+    )
+    yield (
+        'pasttle_render_cache_evictions_total', 'counter',
+        'Entries evicted from the render cache', [({}, stats['evictions'])],
+    )
+    yield (
+        'pasttle_render_cache_bytes', 'gauge',
+        'Size of the entries in the render cache', [({}, stats['bytes'])],
+    )
+    for kind, buckets in sorted(rate_limits.items()):
+        if buckets:
+            yield (
+                'pasttle_rate_limited_total', 'counter',
+                'Requests turned away with a 429, by kind of route',
+                [(dict(kind=kind), buckets.limited)],
+            )
+    if admission:
+        yield (
+            'pasttle_requests_in_flight', 'gauge',
+            'Requests being handled by this process',
+            [({}, admission.inflight)],
+        )
+        yield (
+            'pasttle_requests_rejected_total', 'counter',
+            'Requests turned away with a 503 for being too many in flight',
+            [({}, admission.rejected)],
+        )
+    if highlighter:
+        yield (
+            'pasttle_highlight_jobs_total', 'counter',
+            'Highlighting jobs sent to the worker processes, by result', [
+                (dict(result=result), count)
+                for result, count in sorted(highlighter.results.items())
+            ],
+        )
+    if committer:
+        stats = committer.stats()
+        yield (
+            'pasttle_group_commit_batches_total', 'counter',
+            'Group commits done', [({}, stats['batches'])],
+        )
+        yield (
+            'pasttle_group_commit_pastes_total', 'counter',
+            'Pastes stored by group commits', [({}, stats['pastes'])],
+        )
+        yield (
+            'pasttle_group_commit_seconds_total', 'counter',
+            'Time spent in group commits', [({}, stats['commit_seconds'])],
+        )
+        yield (
+            'pasttle_group_commit_largest_batch', 'gauge',
+            'Most pastes stored by a single group commit',
+            [({}, stats['largest_batch'])],
+        )
 
-@bottle.get('/<filetype:re:(css|images)>/<path:path>')
+
+@bottle.get('/<filetype:re:(css|images)>/<path:path>', limit=None)
 def serve_static(filetype, path):
     "Serve static files if not configured on the web server"
 
     return bottle.static_file(os.path.join(filetype, path), STATIC_CONTENT)
 
 
-@bottle.get('/favicon.ico')
+@bottle.get('/favicon.ico', limit=None)
 def serve_icon():
     return serve_static('images', 'icon.png')
 
 
+def _recent_pastes(db, items, before=None):
+    """
+    Returns up to the given number of pastes older than the ``before`` id
+    (or the newest ones), and whether there are more after them. Walks the
+    primary key index so every page costs the same
+    """
+
+    query = db.query(
+        model.Paste.id, model.Paste.filename, model.Paste.mimetype,
+        model.Paste.created, model.Paste.password, model.Paste.expires
+    ).filter(sqlalchemy.or_(
+        model.Paste.expires.is_(None),
+        model.Paste.expires > datetime.datetime.utcnow(),
+    ))
+    if before is not None:
+        query = query.filter(model.Paste.id < before)
+    pastes = query.order_by(model.Paste.id.desc()).limit(items + 1).all()
+    return pastes[:items], len(pastes) > items
+
+
 @bottle.get('/recent')
 def recent(db):
     """
-    Shows an unordered list of most recent pasted items
+    Shows an unordered list of most recent pasted items, a page at a time.
+    Older pages are reached with ?before=<id>, and ?format=json lists them
+    as JSON instead
     """
 
-    items = util.conf.get(util.cfg_section, 'recent_items')
+    items = util.conf.getint(util.cfg_section, 'recent_items')
+    before = bottle.request.query.before or None
+    if before is not None:
+        try:
+            before = int(before)
+        except ValueError:
+            return bottle.HTTPError(400, 'Invalid paste id')
+        pastes, more = _recent_pastes(db, items, before)
+    else:
+        pastes, more = recent_page.get(lambda: _recent_pastes(db, items))
+    fmt = bottle.request.query.format or None
+    older = None
+    if more:
+        older = '{0}/recent?before={1}{2}'.format(
+            get_url(), pastes[-1].id, '&format=json' if fmt == 'json' else ''
+        )
+    if fmt == 'json':
+        return dict(
+            pastes=[
+                dict(
+                    id=_.id, url='{0}/{1}'.format(get_url(), _.id),
+                    filename=_.filename, mimetype=_.mimetype,
+                    created=_.created.isoformat(),
+                    expires=_.expires.isoformat() if _.expires else None,
+                    protected=bool(_.password),
+                ) for _ in pastes
+            ],
+            older=older,
+        )
     return bottle.template(
         'recent', dict(
-            pastes=db.query(
-                model.Paste.id, model.Paste.filename, model.Paste.mimetype,
-                model.Paste.created, model.Paste.password
-            ).order_by(
-                model.Paste.id.desc()
-            ).limit(items).all(),
+            pastes=pastes,
+            older=older,
             url=get_url(),
             title=util.conf.get(util.cfg_section, 'title'),
             recent=items,
@@ -132,7 +489,7 @@ def upload_file():
     )
 
 
-@bottle.post('/post')
+@bottle.post('/post', limit='write')
 def post(db):
     """
     Main upload interface. Users can password-protect an entry if they so
@@ -140,8 +497,14 @@ def post(db):
     your intended password does not fly insecure through the internet
     """
 
+    max_bytes = util.conf.getint(util.cfg_section, 'max_paste_bytes')
+    if max_bytes and bottle.request.content_length > max_bytes + FORM_BYTES:
+        # Don't even bother reading the body
+        return bottle.HTTPError(413, 'Paste is too big')
     form = bottle.request.forms
-    upload = form.upload
+    upload = _open_upload()
+    if upload and max_bytes and _stream_size(upload) > max_bytes:
+        return bottle.HTTPError(413, 'Paste is too big')
     filename = form.filename if form.filename != '-' else None
     syntax = form.syntax if form.syntax != '-' else None
     password = form.password
@@ -149,77 +512,355 @@ def post(db):
         parent = int(form.parent) if form.parent else None
     except Exception as e:
         util.log.warn('Parent value does not seem like an int: %s' % (e,))
+        parent = None
     is_encrypted = bool(form.is_encrypted)
     redirect = bool(form.redirect)
+    try:
+        expires = _expiry(form.expires)
+    except ValueError as ex:
+        return bottle.HTTPError(400, str(ex))
     util.log.debug('Filename: {0}, Syntax: {1}'.format(filename, syntax,))
-    default_lexer = lexers.get_lexer_for_mimetype('text/plain')
     if upload:
-        if syntax:
-            util.log.debug(
-                'Guessing lexer for explicit syntax {0}'.format(syntax,)
+        try:
+            paste, encoded = _new_paste(
+                upload, filename, syntax, password=password,
+                is_encrypted=is_encrypted, ip=_source_ip(), parent=parent,
+                expires=expires,
             )
+        except UnicodeDecodeError:
+            return bottle.HTTPError(400, 'Paste is not UTF-8 text')
+        util.log.debug(paste)
+        rendering = (encoded, paste.lexer, paste.mimetype)
+        if committer:
+            future = committer.submit(paste)
             try:
-                lexer = lexers.get_lexer_by_name(syntax)
-            except lexers.ClassNotFound:
-                lexer = default_lexer
-        else:
-            if filename:
-                util.log.debug(
-                    'Guessing lexer for filename {0}'.format(filename,)
-                )
-                try:
-                    lexer = lexers.guess_lexer_for_filename(filename, upload)
-                except lexers.ClassNotFound:
-                    lexer = lexers.guess_lexer(upload)
-            else:
-                util.log.debug('Use default lexer')
-                lexer = default_lexer
-        util.log.debug(lexer.mimetypes)
-        lx = None
-        if lexer.name:
-            lx = lexer.name
+                paste_id = future.result(commit_timeout)
+            except futures.TimeoutError:
+                if future.cancel():
+                    return bottle.HTTPError(
+                        503, 'Too busy, try again later',
+                        headers={'Retry-After': '1'},
+                    )
+                # Its batch is being committed already, a retry would
+                # store it twice
+                paste_id = future.result()
         else:
-            if lexer.aliases:
-                lx = lexer.aliases[0]
-        mime = lexer.mimetypes[0]
-        ip = bottle.request.remote_addr
-        if ip:
-            # Try not to store crap in the database if it's not a valid IP
+            db.add(paste)
             try:
-                ip = bin(IPy.IP(ip).int())
-            except Exception as ex:
-                util.log.warn(
-                    'Impossible to store the source IP address: {0}'.format(ex)
-                )
-                ip = None
-        paste = model.Paste(
-            content=upload, mimetype=mime, is_encrypted=is_encrypted,
-            password=password, ip=ip, filename=filename,
-            lexer=lx, parent=parent
-        )
-        util.log.debug(paste)
-        db.add(paste)
-        db.commit()
+                db.commit()
+            except sqlalchemy.exc.IntegrityError as ex:
+                # Somebody stored the same content at the same time, try
+                # again now that its blob exists
+                util.log.debug('Retrying insert: {0}'.format(ex,))
+                db.rollback()
+                db.add(paste)
+                db.commit()
+            paste_id = paste.id
+        recent_page.invalidate()
+        if prerenderer:
+            prerenderer.submit(paste_id, *rendering)
         if redirect:
-            bottle.redirect('{0}/{1}'.format(get_url(), paste.id, ))
+            bottle.redirect('{0}/{1}'.format(get_url(), paste_id, ))
         else:
-            return bottle.HTTPResponse('{0}/{1}'.format(get_url(), paste.id, ))
+            return bottle.HTTPResponse('{0}/{1}'.format(get_url(), paste_id, ))
+    else:
+        return bottle.HTTPError(400, 'No paste provided')
+
+
+@bottle.post('/bulk', limit='write')
+def bulk(db):
+    """
+    Uploads many pastes at once, either as several ``upload`` file parts of
+    a multipart form or as an NDJSON body with one paste per line (an object
+    with the ``upload``, ``filename``, ``syntax``, ``password`` and
+    ``is_encrypted`` keys). All of them are stored in one transaction and
+    their URLs returned one per line, in order. With ``bundle`` set, the
+    first paste is the parent of the others, and ``expires`` applies to all
+    of them (both are query parameters of NDJSON uploads)
+    """
+
+    max_bytes = util.conf.getint(util.cfg_section, 'max_paste_bytes')
+    max_pastes = util.conf.getint(util.cfg_section, 'bulk_max_pastes')
+    if bottle.request.content_type.startswith('application/x-ndjson'):
+        items = _ndjson_items()
+        options = bottle.request.query
     else:
+        items = _multipart_items()
+        options = bottle.request.forms
+    bundle = bool(options.bundle)
+    try:
+        expires = _expiry(options.expires)
+    except ValueError as ex:
+        return bottle.HTTPError(400, str(ex))
+    ip = _source_ip()
+    pastes = []
+    try:
+        for upload, filename, syntax, password, is_encrypted in items:
+            if len(pastes) == max_pastes:
+                return bottle.HTTPError(
+                    413, 'No more than {0} pastes at once'.format(max_pastes)
+                )
+            if max_bytes and _stream_size(upload) > max_bytes:
+                return bottle.HTTPError(413, 'Paste is too big')
+            pastes.append(_new_paste(
+                upload, filename, syntax, password=password,
+                is_encrypted=is_encrypted, ip=ip, expires=expires,
+            ))
+    except UnicodeDecodeError:
+        return bottle.HTTPError(400, 'Paste is not UTF-8 text')
+    except ValueError as ex:
+        return bottle.HTTPError(400, 'Invalid paste: {0}'.format(ex,))
+    if not pastes:
         return bottle.HTTPError(400, 'No paste provided')
+    rendering = [(paste.lexer, paste.mimetype) for paste, encoded in pastes]
+    for retry in (True, False):
+        try:
+            ids = _add_all(db, [paste for paste, encoded in pastes], bundle)
+            db.commit()
+            break
+        except sqlalchemy.exc.IntegrityError as ex:
+            if not retry:
+                raise
+            # Somebody stored some of the same content at the same time, try
+            # again now that the blobs exist
+            util.log.debug('Retrying insert: {0}'.format(ex,))
+            db.rollback()
+    recent_page.invalidate()
+    if prerenderer:
+        for id, (paste, encoded), (lexer, mime) in zip(
+            ids, pastes, rendering
+        ):
+            prerenderer.submit(id, encoded, lexer, mime)
+    bottle.response.content_type = 'text/plain'
+    return u''.join(
+        '{0}/{1}\n'.format(get_url(), _) for _ in ids
+    )
+
+
+def _add_all(db, pastes, bundle=False):
+    """
+    Adds the given pastes to the session, pointing them all to the first
+    one if bundled, and returns their ids
+    """
+
+    for paste in pastes:
+        # Ids handed out by a rolled back flush are not ours anymore
+        paste.id = None
+    db.add_all(pastes)
+    if bundle:
+        # The first paste needs an id for the others to point to
+        db.flush()
+        for paste in pastes[1:]:
+            paste.parent = pastes[0].id
+    db.flush()
+    return [paste.id for paste in pastes]
+
+
+def _multipart_items():
+    """
+    Yields (file object, filename, syntax, password, is_encrypted) for each
+    file part of a bulk upload, the options are shared by all of them
+    """
+
+    form = bottle.request.forms
+    syntax = form.syntax if form.syntax != '-' else None
+    for upload in bottle.request.files.getall('upload'):
+        upload.file.seek(0)
+        filename = upload.raw_filename
+        if filename == '-':
+            filename = None
+        yield (
+            upload.file, filename, syntax, form.password,
+            bool(form.is_encrypted),
+        )
+
+
+def _ndjson_items():
+    """
+    Yields (file object, filename, syntax, password, is_encrypted) for each
+    line of an NDJSON bulk upload
+    """
+
+    for line in bottle.request.body:
+        if not line.strip():
+            continue
+        item = json.loads(line.decode())
+        if not isinstance(item, dict) or \
+                not isinstance(item.get('upload'), str):
+            raise ValueError('every line needs an "upload" string')
+        for key in ('filename', 'syntax', 'password'):
+            if not isinstance(item.get(key) or '', str):
+                raise ValueError('"{0}" is not a string'.format(key,))
+        yield (
+            io.BytesIO(item['upload'].encode()), item.get('filename'),
+            item.get('syntax'), item.get('password'),
+            bool(item.get('is_encrypted')),
+        )
+
+
+def _choose_lexer(sample, filename=None, syntax=None):
+    """
+    Returns the lexer for a new paste: the one for the given syntax, or
+    the one guessed from its filename and a sample of its content. Plain
+    text if neither was given
+    """
+
+    default_lexer = lexing.by_mimetype('text/plain')
+    if syntax:
+        util.log.debug(
+            'Guessing lexer for explicit syntax {0}'.format(syntax,)
+        )
+        try:
+            return lexing.by_name(syntax)
+        except lexing.ClassNotFound:
+            return default_lexer
+    if filename:
+        util.log.debug('Guessing lexer for filename {0}'.format(filename,))
+        lexer, elapsed = lexing.guess(sample, filename)
+        bottle.request.environ['pasttle.guess_time'] = \
+            bottle.request.environ.get('pasttle.guess_time', 0) + elapsed
+        util.log.debug(
+            'Guessed {0} in {1:.3f}s'.format(lexer.name, elapsed,)
+        )
+        return lexer
+    util.log.debug('Use default lexer')
+    return default_lexer
+
+
+def _source_ip():
+    """
+    Returns the client IP address the way it is stored, if it is valid
+    """
+
+    ip = bottle.request.remote_addr
+    if ip:
+        # Try not to store crap in the database if it's not a valid IP
+        try:
+            ip = model.pack_ip(ip)
+        except ValueError as ex:
+            util.log.warn(
+                'Impossible to store the source IP address: {0}'.format(ex)
+            )
+            ip = None
+    return ip
+
+
+def _new_paste(upload, filename=None, syntax=None, **kwargs):
+    """
+    Builds a new paste out of the uploaded binary file object, returns it
+    along with its encoded content. Raises UnicodeDecodeError if the upload
+    is not UTF-8 text
+    """
+
+    # Only a prefix of the upload is used to guess the lexer
+    sample = upload.read(
+        util.conf.getint(util.cfg_section, 'lexer_sample_bytes')
+    ).decode('utf-8', 'ignore')
+    upload.seek(0)
+    encoded = model.encode_stream(upload, model.storage_codec())
+    lexer = _choose_lexer(sample, filename, syntax)
+    bottle.request.environ['pasttle.lexer'] = lexer.name
+    util.log.debug(lexer.mimetypes)
+    lx = None
+    if lexer.name:
+        lx = lexer.name
+    else:
+        if lexer.aliases:
+            lx = lexer.aliases[0]
+    paste = model.Paste(
+        content=encoded, mimetype=lexer.mimetypes[0], filename=filename,
+        lexer=lx, **kwargs
+    )
+    return paste, encoded
+
+
+def _open_upload():
+    """
+    Returns the uploaded content as a binary file object. Uploads sent as a
+    file part are spooled to disk while the request is parsed and read back
+    from there in chunks, plain form fields are already in memory
+    """
+
+    upload = bottle.request.files.get('upload')
+    if upload:
+        upload.file.seek(0)
+        return upload.file
+    upload = bottle.request.forms.upload
+    if upload:
+        return io.BytesIO(upload.encode())
+    return None
+
+
+def _stream_size(stream):
+    """
+    Returns the size of the given seekable file object, rewound
+    """
+
+    stream.seek(0, io.SEEK_END)
+    size = stream.tell()
+    stream.seek(0)
+    return size
 
 
 def _get_paste(db, id):
     """
-    Queries the database for the given paste, or returns False is not found
+    Queries the database for the given paste, or returns False is not found.
+    Raises a 410 error if it expired, before its content is ever loaded
     """
 
     try:
         paste = db.query(model.Paste).filter_by(id=id).one()
     except Exception:
         paste = None
+    if paste is not None and paste.is_expired():
+        raise bottle.HTTPError(410, 'This paste has expired')
     return paste
 
 
+# Units of the expiry durations of new pastes
+DURATIONS = {
+    's': 1,
+    'm': 60,
+    'h': 3600,
+    'd': 86400,
+    'w': 604800,
+}
+
+
+def _expiry(duration):
+    """
+    Returns when a new paste expires given how long it should be kept (in
+    seconds, or with one of the DURATIONS units like 12h or 30d): the site
+    ``retention_days`` if empty, and never if it is ``never``. Raises
+    ValueError if it can't be parsed
+    """
+
+    duration = (duration or '').strip().lower()
+    if duration == 'never':
+        return None
+    if duration:
+        unit = DURATIONS.get(duration[-1])
+        try:
+            if unit:
+                seconds = float(duration[:-1]) * unit
+            else:
+                seconds = float(duration)
+        except ValueError:
+            seconds = 0
+        if not 0 < seconds < float('inf'):
+            raise ValueError('Invalid expiry: {0}'.format(duration,))
+    else:
+        days = util.conf.getfloat(util.cfg_section, 'retention_days')
+        if days <= 0:
+            return None
+        seconds = days * DURATIONS['d']
+    try:
+        return datetime.datetime.utcnow() + \
+            datetime.timedelta(seconds=seconds)
+    except OverflowError:
+        raise ValueError('Invalid expiry: {0}'.format(duration,))
+
+
 def _add_header_metadata(paste):
     """
     Adds pasttle special headers for paste metadata
@@ -235,58 +876,265 @@ def _add_header_metadata(paste):
             'X-Pasttle-Filename', paste.filename
         )
     if paste.ip:
-        ip = IPy.IP(int(paste.ip, 2))
-        bottle.response.set_header('X-Pasttle-Source-IP', ip)
+        bottle.response.set_header(
+            'X-Pasttle-Source-IP', str(paste.source_ip)
+        )
+
+
+def _line_range(lines):
+    """
+    Parses the ``first-last`` range of lines to show (or just the first
+    one), returns None if empty. Raises ValueError if invalid
+    """
+
+    if not lines:
+        return None
+    first, _, last = lines.partition('-')
+    try:
+        first = int(first)
+        last = int(last) if last else None
+    except ValueError:
+        first = 0
+    if first < 1 or (last is not None and last < first):
+        raise ValueError('Invalid line range: {0}'.format(lines,))
+    return first, last
 
 
-def _pygmentize(paste, lang):
+def _window(paste, lines):
     """
-    Guess (or force if lang is given) highlight on a given paste via pygments
+    Returns the window of lines of the given paste to highlight as a dict,
+    either the requested range of lines (at most ``window_lines`` of them)
+    or the first page of pastes with more than ``window_over_lines`` lines.
+    Returns None to highlight the whole paste, raises ValueError if the
+    range starts past the end of the paste
+    """
+
+    size = util.conf.getint(util.cfg_section, 'window_lines')
+    over = util.conf.getint(util.cfg_section, 'window_over_lines')
+    blob = paste.blob if paste.digest else None
+    total = blob.lines if blob else None
+    if lines is None:
+        # A paste can't have more lines than bytes
+        length = blob.size if blob else len(paste.content)
+        if not over or length <= over or (total is not None and
+                                          total <= over):
+            return None
+        first, last = 1, size
+    else:
+        first, last = lines
+        last = min(last or first + size - 1, first + size - 1)
+    window = dict(first=first, last=last, total=total, size=size)
+    if total is None:
+        # Counted once for the blobs stored by previous versions, the
+        # window is read on the way
+        window['lead'], window['text'], total = _read_lines(
+            paste, first, last, count=True
+        )
+        window['total'] = total
+        if blob:
+            blob.lines = total
+        if lines is None and total <= over:
+            return None
+    if first > max(total, 1):
+        raise ValueError('The paste only has {0} lines'.format(total,))
+    window['last'] = min(last, total)
+    return window
+
+
+def _read_lines(paste, first, last, count=False):
+    """
+    Reads lines first to last of the given paste along with the lead-in
+    lines before them, see render.read_window()
+    """
+
+    blob = paste.blob if paste.digest else None
+    chunks = blob.iter_content() if blob else [paste.content.encode()]
+    try:
+        return render.read_window(
+            chunks, first, last,
+            util.conf.getint(util.cfg_section, 'window_lead_lines'), count,
+        )
+    finally:
+        # Stop reading the blob once past the window
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+def _pygmentize(paste, lang, lines=None):
+    """
+    Guess (or force if lang is given) highlight on a given paste via pygments,
+    the whole of it or only a window of lines (see _window). The highlighted
+    output is served from the render cache when possible, the callers are
+    responsible for checking the password before getting here
     """
 
     util.log.debug("{0} in {1} language".format(paste, lang,))
     if lang:
         try:
-            lexer = lexers.get_lexer_by_name(lang)
-        except lexers.ClassNotFound:
-            lexer = lexers.get_lexer_by_name('text')
+            lexer = lexing.by_name(lang)
+        except lexing.ClassNotFound:
+            lexer = lexing.by_name('text')
     else:
-        try:
-            util.log.debug(paste.lexer)
-            lexer = lexers.get_lexer_by_name(paste.lexer)
-            util.log.debug(lexer)
-        except lexers.ClassNotFound:
-            lexer = lexers.get_lexer_for_mimetype(paste.mimetype)
+        util.log.debug(paste.lexer)
+        lexer = lexing.for_paste(paste.lexer, paste.mimetype)
     util.log.debug('Lexer is {0}'.format(lexer,))
+    bottle.request.environ['pasttle.lexer'] = lexer.name
     if paste.ip:
-        ip = IPy.IP(int(paste.ip, 2))
-        util.log.debug('Originally pasted from {0}'.format(ip,))
+        util.log.debug('Originally pasted from {0}'.format(paste.source_ip,))
     if paste.filename:
         title = '{0}, created on {1}'.format(paste.filename, paste.created, )
     else:
         title = 'created on {0}'.format(paste.created, )
     title = '{0} {1}'.format(paste.mimetype, title,)
     util.log.debug(lexer)
-    content = pygments.highlight(
-        paste.content, lexer, formatters.HtmlFormatter(
-            linenos='table',
-            encoding='utf-8',
-            lineanchors='ln',
-            anchorlinenos=True,
+    style = util.conf.get(util.cfg_section, 'pygments_style')
+    try:
+        window = _window(paste, lines)
+    except ValueError as ex:
+        return bottle.HTTPError(400, str(ex))
+    # With the digest, a paste never gets the HTML of another with its id
+    key = (paste.id, paste.get_digest(), lexer.name, lang, style)
+    if window:
+        key += (window['first'], window['last'])
+        content = render_cache.get(key)
+        if content is None:
+            if 'text' not in window:
+                window['lead'], window['text'], _ = _read_lines(
+                    paste, window['first'], window['last'],
+                )
+            content, final = _highlight(
+                paste, render.highlight_window, window['text'], lexer,
+                window['first'], window['lead'],
+            )
+            if final:
+                render_cache.set(key, content)
+            else:
+                _uncacheable()
+        window = _window_links(paste, lang, window)
+    else:
+        content = render_cache.get(key)
+    if content is None:
+        # Pre-rendered HTML is only good for the lexer the paste was stored
+        # with, forced languages are always highlighted live
+        rendered = None if lang else paste.rendered
+        if rendered is not None and rendered.lexer == lexer.name:
+            util.log.debug('Using pre-rendered {0}'.format(rendered,))
+            content, final = rendered.html, True
+        else:
+            content, final = _highlight(
+                paste, render.highlight, paste.content, lexer,
+            )
+        if final:
+            render_cache.set(key, content)
+        else:
+            _uncacheable()
+    util.log.debug('Render cache: {0}'.format(render_cache.stats(),))
+    _add_header_metadata(paste)
+    with metrics.stage('template'):
+        return bottle.template(
+            'pygmentize.html',
+            pygmentized=content,
+            title=title,
+            version=pasttle.__version__,
+            current_year=CURRENT_YEAR,
+            url=get_url(),
+            id=paste.id,
+            parent=paste.parent or u'',
+            pygments_style=style,
+            pygments_digest=stylesheets.get(style).digest,
+            window=window,
         )
+
+
+def _highlight(paste, func, text, lexer, *args):
+    """
+    Highlights some text of the given paste with render.highlight() or
+    render.highlight_window(), in the highlighter processes if there are
+    any. If it takes too long, that text is shown as plain text and so is
+    the content of the paste with that lexer from then on. Returns the HTML
+    and whether it is final, i.e. not plain text just because every
+    highlighter process was busy or failed for other reasons (e.g. it did
+    not start)
+    """
+
+    if highlighter is None:
+        return func(text, lexer, *args), True
+    blob = paste.blob if paste.digest else None
+    if blob is None or blob.slow_lexer != lexer.name:
+        try:
+            return render.run_in(highlighter, func, text, lexer, *args), True
+        except sandbox.TimedOut as ex:
+            util.log.warn('Could not highlight paste #{0} as {1}: {2}'.format(
+                paste.id, lexer.name, ex,
+            ))
+            if blob is not None:
+                blob.slow_lexer = lexer.name
+        except (sandbox.Busy, sandbox.Failed) as ex:
+            util.log.warn('Not highlighting paste #{0}: {1}'.format(
+                paste.id, ex,
+            ))
+            return func(text, lexing.by_name('text'), *args), False
+    return func(text, lexing.by_name('text'), *args), True
+
+
+def _window_links(paste, lang, window):
+    """
+    Adds the links to the previous and next pages of lines to the given
+    window, and the URL any other range of lines is shown at (also as a
+    JavaScript string literal safe to put in a script element, the host
+    comes from the request headers)
+    """
+
+    url = '{0}/{1}?{2}lines='.format(
+        get_url(), paste.id,
+        'lang={0}&'.format(urllib.parse.quote(lang)) if lang else '',
     )
-    _add_header_metadata(paste)
-    return bottle.template(
-        'pygmentize.html',
-        pygmentized=content,
-        title=title,
-        version=pasttle.__version__,
-        current_year=CURRENT_YEAR,
-        url=get_url(),
-        id=paste.id,
-        parent=paste.parent or u'',
-        pygments_style=util.conf.get(util.cfg_section, 'pygments_style'),
+    first, last, size = window['first'], window['last'], window['size']
+    links = dict(
+        window, url=url, previous=None, next=None,
+        script_url=json.dumps(url).replace('<', '\\u003c').replace(
+            '>', '\\u003e'
+        ).replace('&', '\\u0026'),
     )
+    if first > 1:
+        start = max(first - size, 1)
+        links['previous'] = '{0}{1}-{2}'.format(url, start, first - 1)
+    if last < window['total']:
+        links['next'] = '{0}{1}-{2}'.format(url, last + 1, last + size)
+    return links
+
+
+def _caching(key, chunks, final=None):
+    """
+    Passes the given chunks of highlighted HTML through, storing them all
+    together in the render cache once the last one was produced, unless the
+    ``final`` callable then says they are not
+    """
+
+    done = []
+    for chunk in chunks:
+        done.append(chunk)
+        yield chunk
+    if final is None or final():
+        render_cache.set(key, b''.join(done))
+
+
+def _stream_page(chunks, **kwargs):
+    """
+    Renders the pygmentize page around the given chunks of highlighted
+    HTML, sending everything before them while they are being produced
+    """
+
+    marker = u'<!-- pasttle:{0} -->'.format(os.urandom(8).hex())
+    with metrics.stage('template'):
+        page = bottle.template(
+            'pygmentize.html', pygmentized=marker, **kwargs
+        )
+    head, tail = page.split(marker, 1)
+    yield head.encode()
+    for chunk in chunks:
+        yield chunk
+    yield tail.encode()
 
 
 @bottle.get('/diff/<parent:int>..<id:int>')
@@ -304,31 +1152,50 @@ def showdiff(db, parent, id):
             403, 'Can only show differences between unprotected entries'
         )
 
-    diff = '\n'.join([_ for _ in difflib.unified_diff(
-        that.content.splitlines(),
-        this.content.splitlines(),
-        fromfile=that.filename or 'Paste #{0}'.format(that.id),
-        tofile=this.filename or 'Paste #{0}'.format(this.id)
-    )])
-    lexer = lexers.get_lexer_by_name('diff')
-    content = pygments.highlight(
-        diff, lexer, formatters.HtmlFormatter(
-            linenos='table',
-            encoding='utf-8',
-            lineanchors='ln',
-            anchorlinenos=True,
+    style = util.conf.get(util.cfg_section, 'pygments_style')
+    if _is_fresh(
+        [
+            that.id, that.get_digest(), this.id, this.get_digest(),
+            _variant(style, pasttle.__version__),
+        ], max(this.created, that.created),
+        min([_.expires for _ in (this, that) if _.expires], default=None),
+    ):
+        return ''
+
+    # Both sides never change, the highlighted diff can be re-used as-is
+    key = ('diff', parent, that.get_digest(), id, this.get_digest(), style)
+    content = render_cache.get(key)
+    if content is not None:
+        chunks = [content]
+    else:
+        # Hunks only fall back to plain text for a busy highlighter after
+        # the headers are sent, only cached diffs are known to be final
+        if highlighter is not None:
+            _uncacheable()
+        busy = []
+        hunks = diff.hunks(
+            that.content.splitlines(),
+            this.content.splitlines(),
+            fromfile=that.filename or 'Paste #{0}'.format(that.id),
+            tofile=this.filename or 'Paste #{0}'.format(this.id),
+            context=util.conf.getint(util.cfg_section, 'diff_context'),
+            max_lines=util.conf.getint(util.cfg_section, 'diff_max_lines'),
         )
-    )
-    return bottle.template(
-        'pygmentize.html',
-        pygmentized=content,
+        chunks = _caching(key, diff.highlight(
+            hunks,
+            util.conf.getint(util.cfg_section, 'diff_highlight_ms') / 1000.0,
+            highlighter, busy,
+        ), lambda: not busy)
+    return _stream_page(
+        chunks,
         title='Showing differences between #{0} and #{1}'.format(parent, id),
         version=pasttle.__version__,
         current_year=CURRENT_YEAR,
         url=get_url(),
         id=id,
         parent=parent,
-        pygments_style=util.conf.get(util.cfg_section, 'pygments_style'),
+        pygments_style=style,
+        pygments_digest=stylesheets.get(style).digest,
     )
 
 
@@ -343,6 +1210,10 @@ def showpaste(db, id):
 
     paste = _get_paste(db, id)
     lang = bottle.request.query.lang or None
+    try:
+        lines = _line_range(bottle.request.query.lines)
+    except ValueError as ex:
+        return bottle.HTTPError(400, str(ex))
     if not paste:
         return bottle.HTTPError(404, 'This paste does not exist')
     form = bottle.request.forms
@@ -368,11 +1239,73 @@ def showpaste(db, id):
         )
         if match == paste.password:
             bottle.response.content_type = 'text/html'
-            return _pygmentize(paste, lang)
+            return _pygmentize(paste, lang, lines)
         else:
             return bottle.HTTPError(401, 'Wrong password provided')
     else:
-        return _pygmentize(paste, lang)
+        style = util.conf.get(util.cfg_section, 'pygments_style')
+        if _is_fresh(
+            [
+                paste.id, paste.get_digest(),
+                _variant(lang, style, pasttle.__version__, lines),
+            ], paste.created, paste.expires
+        ):
+            return ''
+        return _pygmentize(paste, lang, lines)
+
+
+def _accepts(coding):
+    """
+    Tells whether the client accepts the given HTTP content-coding
+    """
+
+    accepted = bottle.request.get_header('Accept-Encoding', '')
+    for item in accepted.split(','):
+        params = [_.strip().lower() for _ in item.split(';')]
+        if params[0] != coding:
+            continue
+        qvalues = [_[2:] for _ in params[1:] if _.startswith('q=')]
+        try:
+            return not qvalues or float(qvalues[0]) > 0
+        except ValueError:
+            return False
+    return False
+
+
+def _content_coding(paste):
+    """
+    Returns the HTTP content-coding the stored (compressed) content of the
+    given paste can be sent with as-is, if the client accepts it
+    """
+
+    bottle.response.set_header('Vary', 'Accept-Encoding')
+    if not paste.digest or paste.blob is None or not paste.blob.codec:
+        return None
+    coding = CONTENT_CODINGS[paste.blob.codec]
+    return coding if _accepts(coding) else None
+
+
+def _send_raw(paste, coding=None):
+    """
+    Sends the content of the given paste, passing the stored compressed
+    bytes through untouched if a content-coding was negotiated
+    """
+
+    _add_header_metadata(paste)
+    bottle.response.content_type = "{}; charset=UTF-8".format(
+        paste.mimetype
+    )
+    blob = paste.blob if paste.digest else None
+    if coding:
+        bottle.response.set_header('Content-Encoding', coding)
+        if blob.size <= model.CHUNK_SIZE:
+            return blob.data
+        return blob.iter_data()
+    if blob is None or blob.size <= model.CHUNK_SIZE:
+        return paste.content
+    # Big pastes are sent while they are read (and decompressed)
+    bottle.response.content_length = blob.size
+    return blob.iter_content()
 
 
 @bottle.get('/raw/<id:int>')
@@ -410,19 +1343,15 @@ def showraw(db, id):
             )
         )
         if match == paste.password:
-            _add_header_metadata(paste)
-            bottle.response.content_type = "{}; charset=UTF-8".format(
-                paste.mimetype
-            )
-            return paste.content
+            return _send_raw(paste, _content_coding(paste))
         else:
             return bottle.HTTPError(401, 'Wrong password provided')
     else:
-        _add_header_metadata(paste)
-        bottle.response.content_type = "{}; charset=UTF-8".format(
-            paste.mimetype
-        )
-        return paste.content
+        coding = _content_coding(paste)
+        etag = [paste.id, paste.get_digest()] + ([coding] if coding else [])
+        if _is_fresh(etag, paste.created, paste.expires):
+            return ''
+        return _send_raw(paste, coding)
 
 
 @bottle.post('/edit/<id:int>')
@@ -441,7 +1370,7 @@ def edit(db, id):
         password=paste.password or u'',
         content=paste.content,
         checked='',
-        syntax=lexers.get_lexer_for_mimetype(paste.mimetype).aliases[0],
+        syntax=lexing.alias_for_mimetype(paste.mimetype),
         parent=id,
         url=get_url(),
         version=pasttle.__version__,
@@ -484,11 +1413,24 @@ def edit(db, id):
 
 def main():
     util.log.info('Using Python {0}'.format(sys.version, ))
+    model.create_schema()
+    util.log.info('Loaded {0}'.format(lexing.registry(),))
+    stylesheets.load()
+    util.log.info('Loaded {0}'.format(stylesheets,))
+    host = util.conf.get(util.cfg_section, 'bind')
+    port = util.conf.getint(util.cfg_section, 'port')
+    wsgi = util.conf.get(util.cfg_section, 'wsgi')
+    workers = prefork.worker_count()
+    # The built-in server gets forked into several workers, other servers
+    # have their own ways and debug mode runs the reloader instead
+    if wsgi == 'wsgiref' and workers > 1 and not util.is_debug and \
+            hasattr(os, 'fork'):
+        prefork.Prefork(application, host, port, workers).run()
+        return
     bottle.run(
-        application, host=util.conf.get(util.cfg_section, 'bind'),
-        port=util.conf.getint(util.cfg_section, 'port'),
+        application, host=host, port=port,
         reloader=util.is_debug,
-        server=util.conf.get(util.cfg_section, 'wsgi')
+        server=wsgi
     )
 
 
@@ -20,7 +20,51 @@ title: Simple paste bin
 wsgi: wsgiref
 pool_recycle: 3600
 recent_items: 20
+recent_cache_seconds: 5
 pygments_style: tango
+render_cache_bytes: 67108864
+prerender_workers: 0
+prerender_processes: false
+compression: gzip
+max_paste_bytes: 0
+lexer_sample_bytes: 65536
+lexer_guess_ms: 200
+diff_context: 3
+diff_max_lines: 20000
+diff_highlight_ms: 2000
+window_lines: 1000
+window_over_lines: 5000
+window_lead_lines: 200
+highlight_workers: 2
+highlight_timeout_ms: 5000
+asgi_threads: 16
+workers: 0
+sqlite_journal_mode: wal
+sqlite_synchronous: normal
+sqlite_mmap_size: 268435456
+sqlite_cache_size: -16384
+sqlite_busy_timeout: 5000
+group_commit: false
+group_commit_size: 64
+group_commit_wait_ms: 5
+group_commit_timeout_ms: 10000
+bulk_max_pastes: 100
+retention_days: 0
+reaper_batch: 100
+reaper_pause_ms: 200
+reaper_interval: 60
+metrics: false
+profile_dir:
+profile_rate: 0
+profile_slow_ms: 0
+profile_token:
+profile_keep: 100
+rate_limit_read: 0
+rate_limit_read_burst: 50
+rate_limit_write: 0
+rate_limit_write_burst: 10
+trusted_proxies: 0
+max_inflight: 0
 """.format(cfg_section,))
 
 conf = configparser.ConfigParser()
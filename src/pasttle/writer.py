@@ -0,0 +1,172 @@
+import concurrent.futures as futures
+import os
+import queue
+import threading
+import time
+
+import sqlalchemy.exc
+import sqlalchemy.orm as orm
+
+import pasttle.util as util
+
+
+class GroupCommitter(object):
+    """
+    Stores new pastes from a single writer thread, which commits whatever
+    was queued in the meantime (up to max_batch pastes, waiting up to
+    max_wait seconds for more to come) in one transaction. Callers get a
+    future resolving to the id of their paste once it is committed, pastes
+    whose future was cancelled before their batch started are not stored
+    """
+
+    def __init__(self, engine, max_batch=64, max_wait=0.005):
+        self.engine = engine
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.session = orm.sessionmaker(bind=engine, expire_on_commit=False)
+        self.batches = 0
+        self.pastes = 0
+        self.largest_batch = 0
+        self.commit_seconds = 0.0
+        self.slowest_commit = 0.0
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def submit(self, paste):
+        """
+        Queues the given paste to be stored, returns a future resolving to
+        its id
+        """
+
+        self._start()
+        future = futures.Future()
+        self._queue.put((paste, future))
+        return future
+
+    def _start(self):
+        # The writer thread is started on first use, so a forked worker
+        # gets its own, and started again if it died
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid() or \
+                    not self._thread.is_alive():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(
+                    target=self._run, name='pasttle-writer', daemon=True
+                )
+                self._thread.start()
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while batch[-1] is not None and len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            try:
+                batch.append(
+                    self._queue.get(timeout=timeout) if timeout > 0 else
+                    self._queue.get_nowait()
+                )
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            stop = batch[-1] is None
+            if stop:
+                batch.pop()
+            if batch:
+                try:
+                    self._commit(batch)
+                except Exception as ex:
+                    util.log.error('Could not store {0} pastes: {1}'.format(
+                        len(batch), ex,
+                    ))
+                    for paste, future in batch:
+                        if not future.done():
+                            future.set_exception(ex)
+            if stop:
+                return
+
+    def _commit(self, batch):
+        batch[:] = [_ for _ in batch if _[1].set_running_or_notify_cancel()]
+        if not batch:
+            return
+        started = time.perf_counter()
+        session = self.session()
+        try:
+            session.add_all([paste for paste, future in batch])
+            session.commit()
+            failed = False
+        except Exception as ex:
+            # Somebody else stored one of the blobs at the same time (or
+            # one of the pastes is bad), store them one by one instead
+            util.log.debug('Committing one by one: {0}'.format(ex,))
+            session.rollback()
+            failed = True
+        finally:
+            session.close()
+        if failed:
+            for paste, future in batch:
+                self._commit_one(paste, future)
+            return
+        elapsed = time.perf_counter() - started
+        for paste, future in batch:
+            future.set_result(paste.id)
+        with self._lock:
+            self.batches += 1
+            self.pastes += len(batch)
+            self.largest_batch = max(self.largest_batch, len(batch))
+            self.commit_seconds += elapsed
+            self.slowest_commit = max(self.slowest_commit, elapsed)
+        util.log.debug('Committed {0} pastes in {1:.4f}s'.format(
+            len(batch), elapsed,
+        ))
+
+    def _commit_one(self, paste, future):
+        session = self.session()
+        try:
+            for retry in (True, False):
+                # Ids handed out by a rolled back flush are not ours anymore
+                paste.id = None
+                session.add(paste)
+                try:
+                    session.commit()
+                    break
+                except sqlalchemy.exc.IntegrityError:
+                    session.rollback()
+                    if not retry:
+                        raise
+            future.set_result(paste.id)
+        except Exception as ex:
+            session.rollback()
+            future.set_exception(ex)
+        finally:
+            session.close()
+
+    def close(self):
+        """
+        Stores everything queued so far and stops the writer thread
+        """
+
+        with self._lock:
+            thread = self._thread
+        if thread is not None and thread.is_alive():
+            self._queue.put(None)
+            thread.join()
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                batches=self.batches, pastes=self.pastes,
+                largest_batch=self.largest_batch,
+                mean_batch=self.pastes / self.batches if self.batches else 0,
+                commit_seconds=self.commit_seconds,
+                slowest_commit=self.slowest_commit,
+            )
+
+    def __repr__(self):
+        return u'<GroupCommitter {0} pastes in {1} batches>'.format(
+            self.pastes, self.batches)
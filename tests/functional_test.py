@@ -3,6 +3,7 @@
 import hashlib
 import os
 import sys
+import time
 import unittest
 import urllib.parse
 import webtest
@@ -29,6 +30,48 @@ class FunctionalTest(unittest.TestCase):
         "Most recent items page, expect a 200"
         assert self.app.get('/recent').status == '200 OK'
 
+    def test_recent_pages(self):
+        "Page through the recent items as JSON, expect newest first"
+        import sqlalchemy.orm
+        from pasttle import model, server, util
+
+        ids = []
+        for x in range(3):
+            rsp = self.app.post('/post', {'upload': 'Recent #{}'.format(x)})
+            ids.append(int(urllib.parse.urlparse(rsp.body).path[1:]))
+        util.conf.set(util.cfg_section, 'recent_items', '2')
+        try:
+            rsp = self.app.get('/recent?format=json')
+            assert [_['id'] for _ in rsp.json['pastes']] == ids[:0:-1]
+            assert 'password' not in rsp.json['pastes'][0]
+            older = rsp.json['older']
+            assert older.endswith('?before={}&format=json'.format(ids[1]))
+            rsp = self.app.get(older)
+            assert rsp.json['pastes'][0]['id'] == ids[0]
+            # The cached first page is dropped when a paste is stored
+            rsp = self.app.post('/post', {'upload': 'Recent #3'})
+            rsp = self.app.get('/recent?format=json')
+            assert rsp.json['pastes'][1]['id'] == ids[-1]
+            rsp = self.app.get('/recent?before={}'.format(ids[1]))
+            assert rsp.status == '200 OK'
+            assert 'Paste #{}'.format(ids[0]) in rsp.text
+            rsp = self.app.request('/recent?before=x', status=400)
+            assert rsp.status == '400 Bad Request'
+            # Deleted by another process, shown until the first page expires
+            session = sqlalchemy.orm.Session(bind=model.engine)
+            session.delete(session.query(model.Paste).get(ids[-1]))
+            session.commit()
+            session.close()
+            rsp = self.app.get('/recent?format=json')
+            assert rsp.json['pastes'][1]['id'] == ids[-1]
+            server.recent_page.ttl = 0
+            rsp = self.app.get('/recent?format=json')
+            assert rsp.json['pastes'][1]['id'] == ids[-2]
+        finally:
+            util.conf.set(util.cfg_section, 'recent_items', '20')
+            server.recent_page.ttl = 5
+            server.recent_page.invalidate()
+
     def test_post_form(self):
         "Form page, expect a 200"
         assert self.app.get('/post').status == '200 OK'
@@ -261,6 +304,1291 @@ class FunctionalTest(unittest.TestCase):
         assert rsp.status == '200 OK'
         assert rsp.body.decode() == emoji
 
+    def test_render_cache(self):
+        "View the same paste twice, expect the second view from the cache"
+        from pasttle import server
+
+        text = 'print("cache me")'
+        rsp = self.app.post(
+            '/post', {
+                'upload': text,
+                'syntax': 'python',
+            }
+        )
+        assert rsp.status == '200 OK'
+        url = urllib.parse.urlparse(rsp.body)
+        stats = server.render_cache.stats()
+        first = self.app.get(url.path.decode())
+        assert first.status == '200 OK'
+        assert server.render_cache.stats()['misses'] == stats['misses'] + 1
+        second = self.app.get(url.path.decode())
+        assert second.status == '200 OK'
+        assert server.render_cache.stats()['hits'] == stats['hits'] + 1
+        assert first.body == second.body
+
+    def test_render_cache_protected(self):
+        "Protected pastes are only rendered after the password matches"
+        from pasttle import server
+
+        password = 'cached password'
+        rsp = self.app.post(
+            '/post', {
+                'upload': 'Protected and cached',
+                'password': password,
+            }
+        )
+        assert rsp.status == '200 OK'
+        path = urllib.parse.urlparse(rsp.body).path.decode()
+        self.app.post(path, {'password': password})
+        stats = server.render_cache.stats()
+        rsp = self.app.get(path)
+        assert 'Protected and cached' not in rsp.body.decode()
+        rsp = self.app.post(path, {'password': 'wrong'}, status=401)
+        assert server.render_cache.stats()['hits'] == stats['hits']
+        rsp = self.app.post(path, {'password': password})
+        assert 'Protected and cached' in rsp.body.decode()
+        assert server.render_cache.stats()['hits'] == stats['hits'] + 1
+
+    def test_prerender(self):
+        "Pre-render a paste in the background, expect it stored"
+        import tempfile
+        import sqlalchemy
+        import sqlalchemy.orm
+        from pasttle import model, render
+
+        with tempfile.TemporaryDirectory() as tmp:
+            engine = sqlalchemy.create_engine(
+                'sqlite:///{}'.format(os.path.join(tmp, 'prerender.db'))
+            )
+            model.Base.metadata.create_all(engine)
+            session = sqlalchemy.orm.Session(bind=engine)
+            paste = model.Paste(
+                content='import os', mimetype='text/x-python', lexer='Python'
+            )
+            session.add(paste)
+            session.commit()
+            renderer = render.PreRenderer(engine, 2)
+            renderer.submit(
+                paste.id, model.encode('import os'), 'Python', 'text/x-python'
+            )
+            assert renderer.join(10)
+            renderer.shutdown()
+            session.expire_all()
+            assert paste.rendered.lexer == 'Python'
+            assert b'highlight' in paste.rendered.html
+            # Workers that don't start leave the paste to its viewers
+            renderer = render.PreRenderer(engine, 1, timeout=5)
+            renderer.pool.preload = ('pasttle.no_such_module',)
+            renderer.submit(
+                paste.id, model.encode('import os'), 'Python', 'text/x-python'
+            )
+            assert renderer.join(60)
+            renderer.shutdown()
+            assert renderer.pool.results['crashed'] == 1
+            session.expire_all()
+            assert paste.blob.slow_lexer is None
+            # Time limited, nothing ever finishes in no time
+            renderer = render.PreRenderer(engine, 1, timeout=1e-6)
+            renderer.submit(
+                paste.id, model.encode('import os'), 'Python', 'text/x-python'
+            )
+            assert renderer.join(60)
+            renderer.shutdown()
+            assert renderer.pool.results['timeout'] == 1
+            session.expire_all()
+            assert paste.blob.slow_lexer == 'Python'
+            session.close()
+            engine.dispose()
+
+    def test_group_commit(self):
+        "Store a burst of pastes through the group committer, expect batches"
+        import concurrent.futures as futures
+        import tempfile
+        import threading
+        import types
+        import sqlalchemy
+        import sqlalchemy.orm
+        from pasttle import model, server, writer
+
+        with tempfile.TemporaryDirectory() as tmp:
+            engine = sqlalchemy.create_engine(
+                'sqlite:///{}'.format(os.path.join(tmp, 'group.db'))
+            )
+            model.Base.metadata.create_all(engine)
+            committer = writer.GroupCommitter(engine, 8, 0.05)
+            ids = []
+
+            def paste(x):
+                # Half of them share their content
+                ids.append(committer.submit(model.Paste(
+                    content='Burst #{}'.format(x % 10),
+                    mimetype='text/plain',
+                )).result(10))
+
+            threads = [
+                threading.Thread(target=paste, args=(_,)) for _ in range(20)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            committer.close()
+            stats = committer.stats()
+            assert len(set(ids)) == 20
+            assert stats['pastes'] == 20
+            assert stats['batches'] < 20
+            assert stats['largest_batch'] <= 8
+            session = sqlalchemy.orm.Session(bind=engine)
+            assert session.query(model.Paste).count() == 20
+            blobs = session.query(model.Blob).all()
+            assert len(blobs) == 10
+            assert set([_.refcount for _ in blobs]) == set([2])
+            assert session.query(model.Paste).get(ids[0]).content.startswith(
+                'Burst #'
+            )
+            session.close()
+            # A writer thread that is gone is started again
+            assert not committer._thread.is_alive()
+            assert committer.submit(model.Paste(
+                content='Burst #20', mimetype='text/plain',
+            )).result(10) > max(ids)
+            committer.close()
+            engine.dispose()
+        # Posts that wait too long for their commit are turned away
+        pending = futures.Future()
+        committer, timeout = server.committer, server.commit_timeout
+        server.committer = types.SimpleNamespace(submit=lambda _: pending)
+        server.commit_timeout = 0.01
+        try:
+            rsp = self.app.post('/post', {'upload': 'Slow'}, status=503)
+            assert rsp.headers['Retry-After'] == '1'
+            assert pending.cancelled()
+            # Too late to be dropped, answered once committed
+            started = futures.Future()
+            started.set_running_or_notify_cancel()
+            server.committer = types.SimpleNamespace(submit=lambda _: started)
+            threading.Timer(0.1, started.set_result, (12345,)).start()
+            rsp = self.app.post('/post', {'upload': 'Slow'})
+            assert rsp.body.decode().endswith('/12345')
+        finally:
+            server.committer, server.commit_timeout = committer, timeout
+
+    def test_prerendered_view(self):
+        "Views use the pre-rendered HTML unless a language is forced"
+        import sqlalchemy.orm
+        from pasttle import model
+
+        rsp = self.app.post(
+            '/post', {
+                'upload': 'Text to be pre-rendered',
+                'syntax': 'text',
+            }
+        )
+        assert rsp.status == '200 OK'
+        path = urllib.parse.urlparse(rsp.body).path.decode()
+        session = sqlalchemy.orm.Session(bind=model.engine)
+        session.add(model.Rendered(
+            paste_id=int(path.split('/')[-1]), lexer='Text only',
+            html=b'<p>pre-rendered marker</p>',
+        ))
+        session.commit()
+        session.close()
+        rsp = self.app.get(path)
+        assert 'pre-rendered marker' in rsp.body.decode()
+        rsp = self.app.get('{}?lang=python'.format(path))
+        assert 'pre-rendered marker' not in rsp.body.decode()
+
+    def test_deduplicated_content(self):
+        "Paste the same text twice, expect a single reference-counted blob"
+        import sqlalchemy.orm
+        from pasttle import model
+
+        text = 'Traceback (most recent call last): deduplicated'
+        ids = []
+        for x in range(0, 2):
+            rsp = self.app.post('/post', {'upload': text})
+            assert rsp.status == '200 OK'
+            ids.append(int(rsp.body.decode().split('/')[-1]))
+        session = sqlalchemy.orm.Session(bind=model.engine)
+        pastes = [session.query(model.Paste).get(_) for _ in ids]
+        assert pastes[0].digest == pastes[1].digest == model.digest(text)
+        assert pastes[0].inline_content == ''
+        blob = session.query(model.Blob).get(model.digest(text))
+        assert blob.refcount == 2
+        assert blob.content == text
+        for x, paste in enumerate(pastes):
+            session.delete(paste)
+            session.commit()
+            blob = session.query(model.Blob).get(model.digest(text))
+            assert (blob.refcount if blob else 0) == 1 - x
+        session.close()
+
+    def test_migrated_content(self):
+        "Store a paste inline like older versions, expect it moved to a blob"
+        from pasttle import model
+
+        text = 'Stored inline by a previous version'
+        rsp = self.app.post('/post', {'upload': text})
+        id = int(rsp.body.decode().split('/')[-1])
+        pastes, blobs = model.Paste.__table__, model.Blob.__table__
+        with model.engine.begin() as conn:
+            conn.execute(pastes.update().where(pastes.c.id == id).values(
+                content=text, digest=None,
+            ))
+            conn.execute(blobs.delete().where(
+                blobs.c.digest == model.digest(text)
+            ))
+        assert self.app.get('/raw/{}'.format(id)).body.decode() == text
+        assert model.migrate_contents(batch=1) == 1
+        assert model.migrate_contents() == 0
+        with model.engine.begin() as conn:
+            row = conn.execute(
+                pastes.select().where(pastes.c.id == id)
+            ).fetchone()
+            assert row.digest == model.digest(text)
+            assert row.content == ''
+            assert conn.execute(
+                blobs.select().with_only_columns([blobs.c.refcount])
+                .where(blobs.c.digest == row.digest)
+            ).scalar() == 1
+        assert self.app.get('/raw/{}'.format(id)).body.decode() == text
+
+    def test_compressed_passthrough(self):
+        "Fetch a compressed paste with and without gzip, expect the same text"
+        import gzip
+        import zlib
+        import webob
+        from pasttle import server, util
+
+        text = 'A very repetitive log line\n' * 100
+        for codec in ('gzip', 'zlib', 'none'):
+            util.conf.set(util.cfg_section, 'compression', codec)
+            try:
+                rsp = self.app.post(
+                    '/post', {
+                        'upload': '{}{}'.format(codec, text),
+                    }
+                )
+            finally:
+                util.conf.set(util.cfg_section, 'compression', 'gzip')
+            assert rsp.status == '200 OK'
+            path = urllib.parse.urlparse(rsp.body).path.decode()
+            rsp = self.app.get('/raw{}'.format(path))
+            assert 'Content-Encoding' not in rsp.headers
+            assert rsp.body.decode() == '{}{}'.format(codec, text)
+            plain_etag = rsp.headers['ETag']
+            # webtest decodes compressed bodies, talk to the app directly
+            rsp = webob.Request.blank(
+                '/raw{}'.format(path),
+                headers={'Accept-Encoding': 'br, gzip, deflate'},
+            ).get_response(server.application)
+            assert rsp.headers['Vary'] == 'Accept-Encoding'
+            coding = rsp.headers.get('Content-Encoding')
+            if codec == 'gzip':
+                assert coding == 'gzip'
+                body = gzip.decompress(rsp.body)
+            elif codec == 'zlib':
+                assert coding == 'deflate'
+                body = zlib.decompress(rsp.body)
+            else:
+                assert coding is None
+                body = rsp.body
+            assert body.decode() == '{}{}'.format(codec, text)
+            assert (rsp.headers['ETag'] != plain_etag) == bool(coding)
+        rsp = webob.Request.blank(
+            '/raw{}'.format(path),
+            headers={'Accept-Encoding': 'gzip;q=0'},
+        ).get_response(server.application)
+        assert 'Content-Encoding' not in rsp.headers
+
+    def test_file_upload(self):
+        "Upload the paste as a file part, expect the text to come back"
+        text = 'A log sent as a file\n' * 5000
+        rsp = self.app.post(
+            '/post', upload_files=[('upload', 'build.log', text.encode())],
+        )
+        assert rsp.status == '200 OK'
+        path = urllib.parse.urlparse(rsp.body).path.decode()
+        rsp = self.app.get('/raw{}'.format(path))
+        assert rsp.body.decode() == text
+        rsp = self.app.post(
+            '/post', upload_files=[('upload', 'binary.bin', b'\xff\xfe\x00')],
+            status=400,
+        )
+        assert rsp.status == '400 Bad Request'
+
+    def test_bulk_upload(self):
+        "Upload several files in one request, expect their URLs in order"
+        import json
+        import sqlalchemy.orm
+        from pasttle import model
+
+        rsp = self.app.post(
+            '/bulk', {'bundle': 'yes'}, upload_files=[
+                ('upload', 'bulk.py', b'import os\n'),
+                ('upload', 'bulk.txt', b'Some bulk text\n'),
+                ('upload', 'bulk.rst', b'Title\n=====\n'),
+            ]
+        )
+        assert rsp.status == '200 OK'
+        ids = [
+            int(urllib.parse.urlparse(_).path[1:])
+            for _ in rsp.text.splitlines()
+        ]
+        assert len(ids) == 3 and ids == sorted(ids)
+        session = sqlalchemy.orm.Session(bind=model.engine)
+        pastes = [session.query(model.Paste).get(_) for _ in ids]
+        assert [_.filename for _ in pastes] == [
+            'bulk.py', 'bulk.txt', 'bulk.rst'
+        ]
+        assert pastes[0].lexer == 'Python'
+        assert [_.parent for _ in pastes] == [None, ids[0], ids[0]]
+        assert pastes[2].content == 'Title\n=====\n'
+        session.close()
+
+        lines = [
+            json.dumps({'upload': 'print(1)', 'syntax': 'python'}),
+            '',
+            json.dumps({'upload': 'ndjson text', 'filename': 'a.txt'}),
+        ]
+        rsp = self.app.post(
+            '/bulk', '\n'.join(lines).encode(),
+            content_type='application/x-ndjson',
+        )
+        urls = rsp.text.splitlines()
+        assert len(urls) == 2
+        rsp = self.app.get(
+            '/raw{}'.format(urllib.parse.urlparse(urls[0]).path)
+        )
+        assert rsp.text == 'print(1)'
+        assert rsp.headers['X-Pasttle-Lexer'] == 'Python'
+        rsp = self.app.post(
+            '/bulk', b'{"filename": "no upload"}',
+            content_type='application/x-ndjson', status=400,
+        )
+        assert rsp.status == '400 Bad Request'
+        rsp = self.app.post('/bulk', {'bundle': 'yes'}, status=400)
+        assert rsp.status == '400 Bad Request'
+
+    def test_upload_too_big(self):
+        "Upload more than max_paste_bytes, expect a 413"
+        from pasttle import util
+
+        util.conf.set(util.cfg_section, 'max_paste_bytes', '1024')
+        try:
+            rsp = self.app.post(
+                '/post', {'upload': 'x' * 1025}, status=413,
+            )
+            assert rsp.status == '413 Request Entity Too Large'
+            rsp = self.app.post(
+                '/post', upload_files=[('upload', 'big.log', b'x' * 100000)],
+                status=413,
+            )
+            assert rsp.status == '413 Request Entity Too Large'
+            rsp = self.app.post('/post', {'upload': 'x' * 1024})
+            assert rsp.status == '200 OK'
+        finally:
+            util.conf.set(util.cfg_section, 'max_paste_bytes', '0')
+
+    def test_streamed_raw(self):
+        "Fetch a big paste, expect it to be sent in several chunks"
+        import io
+        import sqlalchemy
+        import wsgiref.util
+        from pasttle import model, server
+
+        text = ''.join(
+            ['{} {}\n'.format(x, os.urandom(16).hex()) for x in range(20000)]
+        )
+        rsp = self.app.post(
+            '/post', upload_files=[('upload', 'big.log', text.encode())],
+        )
+        path = urllib.parse.urlparse(rsp.body).path.decode()
+        assert self.app.get('/raw{}'.format(path)).body.decode() == text
+
+        environ = {
+            'PATH_INFO': '/raw{}'.format(path), 'wsgi.input': io.BytesIO(),
+        }
+        wsgiref.util.setup_testing_defaults(environ)
+        body = server.application(environ, lambda *args: None)
+        chunks = list(body)
+        body.close()
+        assert len(chunks) > 1
+        assert max([len(_) for _ in chunks]) < len(text)
+        assert b''.join(chunks).decode() == text
+
+        # Backends without incremental blob I/O are read in slices
+        digest = model.digest(text)
+        conn = model.engine.connect()
+        try:
+            slices = b''.join(model._read_slices(conn, digest, 0, 1000))
+        finally:
+            conn.close()
+        assert slices == b''.join(model.read_blob(digest))[
+            :model.READ_BATCH_SIZE
+        ]
+
+        # Read in batches, no connection is held while chunks are sent
+        stored = b''.join(model.read_blob(digest))
+        checkins = []
+
+        def checkin(*args):
+            checkins.append(args)
+
+        sqlalchemy.event.listen(model.engine, 'checkin', checkin)
+        try:
+            model.READ_BATCH_SIZE = 5000
+            chunks = model.read_blob(digest, 1000)
+            assert next(chunks) == stored[:1000]
+            assert len(checkins) == 1
+            assert b''.join(chunks) == stored[1000:]
+            assert len(checkins) == len(stored) // 5000 + 1
+        finally:
+            model.READ_BATCH_SIZE = 16 * model.CHUNK_SIZE
+            sqlalchemy.event.remove(model.engine, 'checkin', checkin)
+
+    def test_streamed_diff(self):
+        "Diff two pastes with several hunks, expect them all highlighted"
+        text = ['line {}'.format(x) for x in range(200)]
+        newtext = list(text)
+        newtext[10] = 'changed line 10'
+        newtext[150] = 'changed line 150'
+        ids = []
+        for content in (text, newtext):
+            rsp = self.app.post('/post', {'upload': '\n'.join(content)})
+            ids.append(urllib.parse.urlparse(rsp.body).path.decode()[1:])
+        rsp = self.app.get('/diff/{}..{}'.format(*ids))
+        assert rsp.status == '200 OK'
+        body = rsp.body.decode()
+        assert body.count('<table class="highlighttable">') == 2
+        assert 'changed line 10' in body and 'changed line 150' in body
+        assert body.count('id="ln-1"') == 1
+        assert body.count('Compare to previous version') == 1
+
+    def test_diff_engine(self):
+        "Diff several edited line lists, expect what difflib would output"
+        import difflib
+        import random
+        from pasttle import diff
+
+        rnd = random.Random(11)
+        for x in range(50):
+            a = ['line {}'.format(_) for _ in range(rnd.randint(0, 60))]
+            b = list(a)
+            for y in range(rnd.randint(0, 5)):
+                b.insert(rnd.randint(0, len(b)), 'new {}'.format(y))
+            b = [_ for _ in b if rnd.random() > 0.05]
+            for context in (0, 3):
+                expected = list(difflib.unified_diff(
+                    a, b, 'a', 'b', n=context, lineterm=''
+                ))
+                got = diff.hunks(a, b, 'a', 'b', context=context)
+                assert [_ for hunk in got for _ in hunk] == expected
+        a = ['line {}'.format(_) for _ in range(100)]
+        b = a[:10] + ['x', 'y'] + a[30:]
+        hunks = list(diff.hunks(a, b, 'a', 'b', max_lines=10))
+        assert len(hunks) == 1
+        assert hunks[0][2] == '@@ -8,26 +8,8 @@'
+        html = b''.join(diff.highlight(hunks, budget=1e-9)).decode()
+        assert '<table' not in html and '+x' in html
+
+    def test_cached_diff(self):
+        "Show the same diff twice, expect the second one from the cache"
+        from pasttle import model, server
+
+        ids, digests = [], []
+        for content in ('cached\ndiff', 'cached\ndiff\nagain'):
+            rsp = self.app.post('/post', {'upload': content})
+            ids.append(int(urllib.parse.urlparse(rsp.body).path[1:]))
+            digests.append(model.digest(content))
+        style = server.util.conf.get(server.util.cfg_section, 'pygments_style')
+        key = ('diff', ids[0], digests[0], ids[1], digests[1], style)
+        assert key not in server.render_cache
+        rsp = self.app.get('/diff/{}..{}'.format(*ids))
+        assert server.render_cache.get(key).decode() in rsp.text
+        server.render_cache.set(key, b'<p>from the cache</p>')
+        try:
+            rsp = self.app.get('/diff/{}..{}'.format(*ids))
+            assert '<p>from the cache</p>' in rsp.text
+        finally:
+            server.render_cache.clear()
+
+    def _asgi(self, app, method, path, body=b'', headers=()):
+        import asyncio
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        asyncio.run(self._asgi_request(app, method, path, body, headers, send))
+        return sent[0]['status'], [_.get('body', b'') for _ in sent[1:]]
+
+    def _asgi_request(self, app, method, path, body, headers, send):
+        query = path.partition('?')[2]
+        scope = {
+            'type': 'http', 'method': method, 'http_version': '1.1',
+            'path': path.partition('?')[0], 'query_string': query.encode(),
+            'headers': [(k.encode(), v.encode()) for k, v in headers],
+            'server': ('localhost', 80), 'client': ('127.0.0.1', 1234),
+        }
+        # The body comes in two messages, like a slow client would send it
+        middle = len(body) // 2
+        received = [
+            {'type': 'http.request', 'body': body[:middle], 'more_body': True},
+            {'type': 'http.request', 'body': body[middle:]},
+        ]
+
+        async def receive():
+            return received.pop(0)
+
+        return app(scope, receive, send)
+
+    def test_asgi(self):
+        "Post and fetch a big paste over ASGI, expect it streamed back"
+        import json
+        from pasttle import asgi, limits, model, util
+
+        admission = limits.Admission(1)
+        app = asgi.ASGIApplication(
+            self.app.app, 1, max_bytes=1048576, admission=admission,
+            path_max_bytes={'/bulk': 2 * 1048576},
+        )
+        try:
+            # Each thread gets its own in-memory database
+            app.workers[0].submit(
+                model.Base.metadata.create_all, model.engine
+            ).result()
+            text = ''.join(
+                'ASGI line {}\n'.format(_) for _ in range(5000)
+            )
+            # Stored uncompressed, so it is read back in several chunks
+            util.conf.set(util.cfg_section, 'compression', 'none')
+            try:
+                status, chunks = self._asgi(
+                    app, 'POST', '/post',
+                    urllib.parse.urlencode({'upload': text}).encode(),
+                    [('Content-Type', 'application/x-www-form-urlencoded')],
+                )
+            finally:
+                util.conf.set(util.cfg_section, 'compression', 'gzip')
+            assert status == 200
+            path = urllib.parse.urlparse(b''.join(chunks)).path.decode()
+            status, chunks = self._asgi(app, 'GET', '/raw{}'.format(path))
+            assert status == 200
+            assert len([_ for _ in chunks if _]) > 1
+            assert b''.join(chunks).decode() == text
+            status, chunks = self._asgi(
+                app, 'POST', '/post', b'x' * 1048577,
+            )
+            assert status == 413
+            assert admission.inflight == 0
+            # Bulk uploads get a limit of their own
+            line = json.dumps({'upload': 'x' * 786432}) + '\n'
+            status, chunks = self._asgi(
+                app, 'POST', '/bulk', (line * 2).encode(),
+                [('Content-Type', 'application/x-ndjson')],
+            )
+            assert status == 200
+            assert len(b''.join(chunks).splitlines()) == 2
+            # Every worker thread is free again
+            assert app._idle.qsize() == 1
+            # Turned away before reading the body when too busy
+            admission.enter()
+            status, chunks = self._asgi(app, 'GET', '/raw{}'.format(path))
+            assert status == 503
+            admission.leave()
+        finally:
+            app.shutdown()
+
+    def test_asgi_slow_client(self):
+        "Stream a paste to a stalled client, expect others still served"
+        import asyncio
+        from pasttle import asgi, model, util
+
+        app = asgi.ASGIApplication(self.app.app, 1, read_ahead_bytes=1000)
+        try:
+            app.workers[0].submit(
+                model.Base.metadata.create_all, model.engine
+            ).result()
+            text = ''.join('slow line {}\n'.format(_) for _ in range(5000))
+            util.conf.set(util.cfg_section, 'compression', 'none')
+            try:
+                status, chunks = self._asgi(
+                    app, 'POST', '/post',
+                    urllib.parse.urlencode({'upload': text}).encode(),
+                    [('Content-Type', 'application/x-www-form-urlencoded')],
+                )
+            finally:
+                util.conf.set(util.cfg_section, 'compression', 'gzip')
+            path = '/raw{}'.format(
+                urllib.parse.urlparse(b''.join(chunks)).path.decode()
+            )
+            slow = []
+            fast = []
+
+            async def run():
+                served = asyncio.Event()
+
+                async def stalled(message):
+                    slow.append(message)
+                    # Doesn't take any more until the other request is done
+                    if len(slow) == 2:
+                        await served.wait()
+
+                async def send(message):
+                    fast.append(message)
+                    if message['type'] == 'http.response.body' and \
+                            not message.get('more_body'):
+                        served.set()
+
+                await asyncio.wait_for(asyncio.gather(
+                    self._asgi_request(app, 'GET', path, b'', (), stalled),
+                    self._asgi_request(app, 'GET', path, b'', (), send),
+                ), 5)
+
+            asyncio.run(run())
+            assert fast[0]['status'] == 200
+            assert b''.join(_.get('body', b'') for _ in fast).decode() == text
+            assert b''.join(_.get('body', b'') for _ in slow).decode() == text
+            assert app._idle.qsize() == 1
+        finally:
+            app.shutdown()
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'needs os.fork()')
+    def test_prefork(self):
+        "Serve from two forked workers, kill one, expect it replaced"
+        import signal
+        import socket
+        import urllib.request
+        from pasttle import prefork
+
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+        url = 'http://127.0.0.1:{}/'.format(port)
+        runner = prefork.Prefork(
+            self.app.app, '127.0.0.1', port, 2, quiet=True
+        )
+        # No warm_up(), it would close the in-memory database of the tests
+        try:
+            for x in range(2):
+                runner.spawn()
+            assert len(runner.children) == 2
+
+            def get():
+                # Wait for the workers to be listening
+                for x in range(50):
+                    try:
+                        with urllib.request.urlopen(url) as rsp:
+                            return rsp.status
+                    except OSError:
+                        time.sleep(0.1)
+
+            assert get() == 200
+            pid = list(runner.children)[0]
+            os.kill(pid, signal.SIGKILL)
+            runner.MIN_UPTIME = 0
+            assert runner.reap() == pid
+            assert pid not in runner.children
+            assert len(runner.children) == 2
+            assert get() == 200
+        finally:
+            runner.stop()
+        assert not runner.children
+
+    def test_sqlite_pragmas(self):
+        "Open an SQLite database file, expect the configured pragmas set"
+        import tempfile
+        import sqlalchemy
+        from pasttle import model
+
+        pragmas = model.sqlite_pragmas()
+        assert pragmas['journal_mode'] == 'wal'
+        with tempfile.TemporaryDirectory() as tmp:
+            engine = sqlalchemy.create_engine(
+                'sqlite:///{}'.format(os.path.join(tmp, 'pragmas.db'))
+            )
+            model.use_pragmas(engine, pragmas)
+            with engine.connect() as conn:
+                assert conn.exec_driver_sql(
+                    'PRAGMA journal_mode'
+                ).scalar() == 'wal'
+                assert conn.exec_driver_sql(
+                    'PRAGMA busy_timeout'
+                ).scalar() == 5000
+                assert conn.exec_driver_sql(
+                    'PRAGMA synchronous'
+                ).scalar() == 1
+            engine.dispose()
+        with self.assertRaises(ValueError):
+            model.use_pragmas(engine, {'synchronous': 'off; drop table x'})
+
+    def test_metrics(self):
+        "View a paste with metrics enabled, expect it in /metrics"
+        from pasttle import metrics, server
+
+        self.app.request('/metrics', status=404)
+        plugin = metrics.MetricsPlugin()
+        server.application.install(plugin)
+        metrics.registry.enabled = True
+        try:
+            rsp = self.app.post('/post', {
+                'upload': 'def metrics(): pass', 'filename': 'metrics.py',
+            })
+            path = urllib.parse.urlparse(rsp.body).path.decode()
+            self.app.get(path)
+            self.app.get(path)
+            self.app.request('/50000', status=404)
+            rsp = self.app.get('/metrics')
+        finally:
+            metrics.registry.enabled = False
+            server.application.uninstall(plugin)
+        assert rsp.content_type == 'text/plain'
+        lines = rsp.text.splitlines()
+        assert '# TYPE pasttle_request_seconds histogram' in lines
+        count = [
+            _ for _ in lines if _.startswith('pasttle_request_seconds_count')
+            and 'route="/<id:int>"' in _ and 'status="200"' in _
+        ]
+        assert len(count) == 1 and float(count[0].split()[-1]) >= 2
+        assert [
+            _ for _ in lines if 'route="/<id:int>"' in _
+            and 'status="404"' in _
+        ]
+        for stage in ('highlight', 'template', 'lexer_guess'):
+            assert [
+                _ for _ in lines if 'stage="{}"'.format(stage) in _
+            ], stage
+        assert [
+            _ for _ in lines
+            if _.startswith('pasttle_render_cache_requests_total')
+            and 'result="hit"' in _
+        ]
+        assert [_ for _ in lines if _.startswith('pasttle_response_bytes')]
+
+    def test_profiler(self):
+        "Profile requests by token and slowness, expect rotated profiles"
+        import json
+        import pstats
+        import tempfile
+        from pasttle import profiler, server
+
+        rsp = self.app.post('/post', {
+            'upload': 'def profiled(): pass', 'filename': 'profiled.py',
+        })
+        path = urllib.parse.urlparse(rsp.body).path.decode()
+        with tempfile.TemporaryDirectory() as spool:
+            plugin = profiler.ProfilerPlugin(spool, token='s3cr3t', keep=2)
+            server.application.install(plugin)
+            try:
+                self.app.get(path)
+                self.app.get(path, headers={'X-Pasttle-Profile': 'nope'})
+                assert os.listdir(spool) == []
+                self.app.get(path, headers={'X-Pasttle-Profile': 's3cr3t'})
+                names = sorted(os.listdir(spool))
+                assert [_.rsplit('.', 1)[1] for _ in names] == [
+                    'json', 'prof',
+                ]
+                with open(os.path.join(spool, names[0])) as meta:
+                    about = json.load(meta)
+                assert about['reasons'] == ['header']
+                assert about['route'] == '/<id:int>'
+                assert about['paste'] == int(path[1:])
+                assert about['lexer'] == 'Python'
+                assert about['response_bytes'] > 0
+                stats = pstats.Stats(os.path.join(spool, names[1]))
+                assert stats.total_calls > 0
+                # Every request is slower than this, profiles get rotated
+                plugin.slow, plugin.interval = 1e-9, 0.001
+                for _ in range(3):
+                    self.app.get(path)
+                    self.app.get('/diff/{0}..{0}'.format(path[1:]))
+                metas = [_ for _ in os.listdir(spool) if _.endswith('.json')]
+                assert len(metas) == 2
+                with open(os.path.join(spool, sorted(metas)[-1])) as meta:
+                    about = json.load(meta)
+                assert about['reasons'] == ['slow']
+                assert about['route'] == '/diff/<parent:int>..<id:int>'
+            finally:
+                server.application.uninstall(plugin)
+
+    def test_source_ip(self):
+        "Post from IPv4 and IPv6, expect packed addresses and migrated rows"
+        import tempfile
+        import sqlalchemy
+        from pasttle import model
+
+        ids = []
+        for addr in ('192.0.2.7', '2001:db8::1', '::ffff:192.0.2.8'):
+            rsp = self.app.post(
+                '/post', {'upload': 'From {}'.format(addr)},
+                extra_environ={'REMOTE_ADDR': addr},
+            )
+            ids.append(int(urllib.parse.urlparse(rsp.body).path[1:]))
+        table = model.Paste.__table__
+        with model.engine.begin() as conn:
+            rows = dict(conn.execute(
+                table.select().with_only_columns([table.c.id, table.c.ip])
+                .where(table.c.id.in_(ids))
+            ).fetchall())
+            assert [len(rows[_]) for _ in ids] == [4, 16, 4]
+            # The way previous versions stored them
+            conn.execute(table.update().where(table.c.id == ids[0]).values(
+                ip=bin(int(model.unpack_ip(rows[ids[0]]))).encode()
+            ))
+        rsp = self.app.get('/{}'.format(ids[0]))
+        assert rsp.headers['X-Pasttle-Source-IP'] == '192.0.2.7'
+        assert model.migrate_ips(batch=2) == 1
+        assert model.migrate_ips() == 0
+        rsp = self.app.get('/raw/{}'.format(ids[0]))
+        assert rsp.headers['X-Pasttle-Source-IP'] == '192.0.2.7'
+        rsp = self.app.get('/raw/{}'.format(ids[1]))
+        assert rsp.headers['X-Pasttle-Source-IP'] == '2001:db8::1'
+        rsp = self.app.get('/raw/{}'.format(ids[2]))
+        assert rsp.headers['X-Pasttle-Source-IP'] == '192.0.2.8'
+        # Databases of previous versions get the indexes they miss
+        with tempfile.TemporaryDirectory() as tmp:
+            engine = sqlalchemy.create_engine(
+                'sqlite:///{}'.format(os.path.join(tmp, 'indexes.db'))
+            )
+            model.Base.metadata.create_all(engine)
+            with engine.begin() as conn:
+                for name in ('ix_paste_ip', 'ix_paste_digest'):
+                    conn.execute(sqlalchemy.text('DROP INDEX {}'.format(name)))
+            model.create_schema(engine)
+            indexes = sqlalchemy.inspect(engine).get_indexes('paste')
+            assert set(['ix_paste_ip', 'ix_paste_digest']) <= set(
+                [_['name'] for _ in indexes]
+            )
+            engine.dispose()
+
+    def test_rate_limits(self):
+        "Flood the write path, expect 429s per client and 503s when busy"
+        from pasttle import limits, server
+
+        now = [0.0]
+        buckets = limits.TokenBuckets(2, 4, shards=1, clock=lambda: now[0])
+        assert [buckets.take('a') for _ in range(4)] == [0] * 4
+        assert buckets.take('a') == 0.5
+        now[0] += 0.5
+        assert buckets.take('a') == 0
+        assert buckets.take('b') == 0 and len(buckets) == 2
+        # Idle long enough to be full again, then dropped
+        now[0] += 2
+        buckets.take('b')
+        assert len(buckets) == 1
+
+        admission = limits.Admission(1)
+        plugin = limits.LimitPlugin(
+            dict(write=limits.TokenBuckets(0.001, 2)), admission,
+        )
+        server.application.install(plugin)
+        try:
+            for _ in range(2):
+                self.app.post('/post', {'upload': 'Limited'})
+            rsp = self.app.post('/post', {'upload': 'Limited'}, status=429)
+            assert int(rsp.headers['Retry-After']) > 1
+            rsp = self.app.post(
+                '/post', {'upload': 'Limited'},
+                extra_environ={'REMOTE_ADDR': '192.0.2.9'},
+            )
+            assert rsp.status == '200 OK'
+            # Forged forwarding headers don't make a new client
+            self.app.post(
+                '/post', {'upload': 'Limited'}, status=429,
+                headers={'X-Forwarded-For': '198.51.100.1'},
+            )
+            plugin.proxies = 1
+            rsp = self.app.post(
+                '/post', {'upload': 'Limited'},
+                headers={'X-Forwarded-For': '198.51.100.1, 198.51.100.2'},
+            )
+            assert rsp.status == '200 OK'
+            assert limits.client_addr({
+                'REMOTE_ADDR': '192.0.2.1',
+                'HTTP_X_FORWARDED_FOR': '198.51.100.1, 198.51.100.2',
+            }, 2) == '198.51.100.1'
+            plugin.proxies = 0
+            assert self.app.get('/recent').status == '200 OK'
+            assert admission.inflight == 0
+            assert admission.enter()
+            rsp = self.app.get('/recent', status=503)
+            assert rsp.headers['Retry-After'] == '1'
+            assert self.app.get('/pygments/tango.css').status == '200 OK'
+            admission.leave()
+        finally:
+            server.application.uninstall(plugin)
+
+    def test_expiry(self):
+        "Post expiring pastes, expect them gone when they expire and reaped"
+        import datetime
+        import tempfile
+        import sqlalchemy
+        import sqlalchemy.orm
+        from pasttle import model, reaper
+
+        rsp = self.app.post('/post', {'upload': 'Expiring', 'expires': '1h'})
+        path = urllib.parse.urlparse(rsp.body).path.decode()
+        rsp = self.app.get('/raw{}'.format(path))
+        max_age = int(rsp.headers['Cache-Control'].split('max-age=')[1])
+        assert 3500 < max_age <= 3600
+        rsp = self.app.post('/post', {'upload': 'x', 'expires': 'soon'},
+                            status=400)
+        assert rsp.status == '400 Bad Request'
+        session = sqlalchemy.orm.Session(bind=model.engine)
+        paste = session.query(model.Paste).get(int(path[1:]))
+        paste.expires = datetime.datetime.utcnow()
+        session.commit()
+        session.close()
+        for url in (path, '/raw{}'.format(path)):
+            assert self.app.get(url, status=410).status == '410 Gone'
+        rsp = self.app.get('/recent?before={}&format=json'.format(
+            int(path[1:]) + 1
+        ))
+        assert int(path[1:]) not in [_['id'] for _ in rsp.json['pastes']]
+
+        with tempfile.TemporaryDirectory() as tmp:
+            engine = sqlalchemy.create_engine(
+                'sqlite:///{}'.format(os.path.join(tmp, 'reaper.db'))
+            )
+            model.Base.metadata.create_all(engine)
+            session = sqlalchemy.orm.Session(bind=engine)
+            past = datetime.datetime.utcnow() - datetime.timedelta(1)
+            for x in range(5):
+                session.add(model.Paste(
+                    content='Shared', mimetype='text/plain',
+                    expires=past if x < 4 else None,
+                ))
+            session.commit()
+            reaped = reaper.Reaper(engine, batch=3, pause=0)
+            assert reaped.reap() == 4
+            assert reaped.reaped == 4
+            assert session.query(model.Paste).count() == 1
+            blob = session.query(model.Blob).get(model.digest('Shared'))
+            assert blob.refcount == 1
+            session.close()
+            engine.dispose()
+
+    def test_reaped_ids(self):
+        "Reap a paste and post another, expect a new id and its own page"
+        import datetime
+        import tempfile
+        import sqlalchemy
+        import sqlalchemy.orm
+        from pasttle import model, reaper
+
+        rsp = self.app.post('/post', {
+            'upload': 'Reaped secret', 'password': 'secret', 'expires': '1h',
+        })
+        id = int(urllib.parse.urlparse(rsp.body).path[1:])
+        rsp = self.app.post('/{}'.format(id), {'password': 'secret'})
+        assert 'Reaped secret' in rsp.text
+        session = sqlalchemy.orm.Session(bind=model.engine)
+        paste = session.query(model.Paste).get(id)
+        paste.expires = datetime.datetime(2000, 1, 1)
+        session.commit()
+        assert reaper.Reaper(model.engine).reap() >= 1
+        assert session.query(model.Paste).get(id) is None
+        session.close()
+        rsp = self.app.post('/post', {'upload': 'Reposted'})
+        assert int(urllib.parse.urlparse(rsp.body).path[1:]) > id
+        rsp = self.app.get(urllib.parse.urlparse(rsp.body).path.decode())
+        assert 'Reposted' in rsp.text and 'Reaped secret' not in rsp.text
+
+        # Tables of previous versions are rebuilt with AUTOINCREMENT ids
+        with tempfile.TemporaryDirectory() as tmp:
+            engine = sqlalchemy.create_engine(
+                'sqlite:///{}'.format(os.path.join(tmp, 'ids.db'))
+            )
+            old = model.Paste.__table__.to_metadata(sqlalchemy.MetaData())
+            old.dialect_kwargs['sqlite_autoincrement'] = False
+            old.metadata.create_all(engine)
+            with engine.begin() as conn:
+                for x in range(2):
+                    conn.execute(old.insert().values(
+                        content='', mimetype='text/plain', digest=str(x),
+                    ))
+            model.create_schema(engine)
+            with engine.begin() as conn:
+                assert 'AUTOINCREMENT' in conn.execute(sqlalchemy.text(
+                    "SELECT sql FROM sqlite_master WHERE name = 'paste'"
+                )).scalar()
+                conn.execute(old.delete().where(old.c.id == 2))
+                conn.execute(old.insert().values(
+                    content='', mimetype='text/plain', digest='2',
+                ))
+                rows = conn.execute(
+                    sqlalchemy.select([old.c.id, old.c.digest])
+                    .order_by(old.c.id)
+                ).fetchall()
+                assert [tuple(_) for _ in rows] == [(1, '0'), (3, '2')]
+            indexes = sqlalchemy.inspect(engine).get_indexes('paste')
+            assert 'ix_paste_expires' in [_['name'] for _ in indexes]
+            engine.dispose()
+
+    def test_lazy_startup(self):
+        "Import the server, expect heavy modules left for later"
+        import subprocess
+        from pasttle import model
+
+        code = (
+            'import sys, pasttle.server; print(sorted(set(sys.modules) & '
+            '{"pkg_resources", "pygments.lexers", "pygments.formatters", '
+            '"difflib"}))'
+        )
+        out = subprocess.run(
+            [sys.executable, '-c', code], check=True,
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)),
+        ).stdout
+        assert out.strip() == b'[]'
+        # Creating the schema again leaves it alone
+        model.create_schema()
+        assert self.app.get('/recent').status == '200 OK'
+
+    def test_lexer_resolution(self):
+        "Resolve and guess lexers, expect memoized and time-boxed lookups"
+        from pasttle import lexing, util
+
+        assert lexing.by_name('python') is lexing.by_name('Python')
+        assert lexing.by_mimetype('text/x-python') is lexing.by_name('py')
+        assert lexing.alias_for_mimetype('text/x-rst') == 'restructuredtext'
+        lexer, elapsed = lexing.guess('[main]\nkey = value\n', 'setup.cfg')
+        assert lexer.name == 'INI'
+        assert elapsed >= 0
+        util.conf.set(util.cfg_section, 'lexer_guess_ms', '0')
+        try:
+            lexer, elapsed = lexing.guess('#!/usr/bin/env python\n')
+        finally:
+            util.conf.set(util.cfg_section, 'lexer_guess_ms', '200')
+        assert lexer is lexing.by_mimetype('text/plain')
+
+    def test_highlight_timeout(self):
+        "Highlight in worker processes, expect slow jobs killed and skipped"
+        import threading
+        import sqlalchemy.orm
+        from pasttle import model, sandbox, server
+
+        pool = sandbox.ProcessPool(1, 5, wait=0)
+        try:
+            assert pool.run(len, 'abc') == 3
+            self.assertRaises(ValueError, pool.run, int, 'x')
+            self.assertRaises(
+                sandbox.TimedOut, pool.run, time.sleep, 5, timeout=0.1
+            )
+            busy = threading.Thread(target=pool.run, args=(time.sleep, 1))
+            busy.start()
+            time.sleep(0.5)
+            self.assertRaises(sandbox.Busy, pool.run, len, 'abc')
+            busy.join()
+            assert pool.run(len, 'abc') == 3
+            assert pool.results == dict(
+                ok=3, error=1, timeout=1, crashed=0, busy=1,
+            )
+        finally:
+            pool.close()
+
+        text = 'def too_slow(): return "<b>"'
+        rsp = self.app.post('/post', {'upload': text, 'syntax': 'python'})
+        path = urllib.parse.urlparse(rsp.body).path.decode()
+        highlighter = server.highlighter
+        # Nothing ever finishes in no time
+        server.highlighter = sandbox.ProcessPool(1, 0, wait=5)
+        try:
+            body = self.app.get('{}?lang=python'.format(path)).body.decode()
+            assert 'def too_slow(): return &quot;&lt;b&gt;&quot;' in body
+            assert server.highlighter.results['timeout'] == 1
+            session = sqlalchemy.orm.Session(bind=model.engine)
+            blob = session.query(model.Blob).get(model.digest(text))
+            assert blob.slow_lexer == 'Python'
+            session.close()
+            self.app.get(path)
+            assert server.highlighter.results['timeout'] == 1
+        finally:
+            server.highlighter.close()
+            server.highlighter = highlighter
+
+        # Shown plain for want of a free process (or of one that starts),
+        # kept by no cache and tried again next time
+        ids = []
+        for x in range(2):
+            rsp = self.app.post('/post', {
+                'upload': 'def busy():\n    return {}\n'.format(x),
+                'syntax': 'python',
+            })
+            ids.append(int(urllib.parse.urlparse(rsp.body).path[1:]))
+        pages = (
+            ('/{}'.format(ids[0]), 'class="k"'),
+            ('/diff/{}..{}'.format(*ids), 'class="gi"'),
+        )
+        try:
+            for pool, result in (
+                (sandbox.ProcessPool(0, 5, wait=0), 'busy'),
+                (sandbox.ProcessPool(
+                    1, 5, preload=['pasttle.no_such_module'],
+                ), 'crashed'),
+            ):
+                server.highlighter = pool
+                for path, highlighted in pages:
+                    rsp = self.app.get(path)
+                    assert highlighted not in rsp.body.decode()
+                    assert 'ETag' not in rsp.headers
+                    assert rsp.headers['Cache-Control'] == 'no-store'
+                assert pool.results[result] == 2
+            session = sqlalchemy.orm.Session(bind=model.engine)
+            assert session.query(model.Paste).get(ids[0]).blob.slow_lexer \
+                is None
+            session.close()
+            server.highlighter = None
+            for path, highlighted in pages:
+                rsp = self.app.get(path)
+                assert highlighted in rsp.body.decode()
+                assert 'immutable' in rsp.headers['Cache-Control']
+        finally:
+            server.highlighter = highlighter
+
+    def test_line_windows(self):
+        "Show ranges of lines of a long paste, expect only those rendered"
+        import sqlalchemy.orm
+        from pasttle import model, util
+
+        text = u''.join(
+            u'x_{0} = """\nstring {0}\n"""\n'.format(_) for _ in range(40)
+        )
+        rsp = self.app.post('/post', {'upload': text, 'syntax': 'python'})
+        path = urllib.parse.urlparse(rsp.body).path.decode()
+        rsp = self.app.get('{}?lines=8-10'.format(path))
+        body = rsp.body.decode()
+        assert 'Lines 8 to 10 of 120' in body
+        assert 'id="ln-7"' not in body and 'id="ln-11"' not in body
+        # Line 8 is inside a string started on line 7
+        assert '<span class="s2">string 2</span>' in body
+        assert '?lines=1-7' in body and '?lines=11-1010' in body
+        rsp = self.app.get('{}?lines=120'.format(path))
+        assert 'Lines 120 to 120 of 120' in rsp.body.decode()
+        for lines in ('121', '0-1', '9-8', 'x'):
+            rsp = self.app.get('{}?lines={}'.format(path, lines), status=400)
+            assert rsp.status == '400 Bad Request'
+        assert 'Lines ' not in self.app.get(path).body.decode()
+        # The host header can't get out of the script's string
+        body = self.app.get(
+            '{}?lines=8-10'.format(path),
+            headers={'Host': "evil';alert(1);'</script>"},
+        ).body.decode()
+        assert "alert(1);'</script>" not in body
+        assert (
+            "\"http://evil';alert(1);'\\u003c/script\\u003e{}?lines=\""
+        ).format(path) in body
+        # Blobs stored by previous versions have their lines counted once
+        session = sqlalchemy.orm.Session(bind=model.engine)
+        blob = session.query(model.Blob).get(model.digest(text))
+        blob.lines = None
+        session.commit()
+        util.conf.set(util.cfg_section, 'window_lines', '50')
+        util.conf.set(util.cfg_section, 'window_over_lines', '100')
+        try:
+            body = self.app.get(path).body.decode()
+            assert 'Lines 1 to 50 of 120' in body
+            assert '?lines=51-100' in body
+            session.expire_all()
+            assert session.query(model.Blob).get(
+                model.digest(text)
+            ).lines == 120
+        finally:
+            util.conf.set(util.cfg_section, 'window_lines', '1000')
+            util.conf.set(util.cfg_section, 'window_over_lines', '5000')
+            session.close()
+
+    def test_conditional_get(self):
+        "Send back the validators we were given, expect 304s without content"
+        import sqlalchemy
+        from pasttle import model
+
+        rsp = self.app.post(
+            '/post', {
+                'upload': 'Conditional text',
+            }
+        )
+        assert rsp.status == '200 OK'
+        path = urllib.parse.urlparse(rsp.body).path.decode()
+        for prefix in ('/raw', ''):
+            rsp = self.app.get('{}{}'.format(prefix, path))
+            assert rsp.status == '200 OK'
+            assert 'immutable' in rsp.headers['Cache-Control']
+            etag = rsp.headers['ETag']
+            last_modified = rsp.headers['Last-Modified']
+            statements = []
+
+            def record(conn, cursor, statement, *args):
+                statements.append(statement)
+
+            sqlalchemy.event.listen(
+                model.engine, 'before_cursor_execute', record
+            )
+            try:
+                rsp = self.app.get(
+                    '{}{}'.format(prefix, path),
+                    headers={'If-None-Match': etag},
+                )
+            finally:
+                sqlalchemy.event.remove(
+                    model.engine, 'before_cursor_execute', record
+                )
+            assert rsp.status == '304 Not Modified'
+            assert rsp.body == b''
+            assert statements
+            assert not [_ for _ in statements if 'paste.content' in _]
+            rsp = self.app.get(
+                '{}{}'.format(prefix, path),
+                headers={'If-Modified-Since': last_modified},
+            )
+            assert rsp.status == '304 Not Modified'
+            rsp = self.app.get(
+                '{}{}'.format(prefix, path),
+                headers={'If-None-Match': '"stale"'},
+            )
+            assert rsp.status == '200 OK'
+
+    def test_conditional_get_css(self):
+        "Fetch a stylesheet twice, expect a 304 the second time"
+        rsp = self.app.get('/pygments/tango.css')
+        assert rsp.status == '200 OK'
+        rsp = self.app.get(
+            '/pygments/tango.css',
+            headers={'If-None-Match': rsp.headers['ETag']},
+        )
+        assert rsp.status == '304 Not Modified'
+
+    def test_stylesheets(self):
+        "Fetch stylesheets plain and gzipped, expect the same precomputed CSS"
+        import gzip
+        import webob
+        from pasttle import server
+
+        rsp = self.app.get('/pygments/tango.css')
+        assert rsp.content_type == 'text/css'
+        assert rsp.body == server.stylesheets.get('tango').css
+        assert 'immutable' in rsp.headers['Cache-Control']
+        etag = rsp.headers['ETag']
+        # webtest decodes compressed bodies, talk to the app directly
+        rsp = webob.Request.blank(
+            '/pygments/tango.css', headers={'Accept-Encoding': 'gzip'},
+        ).get_response(server.application)
+        assert rsp.headers['Content-Encoding'] == 'gzip'
+        assert rsp.headers['ETag'] != etag
+        assert gzip.decompress(rsp.body) == server.stylesheets.get('tango').css
+        rsp = self.app.get('/pygments/nonexistent.css')
+        assert rsp.body == server.stylesheets.get('default').css
+        other = self.app.get('/pygments/monokai.css')
+        assert other.headers['ETag'] != etag
+        assert other.body != server.stylesheets.get('tango').css
+        # Pages link to the version of the stylesheet they were rendered with
+        rsp = self.app.post('/post', {'upload': 'Styled'})
+        rsp = self.app.get(urllib.parse.urlparse(rsp.body.decode()).path)
+        assert '/pygments/tango.css?v={}"'.format(
+            server.stylesheets.get('tango').digest
+        ) in rsp.body.decode()
+
     def test_404s(self):
         "Test several invalid scenarios, expect 404s"
 